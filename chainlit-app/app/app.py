@@ -1,15 +1,26 @@
 from dotenv import load_dotenv
 import os
-import uuid
-from openai import AsyncOpenAI
+import copy
+import time
 from mcp import ClientSession
 import chainlit as cl
 import json
-from utils import parse_mcp_result,get_result_value,get_practitioner,get_official_name
-from context_manager import IRISContextManager
+from utils import parse_mcp_result,get_result_value
+from async_context_manager import AsyncIRISContextManager
 from planner_agent import generate_plan
 from context_aware_agent import can_answer_from_context, generate_context_answer
 from data_visualization_agent import generate_interactive_plotly_chart
+from plan_executor import run_plan
+from speculation import SpeculativeTask, SpeculationStats
+from llm_providers import LLMRouter
+from llm_cache import LLMResponseCache
+from plan_cache import PlanCache
+from intent_router import IntentRouter
+from prompt_builder import PromptBuilder, Tokenizer
+from summarizer import ConversationSummarizer
+from history_selector import HistorySelector
+from practitioner_service import PractitionerService
+from mcp_pool import MCPConnectionPool, parse_servers
 import audioop
 import numpy as np
 import io
@@ -20,11 +31,14 @@ import base64
 
 load_dotenv()
 
-prac_id = os.getenv("Practioner_ID")
-practioner = get_practitioner(prac_id)
-prac_name = get_official_name(practioner)
+# 未启用认证（或用户没有绑定医生）时使用的医生资源id
+default_prac_id = os.getenv("Practioner_ID")
+# 医生档案在会话开始时按需从FHIR查询并缓存，启动时不访问FHIR服务器
+practitioners = PractitionerService(
+    os.getenv("FHIR_BASE_URL", "http://localhost:52880/csp/healthshare/fhirserver/fhir/r4"),
+    ttl=float(os.getenv("PRACTITIONER_CACHE_TTL", "600"))
+)
 assistant_name = os.getenv("Assistant_NAME")
-llm_model = os.getenv("LLM_MODEL")
 
 #临床助手Prompt
 assistant_prompt = f"""
@@ -73,43 +87,116 @@ SILENCE_THRESHOLD = (
 )
 SILENCE_TIMEOUT = 2000.0  # Seconds of silence to consider the turn finished
 
-# 初始化IRIS上下文管理器
-ctx = IRISContextManager(
+# 每轮对话中同时执行的计划步骤数上限
+plan_max_concurrency = int(os.getenv("PLAN_MAX_CONCURRENCY", "4"))
+
+# 推测执行：上下文判断与计划生成同时开始，可以直接回答时取消计划生成；
+# 最近一段时间丢弃比例超过上限时自动暂停推测，节省token
+speculation = SpeculationStats(
+    enabled=os.getenv("SPECULATIVE_PLANNING", "true").lower() == "true",
+    max_discard_rate=float(os.getenv("SPECULATION_MAX_DISCARD_RATE", "1.0"))
+)
+
+# 执行计划缓存：同一意图模板的问题（如"查看患者X的信息"）用新的患者id、药品名等重放已成功执行的计划，0表示不缓存
+plan_cache = PlanCache(int(os.getenv("PLAN_CACHE_SIZE", "256")))
+
+# 上下文检测前的规则路由：无对话、用药风险、费用未查询等明显不能直接回答的问题在本地判定，不调用LLM
+intent_router = IntentRouter(os.getenv("INTENT_ROUTER", "true").lower() == "true")
+
+# 各Agent提示词的token预算：保留系统规则和最新问题，优先放入最近的对话，较早的工具返回数据换成摘要
+prompt_builder = PromptBuilder(
+    budgets={
+        "context_check": int(os.getenv("PROMPT_BUDGET_CONTEXT_CHECK", "6000")),
+        "planner": int(os.getenv("PROMPT_BUDGET_PLANNER", "8000")),
+        "context_answer": int(os.getenv("PROMPT_BUDGET_CONTEXT_ANSWER", "16000")),
+    },
+    payload_tokens=int(os.getenv("PROMPT_PAYLOAD_TOKENS", "300")),
+    tokenizer=Tokenizer(os.getenv("PROMPT_TOKENIZER") or None)
+)
+
+# 初始化IRIS上下文管理器（异步版本，IRIS调用在线程池中执行，不阻塞事件循环）
+ctx = AsyncIRISContextManager(
     host=os.getenv("IRIS_HOSTNAME"),
     port=int(os.getenv("IRIS_PORT")),
     namespace=os.getenv("IRIS_NAMESPACE"),
     username=os.getenv("IRIS_USERNAME"),
     password=os.getenv("IRIS_PASSWORD"),
+    # 写后缓冲：对话消息最多延迟这么久批量写入IRIS，轮次结束和读取前都会先写出
+    flush_interval=float(os.getenv("IRIS_WRITE_BEHIND_MS", "200")) / 1000,
+    # 进程内会话读缓存容量，多个worker通过IRIS中的会话版本号保持一致
+    cache_max_bytes=int(float(os.getenv("IRIS_SESSION_CACHE_MB", "16")) * 1024 * 1024),
+    # 消息超过阈值时压缩存储（zstd/zlib），超过IRIS字符串长度上限时分块
+    codec=os.getenv("IRIS_STORAGE_CODEC") or None,
+    compress_threshold=int(os.getenv("IRIS_COMPRESS_THRESHOLD", "4096"))
 )
 
-# LLM客户端
-client = AsyncOpenAI(
-    api_key=os.getenv("Qwen_API_KEY"), 
-    base_url="https://dashscope.aliyuncs.com/compatible-mode/v1"
+# LLM客户端：按Agent路由到不同的服务商和模型（DashScope、DeepSeek、OpenAI兼容/本地服务），
+# 只输出JSON的上下文检测和计划生成可以用小模型，风险分析等保留大模型
+router = LLMRouter.from_env()
+
+# LLM响应缓存（默认关闭）：低温度调用的相同请求（重复提问、界面刷新后重试、相同历史上的计划生成）直接重放缓存的响应，
+# 流式响应逐token重放；LLM_CACHE_AGENTS列出启用缓存的Agent
+llm_cache = LLMResponseCache(
+    max_entries=int(os.getenv("LLM_CACHE_SIZE", "512")),
+    max_bytes=int(float(os.getenv("LLM_CACHE_MB", "32")) * 1024 * 1024),
+    ttl=float(os.getenv("LLM_CACHE_TTL", "600"))
 )
+router.enable_cache(llm_cache, [a.strip() for a in os.getenv("LLM_CACHE_AGENTS", "").split(",") if a.strip()])
+
+# 后台滚动摘要：每轮结束后把较早的对话合并进会话头中的摘要，Agent使用 摘要 + 最近的消息
+summarizer = ConversationSummarizer(
+    ctx, router,
+    recent_messages=int(os.getenv("SUMMARY_RECENT_MESSAGES", "8")),
+    min_batch=int(os.getenv("SUMMARY_MIN_BATCH", "8"))
+) if os.getenv("SESSION_SUMMARY", "true").lower() == "true" else None
+
+# 上下文检测、上下文回答和计划生成Agent的历史：摘要 + 与问题相关的较早消息（BM25检索，索引在会话缓存中增量维护）+ 最近的消息
+history_selector = HistorySelector(
+    ctx,
+    top_k=int(os.getenv("HISTORY_TOP_K", "4")),
+    recent_messages=int(os.getenv("HISTORY_RECENT_MESSAGES", "6")),
+    use_summary=summarizer is not None
+)
+
+# 每个worker进程自己的MCP连接：多进程/多节点部署时会话可能由没有界面MCP连接的worker处理
+mcp_pool = MCPConnectionPool(parse_servers(os.getenv("MCP_SERVERS")))
 
 # 音频理解（Qwen-Audio）客户端（由于Qwen不兼容OpenAI音频接口，需额外构建客户端）
 dashscope.api_key = os.getenv('DASHSCOPE_API_KEY')
 #.AsyncClient()
 
 # 各类工具函数
-def get_or_create_session(cl, ctx):
+async def get_practitioner_profile():
+    """
+    当前登录医生的档案。启用认证时从用户metadata的practitioner_id取医生资源id，否则使用配置的Practioner_ID
+    """
+    profile = cl.user_session.get("practitioner")
+    if profile is None:
+        user = cl.user_session.get("user")
+        metadata = getattr(user, "metadata", None) or {}
+        profile = await practitioners.get(metadata.get("practitioner_id") or default_prac_id)
+        cl.user_session.set("practitioner", profile)
+    return profile
+
+async def get_or_create_session(cl, ctx):
     session_id = cl.user_session.get("session_id")
     if not session_id:
-        session_id = str(uuid.uuid4())
+        # 使用浏览器端的会话id：断线重连到其它worker（user_session为空）时仍能找到IRIS中的同一会话
+        session_id = cl.context.session.id
         cl.user_session.set("session_id", session_id)
     # 判断IRIS是否已有此session，没有才创建
-    if ctx.get_session(session_id) is None:
-        ctx.create_session(session_id)  # meta参数可以省略
+    if await ctx.get_session(session_id) is None:
+        await ctx.create_session(session_id)  # meta参数可以省略
         # 创建session时绑定医生身份
-        save_assistant_message(ctx,session_id,f"我是一个临床医生的门诊助手。现在登录的临床医生的资源id是{prac_id},他的姓名是{prac_name}。我们用中文交流。")
+        profile = await get_practitioner_profile()
+        await save_assistant_message(ctx,session_id,f"我是一个临床医生的门诊助手。现在登录的临床医生的资源id是{profile.id},他的姓名是{profile.display_name()}。我们用中文交流。")
     return session_id
 
-def save_user_message(ctx, session_id, msg):
-    ctx.append_history(session_id, "user", msg.content)
+async def save_user_message(ctx, session_id, msg):
+    await ctx.append_history(session_id, "user", msg.content)
 
-def get_history_str(ctx, session_id):
-    history = ctx.get_history(session_id)
+async def get_history_str(ctx, session_id):
+    history = await ctx.get_history(session_id)
     return "\n".join([f"{item['role']}: {item['content']}" for item in history]), history
 
 def build_tool_descriptions(mcp_tools):
@@ -137,8 +224,34 @@ async def call_mcp_tool(session, tool_name, tool_input):
     except Exception as e:
         return f"调用 MCP 工具失败: {e}"
 
-def save_assistant_message(ctx, session_id, answer):
-    ctx.append_history(session_id, "assistant", answer)
+async def save_assistant_message(ctx, session_id, answer):
+    await ctx.append_history(session_id, "assistant", answer)
+
+async def show_step(name, output):
+    async with cl.Step(name=name) as step:
+        step.output = output
+
+async def stream_answer(out, system_prompt, user_prompt, agent="answer"):
+    """流式生成回答，token经计划执行器按步骤顺序输出到界面，返回完整文本"""
+    message = cl.Message(content="")
+    client, llm_model = router.route(agent)
+    stream = await client.chat.completions.create(
+        model=llm_model,
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt},
+        ],
+        stream=True,
+        temperature=0.01
+    )
+    tokens = []
+    async for part in stream:
+        delta = part.choices[0].delta
+        if delta.content:
+            tokens.append(delta.content)
+            # Stream the output of the step
+            await out.emit(lambda token=delta.content: message.stream_token(token))
+    return "".join(tokens)
 
 async def send_messages(cl, answer, reasoning_output, counter):
     await cl.Message(content=answer).send()
@@ -187,18 +300,17 @@ async def speech_to_text(audio_buffer):
 async def on_chat_start():
     # 每次新会话分配一个session_id并创建global
     #session_id = str(uuid.uuid4())
-    session_id = get_or_create_session(cl, ctx)
+    session_id = await get_or_create_session(cl, ctx)
     cl.user_session.set("session_id", session_id)
-    cl.user_session.set("counter", 0)
-    cl.user_session.set("temp_values",{})
-    cl.logger.info(f"医生{prac_id}的名字是{prac_name}")
-    #cl.user_session.set("practitioner",)
+    profile = await get_practitioner_profile()
+    cl.logger.info(f"医生{profile.id}的名字是{profile.name}")
     cl.logger.info(f"新会话分配 session_id: {session_id}")
-    initMsg = f"欢迎您，{prac_name}医生，我是您的门诊助手{assistant_name}。我会协助您完成门诊，欢迎您向我提出任何问题。"
+    initMsg = f"欢迎您，{profile.display_name()}医生，我是您的门诊助手{assistant_name}。我会协助您完成门诊，欢迎您向我提出任何问题。"
     await cl.Message(
         content=initMsg
     ).send()
-    save_assistant_message(ctx, session_id, initMsg)
+    await save_assistant_message(ctx, session_id, initMsg)
+    await ctx.flush(session_id)
 
 @cl.on_mcp_connect
 async def on_mcp_connect(connection, session: ClientSession):
@@ -206,8 +318,11 @@ async def on_mcp_connect(connection, session: ClientSession):
     try:
         result = await session.list_tools()
         tools = [{"name": t.name, "description": t.description, "input_schema": t.inputSchema} for t in result.tools]
-        cl.user_session.set("mcp_tools", {connection.name: tools})
-        cl.user_session.set("mcp_session", session)
+        # 界面可以连接多个MCP服务，按服务名分别保存工具列表和连接
+        cl.user_session.set("mcp_tools", {**(cl.user_session.get("mcp_tools") or {}), connection.name: tools})
+        cl.user_session.set("mcp_sessions", {**(cl.user_session.get("mcp_sessions") or {}), connection.name: session})
+        # 登记服务地址，本进程处理其它worker上建立的会话时可以自行连接
+        mcp_pool.register(connection)
         cl.logger.info(f"MCP 连接成功，已获取 {len(tools)} 个工具")
         
         cl.logger.info(json.dumps(tools,indent=2,ensure_ascii=False))
@@ -221,51 +336,106 @@ async def on_mcp_connect(connection, session: ClientSession):
 
 @cl.on_message
 async def on_message(msg: cl.Message):
-    session_id = get_or_create_session(cl, ctx)
+    session_id = await get_or_create_session(cl, ctx)
     #save_user_message(ctx, session_id, msg)
-    history_str, history = get_history_str(ctx, session_id)
+    history_str, history = await get_history_str(ctx, session_id)
     original_quest = msg.content
+    # Agent提示词使用的历史：摘要 + 与问题相关的较早消息 + 最近的消息
+    agent_history = await history_selector.select(session_id, history, msg.content)
+
+    mcp_tools = cl.user_session.get("mcp_tools")
+    mcp_sessions = cl.user_session.get("mcp_sessions")
+    if not mcp_sessions:
+        # 界面没有在本worker上建立MCP连接（断线重连到其它worker、多进程部署）时使用本进程的连接
+        mcp_sessions, mcp_tools = await mcp_pool.get()
+    # 提取原始tools，并记录每个工具所属服务的连接
+    tool_list = []
+    tool_sessions = {}
+    if mcp_tools:
+        for name, v in mcp_tools.items():
+            tool_list.extend(v)
+            if name in mcp_sessions:
+                tool_sessions.update((t["name"], mcp_sessions[name]) for t in v)
+
+    # 同一意图模板的计划已缓存时不再需要生成
+    cached = plan_cache.match(msg.content, tool_list)
+    cached_plan = cached.plan if cached is not None else None
 
     # === 上下文优先判断 ===
+    # 规则能直接判定时不再调用LLM判断，也不需要推测执行
+    decision = intent_router.route(history, msg.content)
+    # 推测执行：判断上下文的同时就开始生成计划（生成过程先不显示），可以直接回答时取消并丢弃
+    speculative = None
+    if decision is None and cached_plan is None and speculation.should_speculate():
+        stream_usage = router.stream_usage("planner")
+        speculative = SpeculativeTask(
+            lambda trace: generate_plan(agent_history, msg.content, tool_list, *router.route("planner"),
+                                        show_step=False, trace=trace, stream_usage=stream_usage,
+                                        prompt_builder=prompt_builder, session_id=session_id),
+            track_usage=stream_usage)
     # 先判断上下文中的数据是否足够回答问题
-    can_answer, reasoning = await can_answer_from_context(history, msg.content, client,llm_model)
+    try:
+        if decision is None:
+            can_answer, reasoning = await can_answer_from_context(agent_history, msg.content, *router.route("context_check"),
+                                                                  prompt_builder=prompt_builder, session_id=session_id)
+        else:
+            can_answer, reasoning = decision
+    except BaseException:
+        if speculative:
+            await speculation.discard(speculative)
+        raise
+    decided = time.perf_counter()
+    if can_answer and speculative:
+        await speculation.discard(speculative)
+    cl.logger.info(f"规则路由统计: {intent_router.stats()}")
     #cl.logger.info(f"历史信息1： {history_str}")
     #cl.logger.info(f"历史信息2： {history}")
     #cl.logger.info(f"判断状态： {can_answer}, 原因是: {reasoning}")
-    save_user_message(ctx, session_id, msg)
+    await save_user_message(ctx, session_id, msg)
     # 用Step显示判断结果    
     async with cl.Step("判断结果显示") as step:
         step.output = f"🧠 上下文判断: {'可以' if can_answer else '不可以'}直接回答\n"+ f"📝 判断理由: {reasoning}"
 
     if can_answer:
         # 直接基于上下文生成回答
-        answer = await generate_context_answer(history, msg.content, client,llm_model)
+        answer = await generate_context_answer(agent_history, msg.content, *router.route("context_answer"),
+                                               prompt_builder=prompt_builder, session_id=session_id)
         visual_tag = '需要图表'
         need_visual = False
         # 保存并返回回答
         if visual_tag in answer:
             answer = answer.replace(visual_tag, "")
             need_visual = True
-        save_assistant_message(ctx, session_id, answer)
+        await save_assistant_message(ctx, session_id, answer)
         await cl.Message(content=answer).send()
+        await ctx.flush(session_id)
+        if summarizer:
+            summarizer.schedule(session_id)
         # 调用Agent绘图
         if need_visual:
             print("准备画图")
-            await generate_interactive_plotly_chart(answer,original_quest,client,llm_model)
+            await generate_interactive_plotly_chart(answer, original_quest, *router.route("visualization"))
 
         return  # 结束处理，不再执行后续工具调用
 
-    mcp_tools = cl.user_session.get("mcp_tools")
-    session = cl.user_session.get("mcp_session")
     # === 调用 planner_agent 生成 plan ===
-    # 提取原始tools
-    tool_list = []
-    if mcp_tools:
-        for v in mcp_tools.values():
-            tool_list.extend(v)
-
+    # 需要执行计划时才计入计划缓存的命中/未命中（可以直接回答时缓存的计划没有被使用）
+    plan_cache.record(cached)
     # 生成多步 plan
-    plan_json = await generate_plan(history, msg.content, tool_list,client,llm_model)
+    if cached_plan is not None:
+        plan_json = cached_plan
+        await show_step("执行计划缓存", json.dumps(plan_json, ensure_ascii=False, indent=2))
+    elif speculative:
+        plan_json = await speculative.result()
+        speculation.record_used(speculative, decided)
+        # 推测生成时没有显示过程，确定采用后补充显示
+        await show_step("执行计划生成Agent", speculative.trace["response"])
+    else:
+        plan_json = await generate_plan(agent_history, msg.content, tool_list, *router.route("planner"),
+                                        prompt_builder=prompt_builder, session_id=session_id)
+    cl.logger.info(f"推测执行统计: {speculation.stats()}")
+    # 执行时会把临时变量的值写入步骤input，缓存用执行前的计划
+    plan_snapshot = copy.deepcopy(plan_json)
     plan = plan_json.get("plan", [])
     explanation = plan_json.get("explanation", "") 
     print("????????")
@@ -274,73 +444,65 @@ async def on_message(msg: cl.Message):
     print(process_steps)
     answer_texts = []
 
-    temp_values = cl.user_session.get("temp_values")
+    # 临时变量保存在IRIS中，会话的后续轮次可以由任意worker处理
+    temp_values = await ctx.get_vars(session_id)
+    new_values = {}
 
-    for idx, step in enumerate(plan):
+    async def run_step(idx, step, out):
         action = step.get("action")
         tool = step.get("tool")
         input_data = step.get("input")
         result_var = step.get("result_var")
         step_desc = step.get("description", "")
-        process_steps.append(f"Step {idx+1}: {step_desc}")
         #cl.logger.info(input_data)
         # 如果input_data是Dict类型，则表明其中包含了上下文中保存的临时变量，需从temp_values中提取对应的临时变量替换其值
+        # （调度器保证引用的临时变量已由前面的步骤产生）
         if isinstance(input_data, dict):
             for key in input_data:
                     if isinstance(input_data[key], str) and input_data[key] in temp_values:
                         input_data[key] = temp_values[input_data[key]]
         #cl.logger.info(temp_values)
         #cl.logger.info(input_data)
-        if action == "call_tool" and tool and session:
-            # 调用 MCP 工具
+        if action == "call_tool" and tool and tool_sessions:
+            # 调用 MCP 工具（使用提供该工具的服务的连接）
             try:
+                session = tool_sessions.get(tool)
+                if session is None:
+                    raise ValueError("已连接的MCP服务中没有该工具")
                 raw_result = await session.call_tool(tool, input_data)
                 parsed_contents = parse_mcp_result(raw_result)
                 #cl.logger.info(parsed_contents)
                 # 如果result_var中标识出了临时变量的名称，则将parsed_contents作为临时变量值赋给这个临时变量
                 if result_var:
                     temp_values[result_var]=get_result_value(parsed_contents)
+                    new_values[result_var]=temp_values[result_var]
                 for content_type, content_value in parsed_contents:
                     if content_type == "text":
-                        answer_texts.append(content_value)
+                        out.answers.append(content_value)
                         #打印工具返回结果
-                        async with cl.Step(name="工具返回结果") as step:
-                            step.output = content_value
+                        await out.emit(lambda v=content_value: show_step("工具返回结果", v))
                         #await cl.Message(content=f"[{tool}] {content_value}").send()
                     elif content_type == "file":
-                        await cl.Message(content=f"文件链接: {content_value}").send()
+                        await out.emit(lambda v=content_value: cl.Message(content=f"文件链接: {v}").send())
                     elif content_type == "image":
-                        await cl.Message(content="收到图片:").send()
-                        await cl.Message(image=content_value).send()
+                        await out.emit(lambda: cl.Message(content="收到图片:").send())
+                        await out.emit(lambda v=content_value: cl.Message(image=v).send())
                     elif content_type == "error":
-                        answer_texts.append(f"❌ {content_value}")
-                        await cl.Message(content=f"❌ {content_value}").send()
+                        out.failed = True
+                        out.answers.append(f"❌ {content_value}")
+                        await out.emit(lambda v=content_value: cl.Message(content=f"❌ {v}").send())
                     else:
-                        await cl.Message(content=f"其他内容: {content_value}").send()
+                        await out.emit(lambda v=content_value: cl.Message(content=f"其他内容: {v}").send())
             except Exception as e:
                 err_msg = f"调用工具 {tool} 失败: {e}"
-                answer_texts.append(err_msg)
-                await cl.Message(content=err_msg).send()
+                out.failed = True
+                out.answers.append(err_msg)
+                await out.emit(lambda: cl.Message(content=err_msg).send())
         elif action == "llm_answer":
             # 直接用LLM自身能力生成回答
             #cl.logger.info(temp_values)
             llm_prompt = input_data if isinstance(input_data, str) else str(input_data)
-            message = cl.Message(content="")
-            stream = await client.chat.completions.create(
-                model=llm_model,
-                messages=[
-                    {"role": "system", "content": assistant_prompt},
-                    {"role": "user", "content": llm_prompt},
-                ],
-                stream=True,
-                temperature=0.01
-            )
-            async for part in stream:
-                delta = part.choices[0].delta
-                if delta.content:
-                    # Stream the output of the step
-                    await message.stream_token(delta.content)
-            answer_texts.append(message.content)
+            out.answers.append(await stream_answer(out, assistant_prompt, llm_prompt))
         # 医保风险分析
         elif action == "risk_analyst":
             context_data = input_data if isinstance(input_data, str) else str(input_data)
@@ -349,36 +511,60 @@ async def on_message(msg: cl.Message):
             问题：{user_question}
             上下文信息:{context_data}
             """
-            message = cl.Message(content="")
-            stream = await client.chat.completions.create(
-                model=llm_model,
-                messages=[
-                    {"role": "system", "content": insurance_expert_prompt},
-                    {"role": "user", "content": question_prompt},
-                ],
-                stream=True,
-                temperature=0.01
-            )
-            async for part in stream:
-                delta = part.choices[0].delta
-                if delta.content:
-                    # Stream the output of the step
-                    await message.stream_token(delta.content)
-            answer_texts.append(message.content)
+            out.answers.append(await stream_answer(out, insurance_expert_prompt, question_prompt, agent="risk"))
         else:
             # 计划格式不对
-            process_steps.append(f"无法识别的计划类型：{step}")
+            out.failed = True
+            out.notes.append(f"无法识别的计划类型：{step}")
+
+    # 按result_var/$变量的依赖关系并发执行互不依赖的步骤，界面输出和历史记录仍按计划顺序
+    outputs = await run_plan(plan, run_step, plan_max_concurrency)
+    # 新生成且各步骤都执行成功的计划加入缓存
+    if cached_plan is None and not any(out.failed for out in outputs):
+        plan_cache.store(original_quest, tool_list, plan_snapshot)
+    cl.logger.info(f"计划缓存统计: {plan_cache.stats()}")
+    cl.logger.info(f"提示词预算统计: {prompt_builder.stats()}")
+    cl.logger.info(f"历史检索统计: {history_selector.stats()}")
+    cl.logger.info(f"LLM响应缓存统计: {llm_cache.stats()}")
+    for idx, out in enumerate(outputs):
+        process_steps.append(f"Step {idx+1}: {plan[idx].get('description', '')}")
+        process_steps.extend(out.notes)
+        answer_texts.extend(out.answers)
 
     # 汇总本轮对话内容并保存在IRIS中
     answer = "\n".join(answer_texts)
     if answer:
-        save_assistant_message(ctx, session_id, answer)
-    counter = cl.user_session.get("counter")
-    counter += 1
-    cl.user_session.set("counter", counter)
+        await save_assistant_message(ctx, session_id, answer)
+    if new_values:
+        await ctx.set_vars(session_id, new_values)
+    # 轮次结束，写出本轮缓冲的消息，并在后台更新对话摘要
+    await ctx.flush(session_id)
+    if summarizer:
+        summarizer.schedule(session_id)
+    counter = await ctx.increment_counter(session_id, "turns")
     process_steps.append(f"你已经发送了 {counter} 条消息！")
     #await cl.Message(content="📝 本轮多步推理/执行过程：\n" + "\n".join(process_steps)).send()
 
+@cl.on_app_startup
+async def on_app_startup():
+    cl.logger.info(f"LLM路由: {router.describe()}")
+    # 配置了维护间隔时在后台定期压缩、归档和清理旧会话
+    interval = os.getenv("SESSION_MAINTENANCE_INTERVAL_MIN")
+    if interval:
+        ctx.start_maintenance(
+            float(interval) * 60,
+            archive_dir=os.getenv("SESSION_ARCHIVE_DIR"),
+            compact_after_days=float(os.getenv("SESSION_COMPACT_AFTER_DAYS", "7")),
+            retention_days=float(os.getenv("SESSION_RETENTION_DAYS", "90"))
+        )
+
+@cl.on_app_shutdown
+async def on_app_shutdown():
+    # 退出前写出所有缓冲的对话消息
+    await ctx.aclose()
+    await practitioners.aclose()
+    await mcp_pool.aclose()
+
 @cl.on_audio_start
 async def on_audio_start():
     cl.user_session.set("silent_duration_ms", 0)
@@ -0,0 +1,22 @@
+"""
+多进程部署入口。chainlit run 只启动一个进程，需要利用多核时用uvicorn启动多个worker（在chainlit-app/app目录下执行）：
+    uvicorn asgi:app --host 0.0.0.0 --port 8000 --workers 4
+每个worker各自加载app.py，建立自己的IRIS连接、LLM客户端和MCP连接；会话历史、临时变量和计数器保存在IRIS中，
+会话的任意一轮可以由任意worker处理。Socket.IO只使用websocket传输（每个连接固定在一个worker上），
+多节点部署时负载均衡器需开启websocket支持，界面发起的MCP连接、文件上传等HTTP请求需按会话保持粘性，
+或在MCP_SERVERS中配置MCP服务地址由各worker自行连接。
+"""
+import os
+from chainlit.auth import ensure_jwt_secret
+from chainlit.config import config, load_module
+from chainlit.server import app
+
+config.run.host = os.getenv("CHAINLIT_HOST", "0.0.0.0")
+config.run.port = int(os.getenv("CHAINLIT_PORT", "8000"))
+config.run.root_path = os.getenv("CHAINLIT_ROOT_PATH", "")
+# 默认的long-polling传输的各次请求可能落在不同worker上
+if not config.project.transports:
+    config.project.transports = ["websocket"]
+config.run.module_name = os.getenv("CHAINLIT_APP", "app.py")
+load_module(config.run.module_name)
+ensure_jwt_secret()
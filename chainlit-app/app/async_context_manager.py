@@ -0,0 +1,257 @@
+import asyncio
+import datetime
+import os
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from context_manager import IRISContextManager
+from session_cache import SessionCache
+from resource_store import FHIRResourceStore
+from storage_codec import StorageCodec
+import maintenance
+
+class AsyncIRISContextManager:
+    """
+    IRISContextManager 的异步版本，供Chainlit事件循环中的处理函数使用。
+    IRIS原生API是阻塞调用且连接不是线程安全的：所有调用在有界线程池中执行，
+    每个工作线程持有自己的连接。方法名和参数与 IRISContextManager 保持一致，调用时加 await 即可。
+    所有连接共享一个进程内 SessionCache，会话版本号未变时读操作只需读取一次版本号。
+
+    flush_interval > 0 时启用写后缓冲（write-behind）：append_history 只把消息放入按会话的缓冲区，
+    在 flush_interval 秒后、轮次结束调用 flush() 时、或读取该会话前批量写入IRIS（一次事务）；
+    关闭时 aclose() 写出所有缓冲的消息。
+
+    可以在导入时创建（多worker部署时由父进程导入后fork）：连接在首次调用时才建立，
+    检测到进程号变化时丢弃从父进程继承的线程池、连接、缓冲区和缓存，在子进程中重新建立。
+    """
+
+    def __init__(self, host, port, namespace, username, password, global_name="ChatSession",
+                 max_workers=4, flush_interval=0.0, cache_max_bytes=16 * 1024 * 1024, store_resources=True,
+                 codec=None, compress_threshold=4096):
+        self._connect_args = (host, port, namespace, username, password, global_name)
+        # 进程内会话读缓存，所有工作线程的连接共享；cache_max_bytes为0时不缓存
+        self.cache = SessionCache(cache_max_bytes) if cache_max_bytes else None
+        # 历史消息中的FHIR资源按 resourceType/id/versionId 去重压缩存储，消息中只保留引用
+        self.resources = FHIRResourceStore() if store_resources else None
+        # 消息JSON超过compress_threshold字节时压缩存储（codec为"zstd"/"zlib"，默认优先zstd），超长时分块
+        self.codec = StorageCodec(codec, threshold=compress_threshold)
+        self.max_workers = max_workers
+        self.flush_interval = flush_interval
+        self._init_process()
+
+    def _init_process(self):
+        """当前进程专用的状态：线程池、各线程的IRIS连接、会话写锁和写后缓冲区"""
+        self._pid = os.getpid()
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="iris-ctx")
+        self._local = threading.local()
+        self._managers = []
+        self._managers_lock = threading.Lock()
+        # 同一会话的写操作按提交顺序串行执行，读操作可以并发；
+        # 锁只被持有者和等待者引用，释放后没有等待者时自动从字典中移除
+        self._write_locks = weakref.WeakValueDictionary()
+        self._pending = {}
+        self._flush_timers = {}
+        self._flush_tasks = set()
+        self._maintenance_stop = None
+
+    def _check_process(self):
+        if self._pid != os.getpid():
+            # fork出的worker：父进程的连接和线程不能使用，缓冲的消息由父进程负责写出
+            if self.cache is not None:
+                self.cache.invalidate()
+            self._init_process()
+
+    def _manager(self):
+        """当前工作线程专用的同步上下文管理器（首次使用时建立连接）"""
+        manager = getattr(self._local, "manager", None)
+        if manager is None:
+            manager = IRISContextManager(*self._connect_args, cache=self.cache, resources=self.resources,
+                                         codec=self.codec)
+            self._local.manager = manager
+            with self._managers_lock:
+                self._managers.append(manager)
+        return manager
+
+    async def _run(self, method, *args, **kwargs):
+        self._check_process()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, lambda: getattr(self._manager(), method)(*args, **kwargs)
+        )
+
+    def _write_lock(self, session_id):
+        self._check_process()
+        lock = self._write_locks.get(session_id)
+        if lock is None:
+            lock = self._write_locks[session_id] = asyncio.Lock()
+        return lock
+
+    async def _write(self, session_id, method, *args, **kwargs):
+        async with self._write_lock(session_id):
+            return await self._run(method, session_id, *args, **kwargs)
+
+    def _discard_pending(self, session_id):
+        timer = self._flush_timers.pop(session_id, None)
+        if timer is not None:
+            timer.cancel()
+        return self._pending.pop(session_id, None)
+
+    def _schedule_flush(self, session_id):
+        if session_id in self._flush_timers:
+            return
+        loop = asyncio.get_running_loop()
+        self._flush_timers[session_id] = loop.call_later(self.flush_interval, self._start_timed_flush, session_id)
+
+    def _start_timed_flush(self, session_id):
+        self._flush_timers.pop(session_id, None)
+        task = asyncio.ensure_future(self.flush(session_id))
+        self._flush_tasks.add(task)
+        task.add_done_callback(self._timed_flush_done)
+
+    def _timed_flush_done(self, task):
+        self._flush_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            # 消息已放回缓冲区，下一次flush（读取前/轮次结束/关闭时）会重试
+            print(f"写后缓冲定时写入IRIS失败: {task.exception()}")
+
+    async def flush(self, session_id=None):
+        """
+        把缓冲的消息写入IRIS。不传session_id时写出所有会话。
+        在会话写锁内取出缓冲区，因此返回时该会话之前提交的写入都已落库。
+        :return: 本次写入的消息序号列表（写出所有会话时返回 {session_id: 序号列表}）
+        """
+        if session_id is None:
+            session_ids = list(self._pending)
+            results = await asyncio.gather(*[self.flush(sid) for sid in session_ids])
+            return dict(zip(session_ids, results))
+        async with self._write_lock(session_id):
+            messages = self._discard_pending(session_id)
+            if not messages:
+                return []
+            try:
+                return await self._run("append_history_batch", session_id, messages)
+            except BaseException:
+                # 写入失败时放回缓冲区头部，保持消息顺序
+                self._pending[session_id] = messages + self._pending.get(session_id, [])
+                raise
+
+    async def create_session(self, session_id, meta=None):
+        """新建一个对话会话（覆盖同名session）"""
+        async with self._write_lock(session_id):
+            # 新建会话会清空同名会话，尚未写出的旧消息直接丢弃
+            self._discard_pending(session_id)
+            return await self._run("create_session", session_id, meta)
+
+    async def get_session(self, session_id):
+        """获取整个会话JSON文档（不存在则返回None）"""
+        await self.flush(session_id)
+        return await self._run("get_session", session_id)
+
+    async def append_history(self, session_id, role, content):
+        """
+        向历史追加一条消息。
+        未启用写后缓冲时立即写入并返回序号；启用时放入缓冲区并返回None，序号由 flush() 返回。
+        """
+        if not self.flush_interval:
+            return await self._write(session_id, "append_history", role, content)
+        self._check_process()
+        self._pending.setdefault(session_id, []).append({
+            "role": role,
+            "content": content,
+            "ts": datetime.datetime.utcnow().isoformat() + "Z"
+        })
+        self._schedule_flush(session_id)
+        return None
+
+    async def get_history(self, session_id):
+        """获取指定session的全部对话历史列表"""
+        await self.flush(session_id)
+        return await self._run("get_history", session_id)
+
+    async def get_history_length(self, session_id):
+        await self.flush(session_id)
+        return await self._run("get_history_length", session_id)
+
+    async def get_history_tail(self, session_id, n):
+        await self.flush(session_id)
+        return await self._run("get_history_tail", session_id, n)
+
+    async def get_history_range(self, session_id, start, end=None):
+        await self.flush(session_id)
+        return await self._run("get_history_range", session_id, start, end)
+
+    async def search_history(self, session_id, query, k, before=None, after=0):
+        await self.flush(session_id)
+        return await self._run("search_history", session_id, query, k, before, after)
+
+    async def get_vars(self, session_id):
+        return await self._run("get_vars", session_id)
+
+    async def set_vars(self, session_id, values: dict):
+        return await self._write(session_id, "set_vars", values)
+
+    async def increment_counter(self, session_id, name, by=1):
+        return await self._write(session_id, "increment_counter", name, by)
+
+    async def update_meta(self, session_id, meta: dict):
+        """批量更新会话meta信息"""
+        return await self._write(session_id, "update_meta", meta)
+
+    async def get_summary(self, session_id):
+        """获取会话的对话摘要（没有时返回None）"""
+        return await self._run("get_summary", session_id)
+
+    async def set_summary(self, session_id, summary: dict):
+        return await self._write(session_id, "set_summary", summary)
+
+    async def delete_session(self, session_id):
+        """彻底删除整个会话（未写出的消息一并丢弃）"""
+        async with self._write_lock(session_id):
+            self._discard_pending(session_id)
+            return await self._run("delete_session", session_id)
+
+    async def pipeline(self, *calls):
+        """
+        并发执行多个互不依赖的调用，按传入顺序返回结果，如：
+            session, tail = await actx.pipeline(("get_session", sid), ("get_history_tail", sid, 10))
+        """
+        return await asyncio.gather(*[getattr(self, method)(*args) for method, *args in calls])
+
+    def cache_stats(self):
+        """会话读缓存的命中率与容量"""
+        return self.cache.stats() if self.cache is not None else {}
+
+    def resource_stats(self):
+        """FHIR资源存储的去重次数、写入字节数与压缩比"""
+        return self.resources.stats() if self.resources is not None else {}
+
+    def codec_stats(self):
+        """消息存储的压缩比、压缩/解压耗时"""
+        return self.codec.stats()
+
+    def start_maintenance(self, interval, **options):
+        """
+        在本进程启动后台会话维护线程（压缩、归档、清理，参数见 maintenance.SessionMaintenance），
+        与本实例共享会话缓存和资源存储；多个进程都启动时每轮只有一个实际执行
+        """
+        if self._maintenance_stop is None:
+            self._maintenance_stop = maintenance.start_background(
+                self._connect_args, interval, cache=self.cache, resources=self.resources, codec=self.codec,
+                **options)
+
+    async def aclose(self):
+        """写出所有缓冲的消息后关闭（应用退出时调用）"""
+        await self.flush()
+        self.close()
+
+    def close(self):
+        """关闭线程池和所有工作线程的IRIS连接（不会写出缓冲区，异步环境中应使用 aclose）"""
+        for session_id in list(self._flush_timers):
+            self._flush_timers.pop(session_id).cancel()
+        if self._maintenance_stop is not None:
+            self._maintenance_stop.set()
+        self._executor.shutdown(wait=True)
+        with self._managers_lock:
+            for manager in self._managers:
+                manager.connection.close()
+            self._managers.clear()
@@ -1,17 +1,21 @@
 import json
 import chainlit as cl
 
-async def can_answer_from_context(history, current_query, client, llm_model):
+CONTEXT_CHECK_SYSTEM = "你是一个上下文判断助手，只输出JSON格式"
+
+async def can_answer_from_context(history, current_query, client, llm_model, prompt_builder=None, session_id=None):
     """
     判断是否可以使用上下文回答当前问题
     返回: (can_answer, reasoning)
+    :param prompt_builder: 可选的PromptBuilder，按token预算截取对话历史（需同时传入session_id）
     """
     # 空历史直接返回False
     if not history:
         return False, "无历史上下文"
     
     # 构造判断提示
-    prompt = f"""
+    def build_prompt(history_json):
+        return f"""
 你是一个非常了解HL7 FHIR的医疗信息助手。
 请分析以下对话历史和当前问题，判断是否可以直接基于上下文回答问题。输出JSON格式：
 
@@ -40,11 +44,17 @@ async def can_answer_from_context(history, current_query, client, llm_model):
 如果上下文中还没有明确用FHIR的$everything操作获得患者的完整档案，就使用fhir query重新获取，绝不允许编造患者档案中的任何信息。
 
 ### 对话历史：
-{json.dumps(history, ensure_ascii=False, indent=2)}
+{history_json}
 
 ### 当前问题：
 "{current_query}"
 """
+    if prompt_builder is not None:
+        history_json = prompt_builder.history_json(session_id, history, "context_check",
+                                                   CONTEXT_CHECK_SYSTEM + build_prompt(""))
+    else:
+        history_json = json.dumps(history, ensure_ascii=False, indent=2)
+    prompt = build_prompt(history_json)
 
     async with cl.Step(name="上下文检测Agent", type="llm") as step:
         step.input = prompt
@@ -52,7 +62,7 @@ async def can_answer_from_context(history, current_query, client, llm_model):
         stream = await client.chat.completions.create(
             model=llm_model,
             messages=[
-                {"role": "system", "content": "你是一个上下文判断助手，只输出JSON格式"},
+                {"role": "system", "content": CONTEXT_CHECK_SYSTEM},
                 {"role": "user", "content": prompt}
             ],
             temperature=0.01,
@@ -72,9 +82,10 @@ async def can_answer_from_context(history, current_query, client, llm_model):
         
         return response_data.get("can_answer", False), response_data.get("reasoning", "")
 
-async def generate_context_answer(history, current_query, client, llm_model):
+async def generate_context_answer(history, current_query, client, llm_model, prompt_builder=None, session_id=None):
     """
     基于上下文生成回答
+    :param prompt_builder: 可选的PromptBuilder，按token预算截取对话历史（需同时传入session_id）
     """
     context_prompt = """
     你是一个智能助手，请严格基于对话历史回答问题。
@@ -83,6 +94,8 @@ async def generate_context_answer(history, current_query, client, llm_model):
     如果用户没有查看图表的需要，就不要追加"需要图表"字样。
     如果上下文中缺少数据，就回答上下文中数据不足，绝不允许编造数据。
     """
+    if prompt_builder is not None:
+        history = prompt_builder.history_messages(session_id, history, "context_answer", context_prompt + current_query)
     async with cl.Step(name="处理上下文Agent", type="llm") as step:
         try:
             message = cl.Message(content="")
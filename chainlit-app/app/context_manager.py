@@ -1,65 +1,600 @@
 import json
 import iris as irisnative
 import datetime
+from typing import NamedTuple
+from session_cache import CachedSession
+from history_index import HistoryIndex
+from resource_store import iter_refs
+
+# 会话在global中的存储结构（每条消息一个下标，追加为O(1)）：
+#   ^ChatSession(sid,"hdr")   = 会话头JSON {session_id, created_at, meta, summary}，
+#                               summary为后台维护的较早对话摘要（见 summarizer.py），可能不存在
+#   ^ChatSession(sid,"ts")    = last_updated
+#   ^ChatSession(sid,"h")     = 消息序号计数器（$INCREMENT）
+#   ^ChatSession(sid,"h",n)   = 第n条消息JSON {role, content, ts}
+#   ^ChatSession(sid,"v")     = 会话版本号，每次写入递增，供进程内缓存判断是否过期
+#   ^ChatSession(sid,"c")     = 维护任务已压缩到的消息序号
+#   ^ChatSession(sid,"r")     = 资源回收已登记引用的消息序号（不超过"c"，已压缩的消息不会再改写）
+#   ^ChatSession(sid,"r",ref) = ""，这些消息引用的资源存储内容
+#   ^ChatSession(sid,"s",name)       = 会话计数器（$INCREMENT，如已处理的轮次数）
+#   ^ChatSession(sid,"s","var",name) = 执行计划的临时变量JSON（多个worker间共享，不进入会话缓存）
+#   ^ChatSession              = 版本纪元计数器：新建/迁移会话时版本号从 纪元<<32 开始，
+#                               删除后重建的同名会话不会与旧版本号重复
+# last_updated 二级索引（按日期分桶，同一天内多次写入只有一个索引项；换日后旧索引项在维护扫描时清除）：
+#   ^ChatSessionIdx(yyyy-mm-dd, sid) = ""
+# 锁 ^ChatSession(sid,"maint") 使迁移/压缩/清理等维护操作互斥（不存数据），
+# 锁 ^ChatSession(sid,"hdr") 保护会话头的读改写；两者互不阻塞。
+# 启用FHIRResourceStore时，消息中的FHIR资源JSON以引用形式存储，消息JSON带 "fhir": 引用段数。
+# 配置StorageCodec时，超过阈值的消息JSON压缩后分块存放在 ^ChatSession(sid,"h",n,i) 下，结点上只存描述符。
+# 旧版本将整个会话文档JSON存放在 ^ChatSession(sid) 结点上，读写时自动迁移。
+HEADER = "hdr"
+UPDATED = "ts"
+HISTORY = "h"
+VERSION = "v"
+COMPACTED = "c"
+STATE = "s"
+VARS = "var"
+REFS = "r"
+MAINT = "maint"
+
+class MessageRecord(NamedTuple):
+    """一条历史消息的轻量记录（seq为消息在会话中的序号，从1开始）"""
+    seq: int
+    role: str
+    content: str
+    ts: str
+
+    def to_message(self):
+        """转换为get_history返回的字典格式"""
+        return {"role": self.role, "content": self.content, "ts": self.ts}
+
+def _to_record(seq, message):
+    return MessageRecord(int(seq), message.get("role"), message.get("content"), message.get("ts"))
 
 class IRISContextManager:
-    def __init__(self, host, port, namespace, username, password, global_name="ChatSession"):
+    def __init__(self, host, port, namespace, username, password, global_name="ChatSession", cache=None,
+                 resources=None, codec=None):
+        """
+        :param cache: 可选的 SessionCache，版本号未变化时读操作直接使用本地副本
+        :param resources: 可选的 FHIRResourceStore，消息中的FHIR资源只存引用，读取时还原
+        :param codec: 可选的 StorageCodec，较大的消息压缩存储，超过IRIS字符串长度上限时分块
+        """
         self.global_name = global_name
+        self.index_name = global_name + "Idx"
+        self.cache = cache
+        self.resources = resources
+        self.codec = codec
         self.connection = irisnative.createConnection(host, port, namespace, username, password)
         self.iris = irisnative.createIRIS(self.connection)
 
     def _now(self):
         return datetime.datetime.utcnow().isoformat() + "Z"
 
+    def _session_state(self, session_id):
+        """
+        返回会话的存储格式：None-不存在，"legacy"-旧的整文档格式，"layout"-按消息分下标的格式
+        """
+        defined = self.iris.isDefined(self.global_name, session_id)
+        if defined in (1, 11):
+            return "legacy"
+        if defined == 10:
+            return "layout"
+        return None
+
+    def _ensure_layout(self, session_id):
+        """确认会话存在，必要时先迁移旧格式；会话不存在时抛出ValueError"""
+        state = self._session_state(session_id)
+        if state == "legacy":
+            self.migrate_session(session_id)
+        elif state is None:
+            raise ValueError(f"Session {session_id} 不存在")
+
+    def _encode(self, message):
+        """
+        消息写入IRIS的JSON，启用资源存储时其中的FHIR资源换成引用
+        :return: (JSON字符串, 在会话缓存中占用的字节数)
+        """
+        content = message.get("content")
+        if self.resources is not None and isinstance(content, str):
+            stored, count = self.resources.dehydrate(self.iris, content)
+            if count:
+                message_str = json.dumps({**message, "content": stored, "fhir": count})
+                return message_str, len(message_str) + len(content)
+        message_str = json.dumps(message)
+        return message_str, len(message_str)
+
+    def _store_message(self, message_str, session_id, seq, overwrite=False):
+        if self.codec is None:
+            self.iris.set(message_str, self.global_name, session_id, HISTORY, seq)
+        else:
+            self.codec.write(self.iris, message_str, self.global_name, session_id, HISTORY, seq, overwrite=overwrite)
+
+    def _load_message(self, value, session_id, seq):
+        """由迭代器读到的结点值还原消息JSON字符串（压缩分块的消息逐块读取解压）"""
+        if self.codec is None:
+            return value
+        return self.codec.read(self.iris, value, self.global_name, session_id, HISTORY, seq)
+
+    def _decode(self, value, session_id, seq):
+        message = json.loads(self._load_message(value, session_id, seq))
+        if message.pop("fhir", None) and self.resources is not None:
+            message["content"] = self.resources.hydrate(self.iris, message["content"])
+        return message
+
+    def _touch(self, session_id, now):
+        """更新last_updated并登记到按日期分桶的索引"""
+        self.iris.set(now, self.global_name, session_id, UPDATED)
+        self.iris.set("", self.index_name, now[:10], session_id)
+
+    def _init_version(self, session_id):
+        version = int(self.iris.increment(1, self.global_name)) << 32
+        self.iris.set(version, self.global_name, session_id, VERSION)
+        return version
+
+    def _bump_version(self, session_id):
+        return int(self.iris.increment(1, self.global_name, session_id, VERSION))
+
+    def _cached(self, session_id):
+        """
+        读取会话版本号（一次IRIS调用），与缓存一致时返回缓存的会话，否则重新加载并放入缓存。
+        未启用缓存、会话不存在或是没有版本号的旧格式会话时返回None，由调用方走原来的读取路径。
+        """
+        if self.cache is None:
+            return None
+        version = self.iris.get(self.global_name, session_id, VERSION)
+        if version is None:
+            return None
+        version = int(version)
+        entry = self.cache.get(session_id, version)
+        if entry is not None:
+            return entry
+        # 先取版本号再读内容：期间若有其它写入，缓存条目只会比版本号新，下次读取时重新加载
+        header_str = self.iris.get(self.global_name, session_id, HEADER)
+        if not header_str:
+            return None
+        items, size = [], len(header_str)
+        for seq, value in self.iris.iterator(self.global_name, session_id, HISTORY).items():
+            message = self._decode(value, session_id, seq)
+            items.append((int(seq), message))
+            size += len(message.get("content") or "") + 64
+        last_updated = self.iris.get(self.global_name, session_id, UPDATED)
+        header = json.loads(header_str)
+        self.cache.put(session_id, version, header, last_updated, items, size)
+        return CachedSession(version, header, last_updated, items, size)
+
     def create_session(self, session_id, meta=None):
         """新建一个对话会话（覆盖同名session）"""
-        doc = {
+        now = self._now()
+        header = {
             "session_id": session_id,
-            "history": [],
-            "created_at": self._now(),
-            "last_updated": self._now(),
+            "created_at": now,
             "meta": meta or {}
         }
-        self.iris.set(json.dumps(doc), self.global_name, session_id)
-        return doc
+        header_str = json.dumps(header)
+        self.iris.kill(self.global_name, session_id)
+        self.iris.set(header_str, self.global_name, session_id, HEADER)
+        self._touch(session_id, now)
+        version = self._init_version(session_id)
+        if self.cache is not None:
+            self.cache.put(session_id, version, header, now, [], len(header_str))
+        return {**header, "history": [], "last_updated": now}
 
     def get_session(self, session_id):
         """获取整个会话JSON文档（不存在则返回None）"""
-        doc_str = self.iris.get(self.global_name, session_id)
-        if doc_str:
-            return json.loads(doc_str)
-        return None
+        entry = self._cached(session_id)
+        if entry is not None:
+            return entry.to_doc()
+        if not self._prepare_read(session_id):
+            return None
+        header_str = self.iris.get(self.global_name, session_id, HEADER)
+        if not header_str:
+            return None
+        doc = json.loads(header_str)
+        doc["history"] = self._read_history(session_id)
+        doc["last_updated"] = self.iris.get(self.global_name, session_id, UPDATED)
+        return doc
+
+    def export_session(self, session_id):
+        """
+        直接从global读取整个会话JSON文档，不经过也不放入会话缓存，旧格式会话不迁移（供维护任务归档）
+        """
+        state = self._session_state(session_id)
+        if state == "legacy":
+            return json.loads(self.iris.get(self.global_name, session_id))
+        if state is None:
+            return None
+        header_str = self.iris.get(self.global_name, session_id, HEADER)
+        if not header_str:
+            return None
+        doc = json.loads(header_str)
+        doc["history"] = self._read_history(session_id)
+        doc["last_updated"] = self.iris.get(self.global_name, session_id, UPDATED)
+        return doc
+
+    def _read_history(self, session_id):
+        return [self._decode(value, session_id, seq) for seq, value in
+                self.iris.iterator(self.global_name, session_id, HISTORY).items()]
 
     def append_history(self, session_id, role, content):
-        """向历史追加一条消息"""
-        doc = self.get_session(session_id)
-        if not doc:
-            raise ValueError(f"Session {session_id} 不存在")
-        doc["history"].append({
+        """向历史追加一条消息（$INCREMENT分配序号，并发写入安全）"""
+        self._ensure_layout(session_id)
+        now = self._now()
+        message = {
             "role": role,
             "content": content,
-            "ts": self._now()
-        })
-        doc["last_updated"] = self._now()
-        self.iris.set(json.dumps(doc), self.global_name, session_id)
+            "ts": now
+        }
+        message_str, size = self._encode(message)
+        seq = int(self.iris.increment(1, self.global_name, session_id, HISTORY))
+        self._store_message(message_str, session_id, seq)
+        self._touch(session_id, now)
+        version = self._bump_version(session_id)
+        if self.cache is not None:
+            self.cache.apply_append(session_id, version, [(seq, message)], size, now)
+        return seq
+
+    def append_history_batch(self, session_id, messages):
+        """
+        批量追加消息（messages为 {role, content, ts} 字典列表）。
+        一次$INCREMENT预留整段序号，再在一个事务中写入，返回分配的序号列表。
+        """
+        if not messages:
+            return []
+        self._ensure_layout(session_id)
+        last = int(self.iris.increment(len(messages), self.global_name, session_id, HISTORY))
+        first = last - len(messages) + 1
+        now = messages[-1].get("ts") or self._now()
+        # 先在事务外完成编码（包括写入FHIR资源，资源按内容寻址，重复写入无副作用）
+        encoded = [self._encode(message) for message in messages]
+        size = sum(message_size for _, message_size in encoded)
+        self.iris.tStart()
+        try:
+            for seq, (message_str, _) in enumerate(encoded, start=first):
+                self._store_message(message_str, session_id, seq)
+            self._touch(session_id, now)
+            version = self._bump_version(session_id)
+            self.iris.tCommit()
+        except Exception:
+            self.iris.tRollback()
+            raise
+        if self.cache is not None:
+            self.cache.apply_append(session_id, version, list(enumerate(messages, start=first)), size, now)
+        return list(range(first, last + 1))
 
     def get_history(self, session_id):
         """获取指定session的全部对话历史列表"""
-        doc = self.get_session(session_id)
-        return doc["history"] if doc else []
+        entry = self._cached(session_id)
+        if entry is not None:
+            return [m for _, m in entry.items]
+        if not self._prepare_read(session_id):
+            return []
+        return self._read_history(session_id)
+
+    def _prepare_read(self, session_id):
+        """读取前检查会话，旧格式先迁移；会话不存在返回False"""
+        state = self._session_state(session_id)
+        if state == "legacy":
+            self.migrate_session(session_id)
+        return state is not None
+
+    def get_history_length(self, session_id):
+        """会话中的消息条数（读取序号计数器，O(1)）"""
+        entry = self._cached(session_id)
+        if entry is not None:
+            return entry.items[-1][0] if entry.items else 0
+        if not self._prepare_read(session_id):
+            return 0
+        return int(self.iris.get(self.global_name, session_id, HISTORY) or 0)
+
+    def get_history_tail(self, session_id, n):
+        """获取最近n条消息（按时间顺序），从最后一个下标反向$ORDER，不读取更早的消息"""
+        entry = self._cached(session_id)
+        if entry is not None:
+            return [_to_record(seq, m) for seq, m in entry.items[-n:]] if n > 0 else []
+        records = []
+        for record in self.iter_history_reversed(session_id):
+            if len(records) >= n:
+                break
+            records.append(record)
+        records.reverse()
+        return records
+
+    def get_history_range(self, session_id, start, end=None):
+        """获取序号在 [start, end) 区间的消息，end为None时读到最后"""
+        entry = self._cached(session_id)
+        if entry is not None:
+            return [_to_record(seq, m) for seq, m in entry.items
+                    if seq >= start and (end is None or seq < end)]
+        if not self._prepare_read(session_id):
+            return []
+        records = []
+        iterator = self.iris.iterator(self.global_name, session_id, HISTORY).startFrom(start - 1)
+        for seq, value in iterator.items():
+            if seq < start:
+                continue
+            if end is not None and seq >= end:
+                break
+            records.append(_to_record(seq, self._decode(value, session_id, seq)))
+        return records
+
+    def search_history(self, session_id, query, k, before=None, after=0):
+        """
+        BM25检索与query最相关的k条消息（只在 after < seq < before 中查找），按序号返回 MessageRecord 列表。
+        启用会话缓存时使用缓存中随追加增量维护的索引，否则临时建立索引。
+        """
+        entry = self._cached(session_id)
+        if entry is not None:
+            found = self.cache.search(session_id, entry.version, query, k, before, after)
+            items = entry.items
+        else:
+            found = None
+            if not self._prepare_read(session_id):
+                return []
+            items = [(int(seq), self._decode(value, session_id, seq)) for seq, value in
+                     self.iris.iterator(self.global_name, session_id, HISTORY).items()]
+        if found is None:
+            index = HistoryIndex()
+            for seq, message in items:
+                index.add(seq, message.get("content"))
+            messages = dict(items)
+            found = [(seq, messages[seq]) for seq in index.search(query, k, before, after)]
+        return [_to_record(seq, message) for seq, message in found]
+
+    def iter_history_reversed(self, session_id, before=None):
+        """从最新消息开始反向逐条迭代（可指定只返回序号小于before的消息），按需读取"""
+        if not self._prepare_read(session_id):
+            return
+        iterator = self.iris.iterator(self.global_name, session_id, HISTORY).reversed()
+        if before is not None:
+            iterator = iterator.startFrom(before)
+        for seq, value in iterator.items():
+            if before is not None and seq >= before:
+                continue
+            yield _to_record(seq, self._decode(value, session_id, seq))
+
+    def _update_header(self, session_id, update, lock_timeout=5):
+        """
+        在会话头锁内读取、修改并写回会话头（多个进程同时更新meta和摘要时不会丢失修改），递增版本号并同步缓存
+        :param update: 修改header字典的函数，返回False时不写入
+        :return: 是否写入
+        """
+        self._ensure_layout(session_id)
+        if not self.iris.lock("", lock_timeout, self.global_name, session_id, HEADER):
+            raise TimeoutError(f"Session {session_id} 的会话头正在被其它进程更新")
+        try:
+            header = json.loads(self.iris.get(self.global_name, session_id, HEADER))
+            if update(header) is False:
+                return False
+            now = self._now()
+            self.iris.set(json.dumps(header), self.global_name, session_id, HEADER)
+            self._touch(session_id, now)
+            version = self._bump_version(session_id)
+        finally:
+            self.iris.unlock("", self.global_name, session_id, HEADER)
+        if self.cache is not None:
+            self.cache.apply_meta(session_id, version, header, now)
+        return True
 
     def update_meta(self, session_id, meta: dict):
         """批量更新会话meta信息"""
-        doc = self.get_session(session_id)
-        if not doc:
-            raise ValueError(f"Session {session_id} 不存在")
-        doc["meta"].update(meta)
-        doc["last_updated"] = self._now()
-        self.iris.set(json.dumps(doc), self.global_name, session_id)
+        self._update_header(session_id, lambda header: header["meta"].update(meta))
+
+    def get_summary(self, session_id):
+        """获取会话的对话摘要（没有时返回None）"""
+        entry = self._cached(session_id)
+        if entry is not None:
+            return entry.header.get("summary")
+        if not self._prepare_read(session_id):
+            return None
+        header_str = self.iris.get(self.global_name, session_id, HEADER)
+        return json.loads(header_str).get("summary") if header_str else None
+
+    def set_summary(self, session_id, summary: dict):
+        """
+        保存对话摘要。摘要覆盖到的消息序号（summary["upto"]）不大于已保存的摘要时不写入，
+        多个进程同时生成同一会话的摘要时只保留覆盖范围最大的
+        :return: 是否写入
+        """
+        def update(header):
+            current = header.get("summary") or {}
+            if current.get("upto", 0) >= summary.get("upto", 0):
+                return False
+            header["summary"] = summary
+        return self._update_header(session_id, update)
+
+    def get_vars(self, session_id):
+        """读取会话中执行计划保存的临时变量 {变量名: 值}"""
+        result = {}
+        for name, value in self.iris.iterator(self.global_name, session_id, STATE, VARS).items():
+            if self.codec is not None:
+                value = self.codec.read(self.iris, value, self.global_name, session_id, STATE, VARS, name)
+            result[name] = json.loads(value)
+        return result
+
+    def set_vars(self, session_id, values: dict):
+        """保存临时变量（同名覆盖），较大的值按StorageCodec压缩、分块"""
+        for name, value in values.items():
+            value_str = json.dumps(value)
+            if self.codec is None:
+                self.iris.set(value_str, self.global_name, session_id, STATE, VARS, name)
+            else:
+                self.codec.write(self.iris, value_str, self.global_name, session_id, STATE, VARS, name, overwrite=True)
+
+    def increment_counter(self, session_id, name, by=1):
+        """原子递增会话计数器，返回递增后的值"""
+        return int(self.iris.increment(by, self.global_name, session_id, STATE, name))
 
     def delete_session(self, session_id):
         """彻底删除整个会话"""
         self.iris.kill(self.global_name, session_id)
+        if self.cache is not None:
+            self.cache.invalidate(session_id)
+
+    def iter_sessions_updated_before(self, updated_before):
+        """
+        按last_updated索引从最旧的日期开始，迭代最后更新时间早于updated_before的 (session_id, last_updated)。
+        索引项与会话当前的last_updated不在同一天（会话之后又有写入或已被删除）时顺带清除。
+        """
+        for day in list(self.iris.iterator(self.index_name).subscripts()):
+            if day > updated_before[:10]:
+                break
+            for session_id in list(self.iris.iterator(self.index_name, day).subscripts()):
+                last_updated = self.iris.get(self.global_name, session_id, UPDATED)
+                if last_updated is None or last_updated[:10] != day:
+                    self.iris.kill(self.index_name, day, session_id)
+                    continue
+                if last_updated < updated_before:
+                    yield session_id, last_updated
+
+    def rebuild_index(self):
+        """为索引建立之前就存在的会话补建last_updated索引项，返回登记的会话数"""
+        count = 0
+        for session_id in list(self.iris.iterator(self.global_name).subscripts()):
+            last_updated = self.iris.get(self.global_name, session_id, UPDATED)
+            if last_updated:
+                self.iris.set("", self.index_name, last_updated[:10], session_id)
+                count += 1
+        return count
+
+    def compact_session(self, session_id, min_payload=1024, lock_timeout=0):
+        """
+        压缩旧会话：把历史消息中的FHIR资源和不小于min_payload的其它工具返回JSON换成资源存储中的压缩引用。
+        只处理上次压缩之后的消息，逐条改写；维护锁只与迁移/清理互斥，正常的追加写入和会话头更新不受影响。
+        :return: 改写的消息数；会话正被其它维护操作加锁时返回None
+        """
+        if self.resources is None:
+            return 0
+        if not self.iris.lock("", lock_timeout, self.global_name, session_id, MAINT):
+            return None
+        try:
+            if self._session_state(session_id) != "layout":
+                return 0
+            done = int(self.iris.get(self.global_name, session_id, COMPACTED) or 0)
+            last = int(self.iris.get(self.global_name, session_id, HISTORY) or 0)
+            rewritten = 0
+            for seq, value in self.iris.iterator(self.global_name, session_id, HISTORY).startFrom(done).items():
+                if seq <= done:
+                    continue
+                if seq > last:
+                    break
+                message = json.loads(self._load_message(value, session_id, seq))
+                content = message.get("content")
+                if not isinstance(content, str):
+                    continue
+                compacted, count = self.resources.dehydrate(self.iris, content, collapse_min=min_payload)
+                if not count or compacted == content:
+                    continue
+                message["content"] = compacted
+                message["fhir"] = count
+                self._store_message(json.dumps(message), session_id, seq, overwrite=True)
+                rewritten += 1
+            self.iris.set(last, self.global_name, session_id, COMPACTED)
+            if rewritten:
+                # 还原后的内容不变，但存储形式变了，递增版本号让各进程的缓存重新加载
+                self._bump_version(session_id)
+                if self.cache is not None:
+                    self.cache.invalidate(session_id)
+            return rewritten
+        finally:
+            self.iris.unlock("", self.global_name, session_id, MAINT)
+
+    def iter_resource_refs(self):
+        """
+        逐个会话迭代 (session_id, 消息中引用的资源存储内容的集合)，供维护任务回收资源的标记阶段使用。
+        已压缩的消息不会再改写，其中的引用登记在会话的"r"结点下，每次只需解码上次登记之后的消息；
+        直接读取存储的消息，不还原资源，也不经过会话缓存
+        """
+        for session_id in list(self.iris.iterator(self.global_name).subscripts()):
+            # 拿不到维护锁（会话正在迁移）时只读取不登记，避免向正被删除重建的会话写入
+            locked = self.iris.lock("", 0, self.global_name, session_id, MAINT)
+            try:
+                if self._session_state(session_id) != "layout":
+                    continue
+                marked = int(self.iris.get(self.global_name, session_id, REFS) or 0)
+                done = int(self.iris.get(self.global_name, session_id, COMPACTED) or 0)
+                refs = set(self.iris.iterator(self.global_name, session_id, REFS).subscripts())
+                for seq, value in self.iris.iterator(self.global_name, session_id, HISTORY).startFrom(marked).items():
+                    if seq <= marked:
+                        continue
+                    message_str = self._load_message(value, session_id, seq)
+                    if '"fhir"' not in message_str:
+                        continue
+                    found = iter_refs(json.loads(message_str).get("content"))
+                    refs.update(found)
+                    if locked and seq <= done:
+                        for ref in found:
+                            self.iris.set("", self.global_name, session_id, REFS, ref)
+                if locked and done > marked:
+                    self.iris.set(done, self.global_name, session_id, REFS)
+            finally:
+                if locked:
+                    self.iris.unlock("", self.global_name, session_id, MAINT)
+            yield session_id, refs
+
+    def purge_session(self, session_id, updated_before, lock_timeout=0):
+        """
+        删除最后更新时间早于updated_before的会话。加锁后再次确认last_updated，期间有新写入的会话保留。
+        会话引用的资源存储内容由维护任务的 collect_garbage 统一回收。
+        :return: 是否删除
+        """
+        if not self.iris.lock("", lock_timeout, self.global_name, session_id, MAINT):
+            return False
+        try:
+            last_updated = self.iris.get(self.global_name, session_id, UPDATED)
+            if last_updated is None or last_updated >= updated_before:
+                return False
+            self.iris.kill(self.global_name, session_id)
+            self.iris.kill(self.index_name, last_updated[:10], session_id)
+            if self.cache is not None:
+                self.cache.invalidate(session_id)
+            return True
+        finally:
+            self.iris.unlock("", self.global_name, session_id, MAINT)
+
+    def migrate_session(self, session_id, lock_timeout=5):
+        """
+        将旧的整文档格式迁移为按消息分下标的格式。
+        加锁后重新检查，多个进程同时迁移同一会话时只有一个会执行。
+        :return: 是否执行了迁移
+        """
+        if not self.iris.lock("", lock_timeout, self.global_name, session_id, MAINT):
+            raise TimeoutError(f"Session {session_id} 迁移加锁超时")
+        try:
+            doc_str = self.iris.get(self.global_name, session_id)
+            if not doc_str:
+                return False
+            doc = json.loads(doc_str)
+            history = doc.get("history", [])
+            header = {
+                "session_id": doc.get("session_id", session_id),
+                "created_at": doc.get("created_at", self._now()),
+                "meta": doc.get("meta", {})
+            }
+            self.iris.tStart()
+            try:
+                self.iris.kill(self.global_name, session_id)
+                self.iris.set(json.dumps(header), self.global_name, session_id, HEADER)
+                self._touch(session_id, doc.get("last_updated") or self._now())
+                for seq, message in enumerate(history, start=1):
+                    # 迁移时同样把消息中的FHIR资源换成引用
+                    self._store_message(self._encode(message)[0], session_id, seq)
+                self.iris.set(len(history), self.global_name, session_id, HISTORY)
+                self._init_version(session_id)
+                self.iris.tCommit()
+            except Exception:
+                self.iris.tRollback()
+                raise
+            return True
+        finally:
+            self.iris.unlock("", self.global_name, session_id, MAINT)
+
+    def migrate_all(self):
+        """迁移global中所有旧格式的会话，返回迁移的会话数"""
+        migrated = 0
+        for session_id in list(self.iris.iterator(self.global_name).subscripts()):
+            if self._session_state(session_id) == "legacy" and self.migrate_session(session_id):
+                migrated += 1
+        return migrated
 
 # ======== 用法举例 ==========
 if __name__ == "__main__":
@@ -70,10 +605,12 @@ if __name__ == "__main__":
         username="superuser",
         password="SYS"
     )
-    session = ctx.create_session("sid001", "u001", meta={"topic": "demo"})
+    session = ctx.create_session("sid001", meta={"topic": "demo"})
     ctx.append_history("sid001", "user", "你好！")
     ctx.append_history("sid001", "assistant", "您好，请问需要什么帮助？")
     print(ctx.get_history("sid001"))
     ctx.update_meta("sid001", {"foo": "bar"})
     print(ctx.get_session("sid001"))
     ctx.delete_session("sid001")
+    # 将旧的整文档格式会话迁移为新格式
+    print(f"迁移旧格式会话: {ctx.migrate_all()}")
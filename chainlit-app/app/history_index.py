@@ -0,0 +1,71 @@
+import math
+import re
+from collections import Counter
+
+ASCII_WORD = re.compile(r"[a-z0-9]+")
+CJK_RUN = re.compile(r"[一-鿿]+")
+# 每个词项的倒排记录在内存中的估算字节数
+POSTING_BYTES = 64
+
+
+def terms(text):
+    """检索用的词项：英文单词和数字（包括资源id），中文按字的二元组切分"""
+    text = (text or "").lower()
+    result = [w for w in ASCII_WORD.findall(text) if len(w) > 1 or w.isdigit()]
+    for run in CJK_RUN.findall(text):
+        if len(run) == 1:
+            result.append(run)
+        else:
+            result.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return result
+
+
+class HistoryIndex:
+    """
+    会话历史的BM25倒排索引，以消息序号为文档编号，随消息追加增量更新。
+    每条消息只索引开头 max_chars 个字符、保留出现次数最多的 max_terms 个词项（工具返回的大段JSON也只占固定的空间），
+    可以放进会话缓存。
+    """
+    __slots__ = ("postings", "lengths", "total_length", "max_terms", "max_chars", "size")
+
+    def __init__(self, max_terms=128, max_chars=16384):
+        self.postings = {}
+        self.lengths = {}
+        self.total_length = 0
+        self.max_terms = max_terms
+        self.max_chars = max_chars
+        self.size = 0
+
+    def add(self, seq, text):
+        """加入一条消息，返回索引增加的估算字节数"""
+        counts = Counter(terms((text or "")[:self.max_chars])).most_common(self.max_terms)
+        length = sum(tf for _, tf in counts)
+        for term, tf in counts:
+            self.postings.setdefault(term, {})[seq] = tf
+        self.lengths[seq] = length
+        self.total_length += length
+        added = len(counts) * POSTING_BYTES
+        self.size += added
+        return added
+
+    def search(self, query, k, before=None, after=0, k1=1.2, b=0.75):
+        """
+        返回与query最相关的k条消息的序号（按序号排列），只在 after < seq < before 的消息中查找
+        """
+        if not self.lengths or k <= 0:
+            return []
+        n = len(self.lengths)
+        avg_length = self.total_length / n or 1
+        scores = {}
+        for term in set(terms(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+            for seq, tf in postings.items():
+                if seq <= after or (before is not None and seq >= before):
+                    continue
+                norm = tf + k1 * (1 - b + b * self.lengths[seq] / avg_length)
+                scores[seq] = scores.get(seq, 0.0) + idf * tf * (k1 + 1) / norm
+        best = sorted(scores, key=scores.get, reverse=True)[:k]
+        return sorted(best)
@@ -0,0 +1,66 @@
+from summarizer import ConversationSummarizer
+
+
+class HistorySelector:
+    """
+    为上下文检测、上下文回答和计划生成Agent选择对话历史：
+    开头固定的消息（医生身份等）+ 会话摘要（启用时）+ 与当前问题最相关的 top_k 条较早消息（BM25检索）+ 最近 recent_messages 条消息。
+    检索索引保存在会话缓存中，随 append_history 增量更新（见 HistoryIndex）。
+    """
+
+    def __init__(self, ctx, top_k=4, recent_messages=6, pinned_messages=1, use_summary=True):
+        """
+        :param ctx: AsyncIRISContextManager
+        :param top_k: 检索的较早消息条数，为0时不检索、只使用最近的消息
+        :param recent_messages: 始终保留的最近消息条数
+        :param pinned_messages: 会话开头始终保留的消息条数
+        :param use_summary: 是否加入会话摘要（ConversationSummarizer维护）
+        """
+        self.ctx = ctx
+        self.top_k = top_k
+        self.recent_messages = recent_messages
+        self.pinned_messages = pinned_messages
+        self.use_summary = use_summary
+        self.metrics = {
+            "selections": 0,
+            "full": 0,
+            "retrieved": 0,
+            "messages_in": 0,
+            "messages_out": 0,
+        }
+
+    async def select(self, session_id, history, question):
+        """
+        :param history: 会话的全部历史消息
+        :return: 按时间顺序排列的消息列表（摘要作为一条system消息放在较早消息之前）
+        """
+        self.metrics["selections"] += 1
+        self.metrics["messages_in"] += len(history)
+        summary = await self.ctx.get_summary(session_id) if self.use_summary else None
+        if not summary and len(history) <= self.pinned_messages + self.top_k + self.recent_messages:
+            self.metrics["full"] += 1
+            self.metrics["messages_out"] += len(history)
+            return history
+        pinned, recent = await self.ctx.pipeline(
+            ("get_history_range", session_id, 1, self.pinned_messages + 1),
+            ("get_history_tail", session_id, self.recent_messages),
+        )
+        before = recent[0].seq if recent else None
+        related = []
+        if self.top_k > 0:
+            related = await self.ctx.search_history(session_id, question, self.top_k, before=before,
+                                                    after=self.pinned_messages)
+        self.metrics["retrieved"] += len(related)
+        selected = [record.to_message() for record in pinned]
+        if summary:
+            selected.append({"role": "system", "content": ConversationSummarizer.render(summary)})
+        selected += [record.to_message() for record in related if record.seq not in {r.seq for r in pinned}]
+        selected += [record.to_message() for record in recent if record.seq > self.pinned_messages]
+        self.metrics["messages_out"] += len(selected)
+        return selected
+
+    def stats(self):
+        return {
+            **self.metrics,
+            "kept_rate": self.metrics["messages_out"] / self.metrics["messages_in"] if self.metrics["messages_in"] else 0.0,
+        }
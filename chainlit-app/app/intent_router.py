@@ -0,0 +1,90 @@
+import re
+import time
+
+# 问题分类的关键词规则（与上下文检测Agent提示词中的规则一致）
+DRUG_RISK = re.compile(r"风险|报销|医保|拒付|适应症|能不能用|可以用吗|能用吗")
+COST = re.compile(r"费用|花费|花了多少|收费|账单|金额|多少钱")
+REFRESH = re.compile(r"重新|最新|刷新|再查|再次查询")
+# 问题中指定的资源id，如 "患者794"、"id为794"、"资源id是794"
+RESOURCE_ID = re.compile(r"(?:患者|病人|id|ID|编号)\s*(?:为|是|:|：)?\s*([0-9][0-9A-Za-z\-]*)")
+
+
+class IntentRouter:
+    """
+    上下文检测前的规则路由：按提示词中固定的规则在本地直接判定明显不能基于上下文回答的问题
+    （没有对话、用药风险/报销、费用未查询、新患者、要求重新查询、没有FHIR数据），
+    其它问题返回None，仍交给LLM判断。只做"不能回答"的判定，误判的代价只是多执行一次计划。
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.rules = [
+            ("no_user_turn", self._no_user_turn, "无历史上下文"),
+            ("drug_risk", self._drug_risk, "用药风险与报销问题需要重新查询患者完整档案和医保规则"),
+            ("cost_not_queried", self._cost_not_queried, "费用问题需要从SQL表查询，上下文中还没有费用查询结果"),
+            ("new_patient", self._new_patient, "问题中的患者不在上下文中"),
+            ("refresh", self._refresh, "要求重新查询最新数据"),
+            ("no_fhir_data", self._no_fhir_data, "上下文中没有FHIR资源数据"),
+        ]
+        self.metrics = {
+            "local": 0,
+            "fallback": 0,
+            "seconds": 0.0,
+            "rules": {name: 0 for name, _, _ in self.rules},
+        }
+
+    @staticmethod
+    def _no_user_turn(history, query):
+        return not any(m.get("role") == "user" for m in history)
+
+    @staticmethod
+    def _drug_risk(history, query):
+        return DRUG_RISK.search(query) is not None
+
+    @staticmethod
+    def _cost_not_queried(history, query):
+        if COST.search(query) is None:
+            return False
+        return not any(m.get("role") == "assistant" and COST.search(m.get("content") or "") for m in history)
+
+    @staticmethod
+    def _new_patient(history, query):
+        ids = RESOURCE_ID.findall(query)
+        return bool(ids) and any(not any(i in (m.get("content") or "") for m in history) for i in ids)
+
+    @staticmethod
+    def _refresh(history, query):
+        return REFRESH.search(query) is not None
+
+    @staticmethod
+    def _no_fhir_data(history, query):
+        # 费用问题依赖SQL数据而不是FHIR资源，由LLM判断
+        if COST.search(query):
+            return False
+        return not any("resourceType" in (m.get("content") or "") for m in history)
+
+    def route(self, history, query):
+        """
+        :return: 本地判定结果 (can_answer, reasoning)，需要LLM判断时返回None
+        """
+        if not self.enabled:
+            return None
+        start = time.perf_counter()
+        history = history or []
+        decision = None
+        for name, matches, reasoning in self.rules:
+            if matches(history, query or ""):
+                self.metrics["rules"][name] += 1
+                decision = (False, f"规则判定：{reasoning}")
+                break
+        self.metrics["local" if decision else "fallback"] += 1
+        self.metrics["seconds"] += time.perf_counter() - start
+        return decision
+
+    def stats(self):
+        total = self.metrics["local"] + self.metrics["fallback"]
+        return {
+            **self.metrics,
+            "local_rate": self.metrics["local"] / total if total else 0.0,
+            "avg_us": self.metrics["seconds"] / total * 1e6 if total else 0.0,
+        }
@@ -0,0 +1,178 @@
+import asyncio
+import copy
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from types import SimpleNamespace
+
+# 请求中不影响模型输出的参数，不参与缓存键
+IGNORED_PARAMS = ("stream_options", "timeout", "extra_headers")
+
+
+def request_key(params, namespace=""):
+    """
+    服务标识 + 模型 + 消息 + 影响输出的参数（温度、response_format、max_tokens、是否流式等）的哈希
+    :param namespace: 调用的服务（服务商和接口地址），同名模型在不同服务上的输出不共用缓存
+    """
+    data = json.dumps([namespace, {k: v for k, v in params.items() if k not in IGNORED_PARAMS}],
+                      ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.blake2b(data.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def _chunk_text(chunk):
+    choices = getattr(chunk, "choices", None) or []
+    return "".join(getattr(c.delta, "content", None) or "" for c in choices if getattr(c, "delta", None))
+
+
+class _Entry:
+    __slots__ = ("value", "expires", "size", "tokens")
+
+    def __init__(self, value, expires, size, tokens):
+        self.value = value
+        self.expires = expires
+        self.size = size
+        self.tokens = tokens
+
+
+class LLMResponseCache:
+    """
+    低温度LLM调用的响应缓存：temperature不高于 max_temperature 的请求按 request_key 缓存完整响应，
+    流式请求缓存收到的全部chunk，命中时逐个chunk重放（界面仍逐token显示）。
+    只缓存正常结束的调用（出错、被取消或调用方中途放弃的流不缓存）；按TTL过期，按条数和字节数LRU淘汰。
+    """
+
+    def __init__(self, max_entries=512, max_bytes=32 * 1024 * 1024, ttl=600, max_temperature=0.1):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_temperature = max_temperature
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.metrics = {
+            "hits": 0,
+            "misses": 0,
+            "bypassed": 0,
+            "stored": 0,
+            "expired": 0,
+            "evictions": 0,
+            "saved_prompt_tokens": 0,
+            "saved_completion_tokens": 0,
+        }
+
+    def cacheable(self, params):
+        temperature = params.get("temperature")
+        return temperature is not None and temperature <= self.max_temperature and not params.get("n", 1) > 1
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires <= time.monotonic():
+                self._remove(key)
+                self.metrics["expired"] += 1
+                entry = None
+            if entry is None:
+                self.metrics["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.metrics["hits"] += 1
+            prompt_tokens, completion_tokens = entry.tokens
+            self.metrics["saved_prompt_tokens"] += prompt_tokens
+            self.metrics["saved_completion_tokens"] += completion_tokens
+            return entry.value
+
+    def put(self, key, value, size, usage=None):
+        tokens = (getattr(usage, "prompt_tokens", 0) or 0, getattr(usage, "completion_tokens", 0) or 0)
+        with self._lock:
+            if size > self.max_bytes:
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = _Entry(value, time.monotonic() + self.ttl, size, tokens)
+            self._bytes += size
+            self.metrics["stored"] += 1
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+                self.metrics["evictions"] += 1
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= entry.size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        lookups = self.metrics["hits"] + self.metrics["misses"]
+        return {
+            **self.metrics,
+            "hit_rate": self.metrics["hits"] / lookups if lookups else 0.0,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+        }
+
+
+class CachingClient:
+    """
+    包装AsyncOpenAI客户端，只拦截 chat.completions.create，用法与原客户端相同：
+        stream = await client.chat.completions.create(..., stream=True)
+    """
+
+    def __init__(self, client, cache, namespace=None):
+        """
+        :param namespace: 服务标识，参与缓存键，默认为客户端的接口地址
+        """
+        self._client = client
+        self._cache = cache
+        self._namespace = str(getattr(client, "base_url", "") or "") if namespace is None else namespace
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    async def _create(self, **params):
+        create = self._client.chat.completions.create
+        if not self._cache.cacheable(params):
+            self._cache.metrics["bypassed"] += 1
+            return await create(**params)
+        key = request_key(params, self._namespace)
+        cached = self._cache.get(key)
+        if params.get("stream"):
+            if cached is not None:
+                return self._replay(cached)
+            return self._record(key, await create(**params))
+        if cached is not None:
+            # 命中的调用没有消耗token，调用方按usage统计时不重复计入
+            response = copy.copy(cached)
+            try:
+                response.usage = None
+            except (AttributeError, TypeError, ValueError):
+                pass
+            return response
+        response = await create(**params)
+        choices = getattr(response, "choices", None) or []
+        size = sum(len(getattr(c.message, "content", None) or "") for c in choices) + 256
+        self._cache.put(key, response, size, getattr(response, "usage", None))
+        return response
+
+    async def _replay(self, chunks):
+        for chunk in chunks:
+            # 让出事件循环，界面和并发的会话与实际流式输出时一样逐token推进
+            await asyncio.sleep(0)
+            yield chunk
+
+    async def _record(self, key, stream):
+        chunks, usage, size = [], None, 256
+        async for chunk in stream:
+            if getattr(chunk, "usage", None) is not None:
+                usage = chunk.usage
+            # stream_options的用量chunk（没有choices）不重放
+            if getattr(chunk, "choices", None):
+                chunks.append(chunk)
+                size += len(_chunk_text(chunk)) + 128
+            yield chunk
+        self._cache.put(key, chunks, size, usage)
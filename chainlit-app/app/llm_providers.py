@@ -0,0 +1,150 @@
+import os
+from openai import AsyncOpenAI
+from llm_cache import CachingClient
+
+# 已知的LLM服务商（均使用OpenAI兼容接口）：
+#   base_url      接口地址，base_url_env 指定的环境变量存在时优先使用
+#   api_key_env   读取API Key的环境变量，按顺序取第一个有值的；都没有时使用 api_key
+#   stream_usage  是否支持流式输出时返回token用量（stream_options.include_usage），部分本地服务不接受该参数
+PROVIDERS = {
+    "dashscope": {
+        "base_url": "https://dashscope.aliyuncs.com/compatible-mode/v1",
+        "api_key_env": ("Qwen_API_KEY", "DASHSCOPE_API_KEY"),
+        "stream_usage": True,
+    },
+    "deepseek": {
+        "base_url": "https://api.deepseek.com/v1",
+        "api_key_env": ("DEEPSEEK_API_KEY",),
+        "stream_usage": True,
+    },
+    "openai": {
+        "base_url": "https://api.openai.com/v1",
+        "base_url_env": "OPENAI_BASE_URL",
+        "api_key_env": ("OPENAI_API_KEY",),
+        "stream_usage": True,
+    },
+    # 本地部署的OpenAI兼容服务（Ollama、vLLM等），一般不校验API Key
+    "local": {
+        "base_url": "http://localhost:11434/v1",
+        "base_url_env": "LOCAL_LLM_BASE_URL",
+        "api_key_env": ("LOCAL_LLM_API_KEY",),
+        "api_key": "EMPTY",
+    },
+}
+
+# 可单独路由的Agent：
+#   context_check   上下文检测（只输出JSON，适合小模型）
+#   context_answer  基于上下文直接回答
+#   planner         执行计划生成（只输出JSON，适合小模型）
+#   answer          计划中的llm_answer步骤
+#   risk            医保拒付风险分析
+#   visualization   图表生成
+#   summarizer      后台对话摘要（只输出JSON，适合小模型）
+AGENTS = ("context_check", "context_answer", "planner", "answer", "risk", "visualization", "summarizer")
+
+
+def register_provider(name, base_url, api_key_env=(), api_key=None, stream_usage=False):
+    """注册其它OpenAI兼容的服务商"""
+    if isinstance(api_key_env, str):
+        api_key_env = (api_key_env,)
+    PROVIDERS[name] = {"base_url": base_url, "api_key_env": tuple(api_key_env), "api_key": api_key,
+                       "stream_usage": stream_usage}
+
+
+class LLMRouter:
+    """
+    按Agent把LLM调用路由到不同的服务商和模型，每个服务商共用一个客户端（连接池）。
+    默认路由为 LLM_PROVIDER/LLM_MODEL，单个Agent可用 LLM_ROUTE_<AGENT> 覆盖，取值为 "服务商:模型" 或只写模型，
+    例如 LLM_ROUTE_CONTEXT_CHECK=dashscope:qwen-turbo、LLM_ROUTE_RISK=deepseek:deepseek-chat。
+    其它OpenAI兼容服务可用 LLM_PROVIDER_<名称>_BASE_URL 和 LLM_PROVIDER_<名称>_API_KEY 注册，
+    支持流式返回token用量时再设置 LLM_PROVIDER_<名称>_STREAM_USAGE=true。
+    """
+
+    def __init__(self, default_provider, default_model, routes=None, environ=None):
+        """
+        :param routes: {agent: (provider, model)}，未列出的Agent使用默认路由
+        :param environ: 读取服务商地址和API Key的环境变量，默认为os.environ
+        """
+        self.default = (default_provider, default_model)
+        self.environ = os.environ if environ is None else environ
+        self.routes = dict(routes or {})
+        self._clients = {}
+        self._pid = os.getpid()
+        self._override = None
+        self._cache = None
+        self._cache_agents = frozenset()
+
+    @classmethod
+    def from_env(cls, environ=None):
+        environ = os.environ if environ is None else environ
+        for key, value in environ.items():
+            if key.startswith("LLM_PROVIDER_") and key.endswith("_BASE_URL") and value:
+                name = key[len("LLM_PROVIDER_"):-len("_BASE_URL")].lower()
+                stream_usage = environ.get(f"LLM_PROVIDER_{name.upper()}_STREAM_USAGE", "").lower() in ("1", "true", "yes")
+                register_provider(name, value, api_key_env=f"LLM_PROVIDER_{name.upper()}_API_KEY", api_key="EMPTY",
+                                  stream_usage=stream_usage)
+        default_model = environ.get("LLM_MODEL") or "qwen-plus"
+        # 未指定服务商时按模型名推断，兼容只配置了LLM_MODEL的旧配置
+        default_provider = environ.get("LLM_PROVIDER") or \
+            ("deepseek" if default_model.startswith("deepseek") else "dashscope")
+        router = cls(default_provider, default_model, environ=environ)
+        for agent in AGENTS:
+            spec = environ.get(f"LLM_ROUTE_{agent.upper()}")
+            if spec:
+                router.routes[agent] = router.parse_route(spec)
+        return router
+
+    def parse_route(self, spec):
+        """解析 "服务商:模型"；前缀不是已知服务商时整体当作模型名（如 qwen2.5:7b）"""
+        provider, sep, model = spec.partition(":")
+        if sep and provider in PROVIDERS:
+            return provider, model
+        return self.default[0], spec
+
+    def client(self, provider):
+        if self._override is not None:
+            return self._override
+        if self._pid != os.getpid():
+            # fork出的worker不复用父进程的HTTP连接池
+            self._clients = {}
+            self._pid = os.getpid()
+        if provider not in self._clients:
+            if provider not in PROVIDERS:
+                raise ValueError(f"未知的LLM服务商: {provider}")
+            config = PROVIDERS[provider]
+            base_url = self.environ.get(config["base_url_env"]) if config.get("base_url_env") else None
+            api_key = next((self.environ[name] for name in config.get("api_key_env", ()) if self.environ.get(name)),
+                           config.get("api_key"))
+            self._clients[provider] = AsyncOpenAI(api_key=api_key, base_url=base_url or config["base_url"])
+        return self._clients[provider]
+
+    def route(self, agent):
+        """返回该Agent使用的 (客户端, 模型)"""
+        provider, model = self.routes.get(agent, self.default)
+        client = self.client(provider)
+        if agent in self._cache_agents:
+            client = CachingClient(client, self._cache, f"{provider}|{getattr(client, 'base_url', '')}")
+        return client, model
+
+    def stream_usage(self, agent):
+        """该Agent路由到的服务商是否支持流式输出时返回token用量"""
+        provider, _ = self.routes.get(agent, self.default)
+        return bool(PROVIDERS.get(provider, {}).get("stream_usage"))
+
+    def enable_cache(self, cache, agents):
+        """
+        为指定的Agent启用响应缓存（LLMResponseCache）
+        :param agents: Agent名称列表，见 AGENTS
+        """
+        unknown = set(agents) - set(AGENTS)
+        if unknown:
+            raise ValueError(f"未知的Agent: {', '.join(sorted(unknown))}")
+        self._cache = cache
+        self._cache_agents = frozenset(agents)
+
+    def override_client(self, client):
+        """所有路由改用同一个客户端（如压测时指向桩LLM服务），模型名不变"""
+        self._override = client
+
+    def describe(self):
+        return {agent: ":".join(self.routes.get(agent, self.default)) for agent in AGENTS}
@@ -0,0 +1,206 @@
+"""
+会话存储的后台维护任务：
+  - 压缩：最后更新早于 compact_after_days 天的会话，把工具返回的大JSON换成资源存储中的压缩引用
+  - 归档：最后更新早于 retention_days 天的会话，写入 gzip 压缩的 NDJSON 文件（每行一个完整会话）
+  - 清理：归档后按批删除过期会话，每批之间暂停，不长时间占用IRIS
+  - 回收：标记所有会话消息仍在引用的资源存储内容，删除其余的FHIR资源和载荷（最近 gc_grace_days 天使用过的保留）
+
+只对单个会话加短时锁（与迁移互斥，不阻塞正常的追加写入），多个进程同时运行时只有一个执行。
+
+用法：
+    python maintenance.py --once
+    python maintenance.py --interval-min 60 --archive-dir ./archive
+"""
+import argparse
+import datetime
+import gzip
+import json
+import os
+import threading
+import time
+
+from context_manager import IRISContextManager
+from resource_store import FHIRResourceStore
+from storage_codec import StorageCodec
+
+
+class SessionMaintenance:
+    def __init__(self, ctx: IRISContextManager, archive_dir=None, compact_after_days=7, retention_days=90,
+                 batch_size=100, batch_pause=0.5, min_payload=1024, gc_grace_days=1):
+        """
+        :param ctx: 维护任务专用的 IRISContextManager（独占一个连接）
+        :param archive_dir: 归档目录，为None时过期会话直接删除不归档
+        :param batch_size: 每批归档/删除的会话数（回收资源时为每批检查的内容数）
+        :param batch_pause: 批与批之间暂停的秒数
+        :param gc_grace_days: 未被引用的资源最近多少天内被使用过时不回收（至少1天，正在写入的消息引用的内容不会被回收）
+        """
+        self.ctx = ctx
+        self.archive_dir = archive_dir
+        self.compact_after_days = compact_after_days
+        self.retention_days = retention_days
+        self.batch_size = batch_size
+        self.batch_pause = batch_pause
+        self.min_payload = min_payload
+        self.gc_grace_days = max(1, gc_grace_days)
+
+    @staticmethod
+    def _cutoff(days):
+        return (datetime.datetime.utcnow() - datetime.timedelta(days=days)).isoformat() + "Z"
+
+    def _batches(self, updated_before):
+        batch = []
+        for session_id, last_updated in self.ctx.iter_sessions_updated_before(updated_before):
+            batch.append(session_id)
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _archive(self, path, session_ids):
+        """把一批会话追加写入归档文件（每批一个gzip成员），返回写入的会话"""
+        archived = []
+        with gzip.open(path, "at", encoding="utf-8") as f:
+            for session_id in session_ids:
+                # 直接读取global，过期会话不进入会话缓存
+                doc = self.ctx.export_session(session_id)
+                if doc is None:
+                    continue
+                f.write(json.dumps(doc, ensure_ascii=False) + "\n")
+                archived.append(session_id)
+        return archived
+
+    def purge_expired(self):
+        """归档并删除超过保留期的会话"""
+        updated_before = self._cutoff(self.retention_days)
+        stats = {"archived": 0, "purged": 0, "skipped": 0}
+        path = None
+        if self.archive_dir:
+            os.makedirs(self.archive_dir, exist_ok=True)
+            stamp = datetime.datetime.utcnow().strftime("%Y%m%d-%H%M%S")
+            path = os.path.join(self.archive_dir, f"chat-sessions-{stamp}.ndjson.gz")
+        for batch in self._batches(updated_before):
+            if path:
+                # 归档文件写完关闭后才删除，进程中途退出时会话最多被重复归档，不会丢失
+                batch = self._archive(path, batch)
+                stats["archived"] += len(batch)
+            for session_id in batch:
+                if self.ctx.purge_session(session_id, updated_before):
+                    stats["purged"] += 1
+                else:
+                    stats["skipped"] += 1
+            time.sleep(self.batch_pause)
+        return stats
+
+    def compact_idle(self):
+        """压缩超过 compact_after_days 天未更新的会话"""
+        updated_before = self._cutoff(self.compact_after_days)
+        stats = {"compacted": 0, "messages": 0, "busy": 0}
+        for batch in self._batches(updated_before):
+            for session_id in batch:
+                rewritten = self.ctx.compact_session(session_id, self.min_payload)
+                if rewritten is None:
+                    stats["busy"] += 1
+                elif rewritten:
+                    stats["compacted"] += 1
+                    stats["messages"] += rewritten
+            time.sleep(self.batch_pause)
+        return stats
+
+    def collect_garbage(self):
+        """回收没有会话消息引用的FHIR资源和载荷（标记-清除）"""
+        resources = self.ctx.resources
+        stats = {"resources_kept": 0, "resources_swept": 0}
+        if resources is None:
+            return stats
+        # 标记：逐个会话汇总引用，每batch_size个会话暂停一次
+        referenced = set()
+        for marked, (_, refs) in enumerate(self.ctx.iter_resource_refs(), start=1):
+            referenced |= refs
+            if marked % self.batch_size == 0:
+                time.sleep(self.batch_pause)
+        used_before = (datetime.datetime.utcnow() - datetime.timedelta(days=self.gc_grace_days)).date().isoformat()
+        checked = 0
+        for ref, subscripts in resources.iter_stored(self.ctx.iris):
+            if ref not in referenced and resources.sweep(self.ctx.iris, subscripts, used_before):
+                stats["resources_swept"] += 1
+            else:
+                stats["resources_kept"] += 1
+            checked += 1
+            if checked % self.batch_size == 0:
+                time.sleep(self.batch_pause)
+        return stats
+
+    def run_once(self):
+        """执行一轮维护；其它进程正在执行时直接返回None"""
+        iris = self.ctx.iris
+        if not iris.lock("", 0, self.ctx.index_name, "maintenance"):
+            return None
+        try:
+            start = time.perf_counter()
+            stats = {**self.purge_expired(), **self.compact_idle(), **self.collect_garbage()}
+            stats["seconds"] = round(time.perf_counter() - start, 3)
+            return stats
+        finally:
+            iris.unlock("", self.ctx.index_name, "maintenance")
+
+    def run_forever(self, interval, stop_event=None):
+        stop_event = stop_event or threading.Event()
+        while not stop_event.is_set():
+            try:
+                stats = self.run_once()
+                if stats:
+                    print(f"会话维护完成: {stats}")
+            except Exception as e:
+                print(f"会话维护失败: {e}")
+            stop_event.wait(interval)
+
+
+def start_background(connect_args, interval, cache=None, resources=None, codec=None, **options):
+    """
+    在后台守护线程中定期执行维护任务（使用独立的IRIS连接），返回用于停止的Event
+    :param connect_args: IRISContextManager 的 (host, port, namespace, username, password, global_name)
+    """
+    stop_event = threading.Event()
+
+    def run():
+        ctx = IRISContextManager(*connect_args, cache=cache, resources=resources, codec=codec)
+        try:
+            SessionMaintenance(ctx, **options).run_forever(interval, stop_event)
+        finally:
+            ctx.connection.close()
+
+    threading.Thread(target=run, name="session-maintenance", daemon=True).start()
+    return stop_event
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="对话会话存储维护任务")
+    parser.add_argument("--once", action="store_true", help="只执行一轮")
+    parser.add_argument("--interval-min", type=float, default=60)
+    parser.add_argument("--archive-dir", default=os.getenv("SESSION_ARCHIVE_DIR"))
+    parser.add_argument("--compact-after-days", type=float, default=float(os.getenv("SESSION_COMPACT_AFTER_DAYS", "7")))
+    parser.add_argument("--retention-days", type=float, default=float(os.getenv("SESSION_RETENTION_DAYS", "90")))
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--rebuild-index", action="store_true", help="先为已有会话补建last_updated索引")
+    args = parser.parse_args()
+
+    ctx = IRISContextManager(
+        host=os.getenv("IRIS_HOSTNAME"),
+        port=int(os.getenv("IRIS_PORT")),
+        namespace=os.getenv("IRIS_NAMESPACE"),
+        username=os.getenv("IRIS_USERNAME"),
+        password=os.getenv("IRIS_PASSWORD"),
+        resources=FHIRResourceStore(),
+        codec=StorageCodec(os.getenv("IRIS_STORAGE_CODEC") or None)
+    )
+    if args.rebuild_index:
+        print(f"补建索引的会话数: {ctx.rebuild_index()}")
+    job = SessionMaintenance(ctx, archive_dir=args.archive_dir, compact_after_days=args.compact_after_days,
+                             retention_days=args.retention_days, batch_size=args.batch_size)
+    if args.once:
+        print(job.run_once())
+    else:
+        job.run_forever(args.interval_min * 60)
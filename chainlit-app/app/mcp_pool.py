@@ -0,0 +1,143 @@
+import asyncio
+import time
+from contextlib import AsyncExitStack
+from mcp import ClientSession
+from mcp.client.sse import sse_client
+from mcp.client.streamable_http import streamablehttp_client
+
+
+def parse_servers(value):
+    """
+    解析MCP服务配置 "名称=地址,名称=地址"。地址以 /sse 结尾时使用SSE，否则使用streamable-http
+    :return: {名称: (client_type, url, headers)}
+    """
+    servers = {}
+    for item in (value or "").split(","):
+        name, sep, url = item.strip().partition("=")
+        if not sep or not url.strip():
+            continue
+        url = url.strip()
+        servers[name.strip()] = ("sse" if url.rstrip("/").endswith("/sse") else "streamable-http", url, None)
+    return servers
+
+
+class _Connection:
+    """一个MCP服务的连接，在后台任务中保持（MCP客户端的上下文必须在同一个任务中进入和退出）"""
+
+    def __init__(self, name, client_type, url, headers):
+        self.name = name
+        self.client_type = client_type
+        self.url = url
+        self.headers = headers
+        self.ready = asyncio.get_running_loop().create_future()
+        self.stop = asyncio.Event()
+        self.task = asyncio.ensure_future(self._hold())
+
+    async def _hold(self):
+        try:
+            async with AsyncExitStack() as stack:
+                if self.client_type == "sse":
+                    read, write = await stack.enter_async_context(sse_client(self.url, headers=self.headers))
+                else:
+                    read, write, _ = await stack.enter_async_context(
+                        streamablehttp_client(self.url, headers=self.headers))
+                session = await stack.enter_async_context(ClientSession(read, write))
+                await session.initialize()
+                result = await session.list_tools()
+                tools = [{"name": t.name, "description": t.description, "input_schema": t.inputSchema}
+                         for t in result.tools]
+                self.ready.set_result((session, tools))
+                await self.stop.wait()
+        except Exception as e:
+            if not self.ready.done():
+                self.ready.set_exception(e)
+        finally:
+            if not self.ready.done():
+                self.ready.cancel()
+
+    @property
+    def alive(self):
+        return not self.task.done()
+
+
+class MCPConnectionPool:
+    """
+    每个worker进程自己的MCP连接，进程内所有会话共享，首次使用时建立，断开后下次使用时重新建立。
+    Chainlit界面建立的MCP连接只存在于处理该连接的worker中；会话被路由到其它worker（重连、多进程部署）时，
+    on_message使用本进程的连接。服务地址来自配置（MCP_SERVERS）或界面连接时登记的地址。
+    """
+
+    def __init__(self, servers=None, connect_timeout=10.0, retry_interval=30.0):
+        """
+        :param servers: {名称: (client_type, url, headers)}，见 parse_servers
+        :param retry_interval: 连接失败的服务在多少秒内不再重试（避免每轮对话都等待连接超时）
+        """
+        self.servers = dict(servers or {})
+        self.connect_timeout = connect_timeout
+        self.retry_interval = retry_interval
+        self._connections = {}
+        self._retry_at = {}
+        self._lock = None
+        self.metrics = {
+            "connects": 0,
+            "failures": 0,
+            "reused": 0,
+        }
+
+    def register(self, connection):
+        """登记界面建立的MCP连接的地址（stdio连接和已配置的服务除外）"""
+        url = getattr(connection, "url", None)
+        if url and connection.name not in self.servers:
+            self.servers[connection.name] = (getattr(connection, "clientType", "sse"), url,
+                                             getattr(connection, "headers", None))
+
+    async def _connect(self, name):
+        connection = self._connections.get(name)
+        if connection is not None and connection.alive and connection.ready.done() \
+                and connection.ready.exception() is None:
+            self.metrics["reused"] += 1
+            return connection.ready.result()
+        if connection is None or not connection.alive:
+            connection = self._connections[name] = _Connection(name, *self.servers[name])
+            self.metrics["connects"] += 1
+        try:
+            return await asyncio.wait_for(asyncio.shield(connection.ready), self.connect_timeout)
+        except Exception:
+            self.metrics["failures"] += 1
+            connection.stop.set()
+            connection.task.cancel()
+            self._connections.pop(name, None)
+            raise
+
+    async def get(self):
+        """
+        返回本进程到所有已登记服务的连接，格式与on_mcp_connect保存到user_session中的相同：
+        ({服务名: ClientSession}, {服务名: 工具列表})；没有可用的服务时两者都为空。
+        调用工具时按工具所属的服务选择连接
+        """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        sessions, tools = {}, {}
+        async with self._lock:
+            for name in list(self.servers):
+                if self._retry_at.get(name, 0) > time.monotonic():
+                    continue
+                try:
+                    server_session, server_tools = await self._connect(name)
+                except Exception as e:
+                    print(f"连接MCP服务{name}失败: {e!r}")
+                    self._retry_at[name] = time.monotonic() + self.retry_interval
+                    continue
+                sessions[name] = server_session
+                tools[name] = server_tools
+        return sessions, tools
+
+    async def aclose(self):
+        for connection in self._connections.values():
+            connection.stop.set()
+        await asyncio.gather(*[c.task for c in self._connections.values()], return_exceptions=True)
+        self._connections.clear()
+
+    def stats(self):
+        return {**self.metrics, "servers": list(self.servers), "connected": sum(
+            1 for c in self._connections.values() if c.alive and c.ready.done() and c.ready.exception() is None)}
@@ -0,0 +1,232 @@
+import hashlib
+import json
+import re
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import NamedTuple
+
+# 问题末尾可以忽略的标点
+TRAILING_PUNCT = "?？。.!！~～ "
+# 看起来像ID的值（患者id、字典码等）
+ID_PATTERN = re.compile(r"(?<![0-9A-Za-z])[0-9][0-9A-Za-z\-]*(?![0-9A-Za-z])")
+
+
+def normalize_question(question):
+    """全角转半角、合并空白（中文与其它字符之间的空白去掉）、去掉末尾标点"""
+    text = unicodedata.normalize("NFKC", question or "")
+    text = re.sub(r"\s+", " ", text).strip()
+    text = re.sub(r"(?<=[^\x00-\x7f]) | (?=[^\x00-\x7f])", "", text)
+    return text.rstrip(TRAILING_PUNCT)
+
+
+def _hash(obj):
+    data = json.dumps(obj, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.blake2b(data.encode("utf-8"), digest_size=12).hexdigest()
+
+
+def tool_schemas(tools):
+    """{工具名: 输入定义的哈希}"""
+    return {t.get("name"): _hash(t.get("input_schema")) for t in tools or []}
+
+
+def tools_fingerprint(tools):
+    """工具列表（名称和输入定义）的指纹，计划按工具列表分别缓存"""
+    return _hash(sorted(tool_schemas(tools).items(), key=lambda item: str(item[0])))
+
+
+def _slot_regex(value):
+    """按原值的形态限定槽位能匹配的内容：数字、ID（字母数字）或任意文本"""
+    if value.isdigit():
+        return r"(\d+)"
+    if re.fullmatch(r"[0-9A-Za-z\-\.]+", value):
+        return r"([0-9A-Za-z\-\.]+)"
+    return r"(.+?)"
+
+
+def _value_pattern(value):
+    """在计划JSON文本中查找槽位值，数字/字母值不匹配更长的数字/单词的一部分"""
+    escaped = re.escape(json.dumps(value, ensure_ascii=False)[1:-1])
+    if re.fullmatch(r"[0-9A-Za-z\-\.]+", value):
+        return re.compile(rf"(?<![0-9A-Za-z]){escaped}(?![0-9A-Za-z])")
+    return re.compile(escaped)
+
+
+def _leaf_values(obj):
+    if isinstance(obj, dict):
+        for value in obj.values():
+            yield from _leaf_values(value)
+    elif isinstance(obj, list):
+        for value in obj:
+            yield from _leaf_values(value)
+    elif isinstance(obj, (str, int)) and not isinstance(obj, bool):
+        yield str(obj)
+
+
+class CachedPlan:
+    """一个意图模板及其参数化的计划：计划JSON文本中的槽位值换成了 \\x00槽位号\\x00"""
+    __slots__ = ("template", "regex", "plan_text", "slots", "hits")
+
+    def __init__(self, template, regex, plan_text, slots):
+        self.template = template
+        self.regex = regex
+        self.plan_text = plan_text
+        self.slots = slots
+        self.hits = 0
+
+    def render(self, values):
+        text = self.plan_text
+        for i, value in enumerate(values):
+            text = text.replace(f"\x00{i}\x00", json.dumps(value, ensure_ascii=False)[1:-1])
+        return json.loads(text)
+
+
+class PlanMatch(NamedTuple):
+    """match 找到的缓存计划：plan 为按新槽位值重放的计划"""
+    fingerprint: str
+    template: str
+    plan: dict
+
+
+class PlanCache:
+    """
+    按意图模板缓存执行计划。问题中同时出现在计划输入里的值（患者id、药品名等）视为槽位，
+    问题去掉槽位后的文本作为模板；同一模板的新问题直接用新的槽位值重放计划，不再调用LLM生成。
+    只缓存执行成功、且不依赖对话历史的计划。进程内所有会话共享，计划按工具列表的指纹分别缓存
+    （没有MCP连接的会话、某个MCP服务暂时不可用的worker互不影响），所有工具列表的计划一起按LRU淘汰；
+    已知的工具的输入定义变化时，包含该工具的工具列表下的计划全部失效。
+    """
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        # (工具列表指纹, 模板) -> CachedPlan，按最近使用排列
+        self._entries = OrderedDict()
+        # 工具列表指纹 -> {模板: CachedPlan}，按最近使用排列（匹配时新的模板优先）
+        self._templates = {}
+        # 工具列表指纹 -> {工具名: 输入定义的哈希}
+        self._tool_sets = {}
+        self._lock = threading.Lock()
+        self.metrics = {
+            "hits": 0,
+            "misses": 0,
+            "stored": 0,
+            "rejected": 0,
+            "invalidations": 0,
+        }
+
+    def _drop(self, fingerprint):
+        for template in self._templates.pop(fingerprint, {}):
+            del self._entries[(fingerprint, template)]
+        self._tool_sets.pop(fingerprint, None)
+
+    def _check_tools(self, fingerprint, tools):
+        """登记工具列表；已知的工具输入定义变化时，使包含旧定义的工具列表下的计划失效"""
+        if fingerprint in self._tool_sets:
+            return
+        schemas = tool_schemas(tools)
+        for known, known_schemas in list(self._tool_sets.items()):
+            if any(name in schemas and schemas[name] != h for name, h in known_schemas.items()):
+                self._drop(known)
+                self.metrics["invalidations"] += 1
+        self._tool_sets[fingerprint] = schemas
+        self._templates[fingerprint] = OrderedDict()
+
+    def match(self, question, tools):
+        """
+        查找问题对应的缓存计划，不改变统计和LRU顺序（计划确实被执行时由调用方调用 record）
+        :return: PlanMatch，其plan与generate_plan的返回格式相同；未找到时返回None
+        """
+        if not self.max_entries:
+            return None
+        text = normalize_question(question)
+        fingerprint = tools_fingerprint(tools)
+        with self._lock:
+            for template, entry in reversed(list((self._templates.get(fingerprint) or {}).items())):
+                match = entry.regex.fullmatch(text)
+                if match:
+                    return PlanMatch(fingerprint, template, entry.render(match.groups()))
+            return None
+
+    def record(self, match):
+        """记录一次需要执行计划的对话：match 为 match() 的结果，None表示计划是新生成的"""
+        with self._lock:
+            if match is None:
+                self.metrics["misses"] += 1
+                return
+            self.metrics["hits"] += 1
+            entry = self._entries.get((match.fingerprint, match.template))
+            if entry is not None:
+                entry.hits += 1
+                self._entries.move_to_end((match.fingerprint, match.template))
+                self._templates[match.fingerprint].move_to_end(match.template)
+
+    def store(self, question, tools, plan_json):
+        """
+        缓存一个已成功执行的计划
+        :param plan_json: 执行前的计划（执行时会把临时变量写进步骤input，调用方需先复制）
+        :return: 是否缓存
+        """
+        if not self.max_entries or not plan_json.get("plan"):
+            return False
+        # 没有工具调用的计划通常是对历史内容的加工，输入中带有历史中的文本，不能用于其它会话
+        if not any(step.get("action") == "call_tool" for step in plan_json["plan"]):
+            self.metrics["rejected"] += 1
+            return False
+        text = normalize_question(question)
+        plan_text = json.dumps(plan_json, ensure_ascii=False)
+        # 计划输入中有问题里没有的ID时（如"他的费用"中的患者id、会话医生的id、当天的日期），计划引用了对话历史、
+        # 会话或当时的信息，换一个问题重放时这些值不会随之变化，不能缓存
+        inputs = json.dumps([step.get("input") for step in plan_json["plan"]], ensure_ascii=False)
+        question_ids = set(ID_PATTERN.findall(text))
+        if any(value not in question_ids for value in ID_PATTERN.findall(inputs)):
+            self.metrics["rejected"] += 1
+            return False
+        values = {v for v in _leaf_values(plan_json["plan"]) if len(v) >= 2 and not v.startswith("$") and v in text}
+        # 长的值优先，避免短值是长值的一部分
+        slots = []
+        for value in sorted(values, key=len, reverse=True):
+            if value in text and not any(value in slot for slot in slots):
+                slots.append(value)
+        # 按在问题中出现的位置排列槽位，生成模板和匹配问题的正则
+        slots.sort(key=text.find)
+        template, pattern, pos = [], [], 0
+        for i, value in enumerate(slots):
+            start = text.find(value, pos)
+            if start < 0:
+                self.metrics["rejected"] += 1
+                return False
+            template.append(text[pos:start] + f"{{{i}}}")
+            pattern.append(re.escape(text[pos:start]) + _slot_regex(value))
+            pos = start + len(value)
+        template.append(text[pos:])
+        pattern.append(re.escape(text[pos:]))
+        for i, value in enumerate(slots):
+            plan_text = _value_pattern(value).sub(f"\x00{i}\x00", plan_text)
+        template = "".join(template)
+        fingerprint = tools_fingerprint(tools)
+        with self._lock:
+            self._check_tools(fingerprint, tools)
+            entry = CachedPlan(template, re.compile("".join(pattern)), plan_text, slots)
+            self._entries[(fingerprint, template)] = entry
+            self._entries.move_to_end((fingerprint, template))
+            self._templates[fingerprint][template] = entry
+            self._templates[fingerprint].move_to_end(template)
+            while len(self._entries) > self.max_entries:
+                (old_fingerprint, old_template), _ = self._entries.popitem(last=False)
+                templates = self._templates[old_fingerprint]
+                del templates[old_template]
+                if not templates and old_fingerprint != fingerprint:
+                    del self._templates[old_fingerprint]
+                    del self._tool_sets[old_fingerprint]
+            self.metrics["stored"] += 1
+        return True
+
+    def stats(self):
+        lookups = self.metrics["hits"] + self.metrics["misses"]
+        return {
+            **self.metrics,
+            "hit_rate": self.metrics["hits"] / lookups if lookups else 0.0,
+            "entries": len(self._entries),
+            "tool_sets": len(self._templates),
+            "templates": {t: e.hits for (_, t), e in self._entries.items()},
+        }
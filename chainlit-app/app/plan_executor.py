@@ -0,0 +1,113 @@
+import asyncio
+import json
+import re
+
+# 计划中引用临时变量的写法，如 "$patient"、"$患者信息"（\w 匹配包括中文在内的Unicode字母、数字和下划线）
+VAR_PATTERN = re.compile(r"\$\w+")
+
+
+def _referenced_vars(input_data, known_vars):
+    """步骤input中引用到的、由本计划其它步骤产生的临时变量"""
+    if input_data is None:
+        return set()
+    text = input_data if isinstance(input_data, str) else json.dumps(input_data, ensure_ascii=False)
+    return set(VAR_PATTERN.findall(text)) & known_vars
+
+
+def build_dependencies(plan):
+    """
+    根据各步骤的 result_var 和 input 中的 $变量 引用建立依赖（DAG，只依赖排在前面的步骤）：
+      - 读取某变量的步骤依赖前面产生该变量的步骤
+      - 产生某变量的步骤依赖前面读取或产生同一变量的步骤，保证变量的最终值与顺序执行一致
+    :return: 每个步骤依赖的步骤下标集合
+    """
+    known_vars = {step.get("result_var") for step in plan if step.get("result_var")}
+    reads = [_referenced_vars(step.get("input"), known_vars) for step in plan]
+    writes = [{step["result_var"]} if step.get("result_var") else set() for step in plan]
+    dependencies = []
+    for i in range(len(plan)):
+        deps = set()
+        for j in range(i):
+            if reads[i] & writes[j] or writes[i] & (writes[j] | reads[j]):
+                deps.add(j)
+        dependencies.append(deps)
+    return dependencies
+
+
+class StepOutput:
+    """单个步骤的输出：界面操作经 emit 按计划顺序发出，answers/notes 按步骤收集后按计划顺序汇总"""
+
+    def __init__(self, ordered, index):
+        self._ordered = ordered
+        self.index = index
+        self.answers = []
+        self.notes = []
+        # 步骤执行失败（工具报错、无法识别的计划类型等）时由 run_step 置为True
+        self.failed = False
+
+    async def emit(self, action):
+        """
+        发出一个界面操作（无参数的协程函数，如 lambda: cl.Message(content=...).send()）。
+        排在最前面的未完成步骤立即执行，其余步骤先缓冲，轮到时按原顺序补发。
+        """
+        await self._ordered.emit(self.index, action)
+
+
+class OrderedOutput:
+    """按计划顺序输出界面内容，并发执行的步骤在界面上的顺序与顺序执行时一致"""
+
+    def __init__(self, count):
+        self._buffers = [[] for _ in range(count)]
+        self._done = [False] * count
+        self._head = 0
+        self._lock = asyncio.Lock()
+
+    async def emit(self, index, action):
+        async with self._lock:
+            if index == self._head:
+                await action()
+            else:
+                self._buffers[index].append(action)
+
+    async def finish(self, index):
+        async with self._lock:
+            self._done[index] = True
+            while self._head < len(self._done) and self._done[self._head]:
+                self._head += 1
+                if self._head < len(self._done):
+                    for action in self._buffers[self._head]:
+                        await action()
+                    self._buffers[self._head].clear()
+
+
+async def run_plan(plan, run_step, max_concurrency=4):
+    """
+    按依赖关系并发执行计划：依赖都已完成的步骤立即开始，同时执行的步骤数不超过max_concurrency。
+    :param run_step: 协程函数 run_step(index, step, output)，通过 output.emit 发出界面操作，
+                     把要写入历史的文本追加到 output.answers
+    :return: 按计划顺序排列的 StepOutput 列表
+    """
+    dependencies = build_dependencies(plan)
+    ordered = OrderedOutput(len(plan))
+    outputs = [StepOutput(ordered, i) for i in range(len(plan))]
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
+    tasks = {}
+
+    async def execute(index):
+        await asyncio.gather(*[tasks[dep] for dep in dependencies[index]])
+        try:
+            async with semaphore:
+                await run_step(index, plan[index], outputs[index])
+        finally:
+            await ordered.finish(index)
+
+    # 依赖只指向前面的步骤，按顺序创建任务即可
+    for index in range(len(plan)):
+        tasks[index] = asyncio.ensure_future(execute(index))
+    try:
+        await asyncio.gather(*tasks.values())
+    except BaseException:
+        for task in tasks.values():
+            task.cancel()
+        raise
+    return outputs
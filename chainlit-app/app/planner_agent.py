@@ -1,10 +1,23 @@
 import chainlit as cl
 import json
 
-async def generate_plan(history, user_input, tools, client, llm_model):
+PLANNER_SYSTEM = "你是一个计划生成Agent，只负责输出JSON结构计划"
+
+def _record_usage(trace, part):
+    # 开启include_usage后，最后一个数据块的choices为空，只带本次调用的token用量
+    usage = getattr(part, "usage", None)
+    if usage is not None:
+        trace["usage"] = {"prompt_tokens": usage.prompt_tokens, "completion_tokens": usage.completion_tokens}
+
+async def generate_plan(history, user_input, tools, client, llm_model, show_step=True, trace=None,
+                        prompt_builder=None, session_id=None, stream_usage=False):
     """
     自动生成执行计划，包含多步tool和llm_answer。
     返回JSON: { plan: [step1, step2, ...], explanation: "" }
+    :param show_step: 是否在界面上流式显示生成过程（推测执行时为False，确定采用后再显示）
+    :param trace: 可选的字典，记录原始输出(response)、已收到的token块数(chunks)和用量(usage)
+    :param prompt_builder: 可选的PromptBuilder，按token预算截取对话历史（需同时传入session_id）
+    :param stream_usage: 服务商支持时请求在流的最后返回token用量（记入trace的usage）
     """
     # 组织tools描述
     tool_list_str = ""
@@ -15,13 +28,8 @@ async def generate_plan(history, user_input, tools, client, llm_model):
         ) if isinstance(input_schema, dict) and input_schema else "无输入字段"
         tool_list_str += f"- {t['name']}: {t['description']} | 输入字段: {input_fields}\n"
 
-    # 多轮历史
-    history_str = ""
-    if history:
-        for msg in history:
-            history_str += f"{msg['role']}: {msg['content']}\n"
-
-    prompt = f"""
+    def build_prompt(history_str):
+        return f"""
 你是一个多步计划Agent，请根据用户历史与当前问题，结合可用工具，规划详细执行计划。
 
 对话历史（如有）：
@@ -65,29 +73,57 @@ async def generate_plan(history, user_input, tools, client, llm_model):
 在对药物进行风险与报销可行性分析时，应明确说明医生要检查的是哪些药物。
 """
 
-    async with cl.Step(name="执行计划生成Agent", type="llm") as step:
-        #step.input = prompt
-        stream = await client.chat.completions.create(
-            model=llm_model,
-            messages=[
-                {"role": "system", "content": "你是一个计划生成Agent，只负责输出JSON结构计划"},
-                {"role": "user", "content": prompt},
-            ],
-            stream=True,
-            temperature=0.01
-        )
+    # 多轮历史
+    if prompt_builder is not None:
+        history_str = prompt_builder.history_lines(session_id, history, "planner", PLANNER_SYSTEM + build_prompt(""))
+    else:
+        history_str = ""
+        if history:
+            for msg in history:
+                history_str += f"{msg['role']}: {msg['content']}\n"
+    prompt = build_prompt(history_str)
+
+    trace = trace if trace is not None else {}
+    trace.setdefault("chunks", 0)
+    # 部分OpenAI兼容的本地服务不接受stream_options，只在服务商支持时请求用量
+    options = {"stream_options": {"include_usage": True}} if stream_usage else {}
+    stream = await client.chat.completions.create(
+        model=llm_model,
+        messages=[
+            {"role": "system", "content": PLANNER_SYSTEM},
+            {"role": "user", "content": prompt},
+        ],
+        stream=True,
+        temperature=0.01,
+        **options
+    )
+    tokens = []
+    if show_step:
+        async with cl.Step(name="执行计划生成Agent", type="llm") as step:
+            #step.input = prompt
+            async for part in stream:
+                _record_usage(trace, part)
+                delta = part.choices[0].delta if part.choices else None
+                if delta and delta.content:
+                    tokens.append(delta.content)
+                    trace["chunks"] += 1
+                    # Stream the output of the step
+                    await step.stream_token(delta.content)
+    else:
         async for part in stream:
-            delta = part.choices[0].delta
-            if delta.content:
-                # Stream the output of the step
-                await step.stream_token(delta.content)
-        #cl.logger.info(step.output)
-        response = step.output
+            _record_usage(trace, part)
+            delta = part.choices[0].delta if part.choices else None
+            if delta and delta.content:
+                tokens.append(delta.content)
+                trace["chunks"] += 1
+    #cl.logger.info(step.output)
+    response = "".join(tokens)
+    trace["response"] = response
     # 提取json（防止模型外包一层说明，可用正则或手动strip）
     try:
-        # 尽可能找第一个大括号及其后内容
+        # 尽可能找第一个大括号，只解析其后的第一个完整JSON对象（忽略之后的 ``` 等内容，如DeepSeek常输出代码块）
         json_start = response.find('{')
-        json_obj = json.loads(response[json_start:])
+        json_obj, _ = json.JSONDecoder().raw_decode(response, json_start)
         return json_obj
     except Exception as e:
         return {
@@ -0,0 +1,121 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import NamedTuple, Optional
+import httpx
+from utils import get_official_name
+
+
+class PractitionerProfile(NamedTuple):
+    """医生档案：资源id、姓名（FHIR不可用时为None）和FHIR Practitioner资源"""
+    id: str
+    name: Optional[str]
+    resource: Optional[dict]
+
+    def display_name(self):
+        return self.name or f"资源id为{self.id}的"
+
+
+class PractitionerService:
+    """
+    异步的医生档案服务：首次用到某位医生时才向FHIR服务器查询Practitioner资源，按TTL缓存，一个worker可服务多位医生。
+    同一医生的并发查询合并为一次请求；FHIR不可用时返回过期的缓存档案或只有id的档案，并在 negative_ttl 后重试，
+    应用启动不依赖FHIR服务器。
+    """
+
+    def __init__(self, base_url, ttl=600, negative_ttl=30, max_entries=1024, timeout=5.0, client=None):
+        """
+        :param base_url: FHIR服务地址，如 http://localhost:52880/csp/healthshare/fhirserver/fhir/r4
+        :param ttl: 档案缓存秒数
+        :param negative_ttl: 查询失败后多少秒内不再重试
+        :param client: 可选的 httpx.AsyncClient，默认首次查询时创建
+        """
+        self.base_url = base_url.rstrip("/")
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self._client = client
+        self._entries = OrderedDict()
+        self._pending = {}
+        self.metrics = {
+            "hits": 0,
+            "misses": 0,
+            "shared": 0,
+            "fetches": 0,
+            "failures": 0,
+            "stale": 0,
+        }
+
+    async def get(self, prac_id) -> PractitionerProfile:
+        prac_id = str(prac_id)
+        entry = self._entries.get(prac_id)
+        if entry is not None and entry[1] > time.monotonic():
+            self._entries.move_to_end(prac_id)
+            self.metrics["hits"] += 1
+            return entry[0]
+        task = self._pending.get(prac_id)
+        if task is None:
+            self.metrics["misses"] += 1
+            task = self._pending[prac_id] = asyncio.ensure_future(self._load(prac_id))
+        else:
+            self.metrics["shared"] += 1
+        # 某个调用方被取消时不影响其它等待同一查询的调用方
+        return await asyncio.shield(task)
+
+    async def _load(self, prac_id):
+        try:
+            resource = await self._fetch(prac_id)
+            if resource is not None:
+                profile = PractitionerProfile(prac_id, get_official_name(resource), resource)
+                self._store(prac_id, profile, self.ttl)
+                return profile
+            self.metrics["failures"] += 1
+            entry = self._entries.get(prac_id)
+            if entry is not None and entry[0].resource is not None:
+                # 沿用过期的档案，稍后重试
+                self.metrics["stale"] += 1
+                profile = entry[0]
+            else:
+                profile = PractitionerProfile(prac_id, None, None)
+            self._store(prac_id, profile, self.negative_ttl)
+            return profile
+        finally:
+            self._pending.pop(prac_id, None)
+
+    async def _fetch(self, prac_id):
+        if self._client is None:
+            self._client = httpx.AsyncClient(timeout=self.timeout, headers={
+                "Content-Type": "application/fhir+json;charset=utf-8",
+                "User-Agent": "Python HTTP Client"
+            })
+        self.metrics["fetches"] += 1
+        try:
+            response = await self._client.get(f"{self.base_url}/Practitioner/{prac_id}")
+            response.raise_for_status()
+            return response.json()
+        except httpx.HTTPError as e:
+            print(f"查询医生{prac_id}的Practitioner资源失败: {e!r}")
+        except ValueError:
+            print(f"医生{prac_id}的Practitioner资源不是有效的JSON")
+        return None
+
+    def _store(self, prac_id, profile, ttl):
+        self._entries[prac_id] = (profile, time.monotonic() + ttl)
+        self._entries.move_to_end(prac_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, prac_id=None):
+        if prac_id is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(str(prac_id), None)
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def stats(self):
+        return {**self.metrics, "entries": len(self._entries)}
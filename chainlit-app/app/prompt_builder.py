@@ -0,0 +1,219 @@
+import json
+import math
+import re
+import threading
+from collections import Counter, OrderedDict
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# 中日韩字符（含全角标点），这类字符大多单独成一个token
+CJK = re.compile(r"[　-〿㐀-䶿一-鿿＀-￯]")
+RESOURCE_TYPE = re.compile(r'"resourceType"\s*:\s*"(\w+)"')
+
+
+class Tokenizer:
+    """
+    本地token计数。安装了tiktoken且能加载编码时使用tiktoken，否则按字符估算：
+    中文字符每个计1个token，其它字符每3个计1个token（JSON、英文一般每3~4个字符1个token，估算偏大更安全）。
+    """
+
+    def __init__(self, encoding=None):
+        self._encoding = None
+        if encoding and tiktoken is not None:
+            try:
+                self._encoding = tiktoken.get_encoding(encoding)
+            except Exception as e:
+                print(f"加载tiktoken编码{encoding}失败，改用估算: {e}")
+        self.name = encoding if self._encoding else "estimate"
+
+    def count(self, text):
+        if not text:
+            return 0
+        if self._encoding is not None:
+            return len(self._encoding.encode(text, disallowed_special=()))
+        cjk = len(CJK.findall(text))
+        return cjk + math.ceil((len(text) - cjk) / 3)
+
+
+def summarize_payload(content, head_chars=200):
+    """把工具返回的大段数据压缩成摘要：开头一段原文、资源类型统计和省略的长度"""
+    types = Counter(RESOURCE_TYPE.findall(content))
+    resources = "，".join(f"{t}×{n}" for t, n in types.most_common(8))
+    summary = f"[较早的工具返回数据，详细内容已省略，共{len(content)}字符"
+    if resources:
+        summary += f"，包含资源: {resources}"
+    return summary + f"] {content[:head_chars]}…"
+
+
+class _Entry:
+    """一条历史消息，按 (格式, 是否摘要) 缓存序列化结果 (内容, 文本, token数)"""
+    __slots__ = ("role", "content", "payload", "rendered")
+
+    def __init__(self, role, content, payload):
+        self.role = role
+        self.content = content
+        self.payload = payload
+        self.rendered = {}
+
+
+class _SessionHistory:
+    __slots__ = ("entries", "lock")
+
+    def __init__(self):
+        self.entries = []
+        self.lock = threading.Lock()
+
+
+# 历史消息的三种序列化格式
+FORMATS = {
+    # 上下文检测：JSON对象，每行一条
+    "json": lambda role, content: json.dumps({"role": role, "content": content}, ensure_ascii=False),
+    # 计划生成：role: content
+    "lines": lambda role, content: f"{role}: {content}",
+    # 直接作为chat messages传入，token数按内容计算
+    "messages": lambda role, content: content,
+}
+# 每条消息在chat格式中的固定开销（role和分隔符）
+MESSAGE_OVERHEAD = 4
+
+
+class PromptBuilder:
+    """
+    按token预算组装各Agent的提示词中的对话历史。优先级：系统规则和最新问题（必须保留）> 最近的对话（原文）
+    > 较早的对话（工具返回的大段数据换成摘要），预算用完后更早的消息丢弃。
+    每个会话的历史按消息增量预序列化并缓存token数，新一轮只处理新追加的消息。
+    """
+
+    def __init__(self, budgets=None, default_budget=8000, payload_tokens=300, tokenizer=None, max_sessions=1024):
+        """
+        :param budgets: {agent: 整个提示词的token预算}
+        :param payload_tokens: 超过该token数的消息视为工具返回数据，在较早的历史中换成摘要
+        """
+        self.budgets = dict(budgets or {})
+        self.default_budget = default_budget
+        self.payload_tokens = payload_tokens
+        self.tokenizer = tokenizer or Tokenizer()
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self.metrics = {
+            "builds": 0,
+            "messages_serialized": 0,
+            "messages_reused": 0,
+            "messages_summarized": 0,
+            "messages_dropped": 0,
+            "tokens_in": 0,
+            "tokens_out": 0,
+        }
+
+    def _session(self, session_id):
+        with self._lock:
+            history = self._sessions.get(session_id)
+            if history is None:
+                history = self._sessions[session_id] = _SessionHistory()
+                while len(self._sessions) > self.max_sessions:
+                    self._sessions.popitem(last=False)
+            self._sessions.move_to_end(session_id)
+            return history
+
+    def _sync(self, session_id, history):
+        """
+        把会话缓存的消息与当前历史对齐：前缀一致时只追加新消息；
+        否则（检索出的历史每轮不同、会话被压缩或重建）按 (role, 内容) 复用已序列化的消息
+        """
+        cached = self._session(session_id)
+        with cached.lock:
+            entries = cached.entries
+            n = len(entries)
+            if n > len(history) or (n and (entries[-1].role != history[n - 1].get("role")
+                                           or entries[-1].content != history[n - 1].get("content"))):
+                known = {(entry.role, entry.content): entry for entry in entries}
+                entries = cached.entries = []
+                n = 0
+            else:
+                known = {}
+            reused = n
+            for message in history[n:]:
+                content = message.get("content") or ""
+                entry = known.get((message.get("role"), content))
+                if entry is None:
+                    entry = _Entry(message.get("role"), content, self.tokenizer.count(content) > self.payload_tokens)
+                else:
+                    reused += 1
+                entries.append(entry)
+            self.metrics["messages_serialized"] += len(history) - reused
+            self.metrics["messages_reused"] += reused
+            return list(entries)
+
+    def _render(self, entry, fmt, summarized):
+        key = (fmt, summarized)
+        rendered = entry.rendered.get(key)
+        if rendered is None:
+            content = summarize_payload(entry.content) if summarized else entry.content
+            text = FORMATS[fmt](entry.role, content)
+            rendered = entry.rendered[key] = (content, text, self.tokenizer.count(text) + MESSAGE_OVERHEAD)
+        return rendered
+
+    def fit(self, session_id, history, agent, fmt, reserved_text=""):
+        """
+        选出放进提示词的历史消息
+        :param fmt: "json"、"lines" 或 "messages"
+        :param reserved_text: 必须保留的部分（系统规则、提示词模板、最新问题），先从预算中扣除
+        :return: 按时间顺序排列的 (role, 内容, 序列化文本) 列表
+        """
+        budget = self.budgets.get(agent, self.default_budget) - self.tokenizer.count(reserved_text)
+        entries = self._sync(session_id, history)
+        selected = []
+        summarizing = False
+        tokens_in = 0
+        for entry in reversed(entries):
+            full = self._render(entry, fmt, False)
+            tokens_in += full[2]
+            if not summarizing and full[2] <= budget:
+                selected.append((entry.role, *full))
+                budget -= full[2]
+                continue
+            # 最近的对话放不下时开始压缩：更早的工具数据只保留摘要
+            summarizing = True
+            candidate = self._render(entry, fmt, True) if entry.payload else full
+            if candidate[2] <= budget:
+                selected.append((entry.role, *candidate))
+                budget -= candidate[2]
+                if entry.payload:
+                    self.metrics["messages_summarized"] += 1
+            else:
+                self.metrics["messages_dropped"] += 1
+        selected.reverse()
+        self.metrics["builds"] += 1
+        self.metrics["tokens_in"] += tokens_in
+        self.metrics["tokens_out"] += sum(tokens for _, _, _, tokens in selected)
+        return [(role, content, text) for role, content, text, _ in selected]
+
+    def history_json(self, session_id, history, agent, reserved_text=""):
+        """上下文检测用：JSON数组文本"""
+        items = self.fit(session_id, history, agent, "json", reserved_text)
+        return "[\n" + ",\n".join(text for _, _, text in items) + "\n]"
+
+    def history_lines(self, session_id, history, agent, reserved_text=""):
+        """计划生成用：每行一条 role: content"""
+        return "".join(text + "\n" for _, _, text in self.fit(session_id, history, agent, "lines", reserved_text))
+
+    def history_messages(self, session_id, history, agent, reserved_text=""):
+        """直接作为chat messages使用"""
+        return [{"role": role, "content": content}
+                for role, content, _ in self.fit(session_id, history, agent, "messages", reserved_text)]
+
+    def invalidate(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def stats(self):
+        return {
+            **self.metrics,
+            "tokenizer": self.tokenizer.name,
+            "sessions": len(self._sessions),
+            "reduction": 1 - self.metrics["tokens_out"] / self.metrics["tokens_in"] if self.metrics["tokens_in"] else 0.0,
+        }
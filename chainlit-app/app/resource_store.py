@@ -0,0 +1,300 @@
+import datetime
+import json
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+from storage_codec import StorageCodec
+
+# FHIR资源在global中的存储结构（内容寻址，同一内容只存一份，经StorageCodec压缩，超长时分块）：
+#   ^FHIRResource(resourceType, id, versionId, 内容哈希) = 压缩后的资源JSON（保留原文的键顺序）
+#   ^FHIRResource("_payload", 内容哈希)                  = 压缩后的其它工具返回JSON（维护任务压缩旧会话时写入）
+# 同一版本的不同内容（_summary、_elements等部分读取的结果）按内容哈希分别存放。
+# 资源没有 meta.versionId 时以内容哈希作为versionId（"c"前缀），没有id时以内容哈希作为id。
+# 对话历史中被替换的JSON段写成 {"$fhirstore:segment": [原文格式, 替换后的JSON]}，其中的资源本体写成
+# {"$fhirstore:ref": "Patient/794/_history/3/<哈希>"} 或 {"$fhirstore:ref": "_payload/<哈希>"}；
+# 还原时按原文格式序列化，与替换前的文本逐字节相同。
+# 每项内容最近一次被写入的消息引用的日期（UTC，yyyy-mm-dd），维护任务不回收近期使用过的内容：
+#   ^FHIRResourceUse(与^FHIRResource相同的下标) = 日期
+SEGMENT_KEY = "$fhirstore:segment"
+REF_KEY = "$fhirstore:ref"
+PAYLOAD = "_payload"
+# JSON段原文的序列化格式（json.dumps的参数）；原文不是其中任何一种（数字写法不同、有多余空白等）时不替换
+_LAYOUTS = {
+    "compact": {"separators": (",", ":")},
+    "default": {},
+    "indent2": {"indent": 2},
+    "indent4": {"indent": 4},
+}
+FORMATS = {
+    **{name: {**options, "ensure_ascii": False} for name, options in _LAYOUTS.items()},
+    **{name + "_ascii": {**options, "ensure_ascii": True} for name, options in _LAYOUTS.items()},
+}
+REF_PATTERN = re.compile(re.escape(json.dumps(REF_KEY)) + r':"([^"\\]+)"')
+
+
+def _content_hash(data: bytes) -> str:
+    return "c" + hashlib.blake2b(data, digest_size=12).hexdigest()
+
+
+def _serialize(obj) -> bytes:
+    """存储用的紧凑JSON，保留键顺序（还原后与原文相同）"""
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def iter_refs(text):
+    """dehydrate 替换后的文本中引用的资源和载荷"""
+    return REF_PATTERN.findall(text or "")
+
+
+def _today():
+    return datetime.datetime.utcnow().date().isoformat()
+
+
+def _source_format(source, obj):
+    """原文对应的序列化格式名，不是FORMATS中的格式时返回None"""
+    indented = "\n" in source
+    for name, options in FORMATS.items():
+        if ("indent" in options) == indented and json.dumps(obj, **options) == source:
+            return name
+    return None
+
+
+class FHIRResourceStore:
+    """
+    对话历史中FHIR资源的内容寻址存储。
+    dehydrate 把消息文本中的FHIR资源/Bundle JSON换成引用并写入存储（已存在的内容不重复写），
+    hydrate 把引用还原为资源，得到与原文逐字节相同的文本。同一进程内所有IRIS连接共享一个实例，调用时传入当前线程的iris对象。
+    资源版本不可变，已读取的资源在进程内按LRU缓存，无需失效。
+    """
+
+    def __init__(self, global_name="FHIRResource", max_cached=2048, codec=None):
+        self.global_name = global_name
+        self.use_name = global_name + "Use"
+        self.max_cached = max_cached
+        # 单个资源通常只有几KB，压缩阈值比会话消息低
+        self.codec = codec or StorageCodec(threshold=256)
+        self._resources = OrderedDict()
+        self._lock = threading.Lock()
+        self._decoder = json.JSONDecoder()
+        # 本进程当天已登记使用日期的引用
+        self._used_day = None
+        self._used = set()
+        self.metrics = {
+            "stored": 0,
+            "deduplicated": 0,
+            "bytes_raw": 0,
+            "resolved": 0,
+            "missing": 0,
+            "unknown_format": 0,
+        }
+
+    def _remember(self, ref, resource):
+        with self._lock:
+            self._resources[ref] = resource
+            self._resources.move_to_end(ref)
+            while len(self._resources) > self.max_cached:
+                self._resources.popitem(last=False)
+
+    def _recall(self, ref):
+        with self._lock:
+            resource = self._resources.get(ref)
+            if resource is not None:
+                self._resources.move_to_end(ref)
+            return resource
+
+    def _exists(self, iris, ref, subscripts):
+        """
+        登记内容当天被使用并检查内容是否存在（每个进程每天每项只访问一次IRIS）。
+        先登记再检查：与维护任务的回收交错时，要么维护任务看到新的日期而保留或恢复内容，要么这里看到内容已删除而重新写入
+        """
+        today = _today()
+        with self._lock:
+            if self._used_day != today:
+                self._used_day, self._used = today, set()
+            if ref in self._used:
+                return True
+            self._used.add(ref)
+        iris.set(today, self.use_name, *subscripts)
+        return bool(iris.isDefined(self.global_name, *subscripts))
+
+    def put(self, iris, resource: dict) -> str:
+        """存储单个资源，返回 resourceType/id/_history/versionId/内容哈希 形式的引用"""
+        data = _serialize(resource)
+        digest = _content_hash(data)
+        resource_type = resource["resourceType"]
+        resource_id = str(resource.get("id") or digest)
+        version_id = str((resource.get("meta") or {}).get("versionId") or digest)
+        ref = f"{resource_type}/{resource_id}/_history/{version_id}/{digest}"
+        subscripts = (resource_type, resource_id, version_id, digest)
+        if self._exists(iris, ref, subscripts):
+            self.metrics["deduplicated"] += 1
+        else:
+            self.codec.write(iris, data.decode("utf-8"), self.global_name, *subscripts)
+            self.metrics["stored"] += 1
+            self.metrics["bytes_raw"] += len(data)
+        self._remember(ref, resource)
+        return ref
+
+    def put_payload(self, iris, payload) -> str:
+        """存储任意JSON载荷（按内容哈希去重），返回 _payload/<哈希> 形式的引用"""
+        data = _serialize(payload)
+        digest = _content_hash(data)
+        ref = f"{PAYLOAD}/{digest}"
+        if self._exists(iris, ref, (PAYLOAD, digest)):
+            self.metrics["deduplicated"] += 1
+        else:
+            self.codec.write(iris, data.decode("utf-8"), self.global_name, PAYLOAD, digest)
+            self.metrics["stored"] += 1
+            self.metrics["bytes_raw"] += len(data)
+        self._remember(ref, payload)
+        return ref
+
+    def get(self, iris, ref: str):
+        """按引用读取资源，不存在时返回None"""
+        resource = self._recall(ref)
+        if resource is not None:
+            return resource
+        if ref.startswith(PAYLOAD + "/"):
+            subscripts = (PAYLOAD, ref[len(PAYLOAD) + 1:])
+        else:
+            resource_type, resource_id, _, version_id, digest = ref.split("/")
+            subscripts = (resource_type, resource_id, version_id, digest)
+        stored = iris.get(self.global_name, *subscripts)
+        if not stored:
+            self.metrics["missing"] += 1
+            return None
+        resource = json.loads(self.codec.read(iris, stored, self.global_name, *subscripts))
+        self.metrics["resolved"] += 1
+        self._remember(ref, resource)
+        return resource
+
+    def iter_stored(self, iris):
+        """迭代存储中的全部内容，返回 (引用, 下标)"""
+        for resource_type in list(iris.iterator(self.global_name).subscripts()):
+            if resource_type == PAYLOAD:
+                for digest in list(iris.iterator(self.global_name, PAYLOAD).subscripts()):
+                    yield f"{PAYLOAD}/{digest}", (PAYLOAD, digest)
+                continue
+            for resource_id in list(iris.iterator(self.global_name, resource_type).subscripts()):
+                for version_id in list(iris.iterator(self.global_name, resource_type, resource_id).subscripts()):
+                    for digest in list(iris.iterator(self.global_name, resource_type, resource_id,
+                                                     version_id).subscripts()):
+                        yield (f"{resource_type}/{resource_id}/_history/{version_id}/{digest}",
+                               (resource_type, resource_id, version_id, digest))
+
+    def sweep(self, iris, subscripts, used_before):
+        """
+        回收一项已确认没有会话消息引用的内容（维护任务标记-清除的清除阶段）。
+        使用日期不早于used_before的保留；删除后发现使用日期有变化（期间有消息引用了该内容）时恢复。
+        :param used_before: 日期（yyyy-mm-dd），不能晚于当天
+        :return: 是否删除
+        """
+        used = iris.get(self.use_name, *subscripts)
+        if used is not None and used >= used_before:
+            return False
+        value = self.codec.get(iris, self.global_name, *subscripts)
+        iris.kill(self.global_name, *subscripts)
+        if iris.get(self.use_name, *subscripts) != used:
+            if value is not None:
+                self.codec.write(iris, value, self.global_name, *subscripts)
+            return False
+        iris.kill(self.use_name, *subscripts)
+        return True
+
+    def _to_refs(self, iris, resource):
+        """Bundle只保留外壳，entry中的资源换成引用；其它资源整体换成引用"""
+        if resource.get("resourceType") == "Bundle":
+            shell = dict(resource)
+            entries = []
+            for entry in resource.get("entry") or []:
+                if isinstance(entry, dict) and isinstance(entry.get("resource"), dict) \
+                        and entry["resource"].get("resourceType"):
+                    entry = {**entry, "resource": self._to_refs(iris, entry["resource"])}
+                entries.append(entry)
+            if entries:
+                shell["entry"] = entries
+            return shell
+        return {REF_KEY: self.put(iris, resource)}
+
+    def _from_refs(self, iris, obj):
+        if isinstance(obj, dict):
+            if len(obj) == 1 and isinstance(obj.get(REF_KEY), str):
+                return self.get(iris, obj[REF_KEY]) or obj
+            return {k: self._from_refs(iris, v) for k, v in obj.items()}
+        if isinstance(obj, list):
+            return [self._from_refs(iris, v) for v in obj]
+        return obj
+
+    def _json_segments(self, text):
+        """找出文本中以行首 '{' 开始的完整JSON对象，返回 (起始位置, 结束位置, 对象)"""
+        pos = 0
+        while True:
+            start = text.find("{", pos)
+            if start < 0:
+                return
+            if start > 0 and text[start - 1] != "\n":
+                pos = start + 1
+                continue
+            try:
+                obj, end = self._decoder.raw_decode(text, start)
+            except ValueError:
+                pos = start + 1
+                continue
+            yield start, end, obj
+            pos = end
+
+    def dehydrate(self, iris, text: str, collapse_min: int = None):
+        """
+        把文本中的FHIR资源JSON换成引用。
+        :param collapse_min: 指定时，长度不小于该值的其它JSON段也整体存为载荷并换成引用
+        :return: (替换后的文本, 替换的JSON段数)，没有可替换的内容时原样返回
+        """
+        if "resourceType" not in text and (collapse_min is None or len(text) < collapse_min):
+            return text, 0
+        parts, pos, count = [], 0, 0
+        for start, end, obj in self._json_segments(text):
+            resource = isinstance(obj, dict) and "resourceType" in obj
+            if not resource and (collapse_min is None or end - start < collapse_min):
+                continue
+            source = text[start:end]
+            # 已替换过的段（维护任务再次压缩时）和恰好含有标记键的原文不处理
+            if SEGMENT_KEY in source or REF_KEY in source:
+                continue
+            source_format = _source_format(source, obj)
+            if source_format is None:
+                self.metrics["unknown_format"] += 1
+                continue
+            replacement = self._to_refs(iris, obj) if resource else {REF_KEY: self.put_payload(iris, obj)}
+            parts.append(text[pos:start])
+            parts.append(json.dumps({SEGMENT_KEY: [source_format, replacement]},
+                                    ensure_ascii=False, separators=(",", ":")))
+            pos = end
+            count += 1
+        if not count:
+            return text, 0
+        parts.append(text[pos:])
+        return "".join(parts), count
+
+    def hydrate(self, iris, text: str) -> str:
+        """把 dehydrate 替换的JSON段还原为原文，其它内容不变"""
+        if SEGMENT_KEY not in text:
+            return text
+        parts, pos = [], 0
+        for start, end, obj in self._json_segments(text):
+            segment = obj.get(SEGMENT_KEY) if isinstance(obj, dict) and len(obj) == 1 else None
+            if not isinstance(segment, list) or len(segment) != 2 or segment[0] not in FORMATS:
+                continue
+            source_format, replacement = segment
+            parts.append(text[pos:start])
+            parts.append(json.dumps(self._from_refs(iris, replacement), **FORMATS[source_format]))
+            pos = end
+        parts.append(text[pos:])
+        return "".join(parts)
+
+    def stats(self):
+        return {
+            **self.metrics,
+            "cached": len(self._resources),
+            "codec": self.codec.stats(),
+        }
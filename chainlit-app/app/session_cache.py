@@ -0,0 +1,154 @@
+import threading
+from collections import OrderedDict
+from history_index import HistoryIndex
+
+
+class CachedSession:
+    """缓存的会话：IRIS中的版本号、会话头、(seq, 消息字典) 列表和历史检索索引（首次检索时建立）"""
+    __slots__ = ("version", "header", "last_updated", "items", "size", "index")
+
+    def __init__(self, version, header, last_updated, items, size):
+        self.version = version
+        self.header = header
+        self.last_updated = last_updated
+        self.items = items
+        self.size = size
+        self.index = None
+
+    def to_doc(self):
+        """组装成 get_session 返回的文档（history为新列表，消息字典与缓存共享，只读）"""
+        return {**self.header, "history": [m for _, m in self.items], "last_updated": self.last_updated}
+
+
+class SessionCache:
+    """
+    进程内的会话读缓存（按字节数限制容量，LRU淘汰），同一进程的所有IRIS连接共享。
+    每个会话在IRIS中有版本号 ^ChatSession(sid,"v")，任何进程写入都会递增；
+    读取时先取版本号，与缓存一致才使用本地副本，多个Chainlit进程之间因此保持一致。
+    """
+
+    def __init__(self, max_bytes: int = 16 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.metrics = {
+            "hits": 0,
+            "misses": 0,
+            "stale": 0,
+            "updates": 0,
+            "evictions": 0,
+        }
+
+    def get(self, session_id, version):
+        """返回与IRIS版本号一致的缓存会话，否则返回None（过期条目同时删除）"""
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None:
+                self.metrics["misses"] += 1
+                return None
+            if entry.version != version:
+                self._remove(session_id)
+                self.metrics["stale"] += 1
+                return None
+            self._entries.move_to_end(session_id)
+            self.metrics["hits"] += 1
+            return entry
+
+    def put(self, session_id, version, header, last_updated, items, size):
+        if version is None or size > self.max_bytes // 4:
+            return
+        with self._lock:
+            self._remove(session_id)
+            self._entries[session_id] = CachedSession(version, header, last_updated, items, size)
+            self._bytes += size
+            self._evict()
+
+    def apply_append(self, session_id, version, items, size, last_updated):
+        """
+        本进程追加消息后增量更新缓存：只有缓存版本正好是写入前的版本（version-1）时才能追加，
+        否则说明期间有其它进程写入，直接丢弃条目，下次读取时重新加载
+        """
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None:
+                return
+            # 同一进程内并发写入同一会话时序号可能与版本号顺序不一致，同样丢弃
+            if entry.version != version - 1 or (entry.items and items[0][0] <= entry.items[-1][0]):
+                self._remove(session_id)
+                return
+            entry.items = entry.items + items
+            entry.version = version
+            entry.last_updated = last_updated
+            # 已建立检索索引的会话随追加增量更新索引
+            if entry.index is not None:
+                for seq, message in items:
+                    size += entry.index.add(seq, message.get("content"))
+            entry.size += size
+            self._bytes += size
+            self.metrics["updates"] += 1
+            self._evict()
+
+    def apply_meta(self, session_id, version, header, last_updated):
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None:
+                return
+            if entry.version != version - 1:
+                self._remove(session_id)
+                return
+            entry.header = header
+            entry.version = version
+            entry.last_updated = last_updated
+            self.metrics["updates"] += 1
+
+    def search(self, session_id, version, query, k, before=None, after=0):
+        """
+        在缓存会话的历史中检索与query最相关的k条消息，返回 [(seq, 消息字典)]；
+        缓存中没有该版本的会话时返回None。索引在首次检索时建立并计入缓存容量。
+        """
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None or entry.version != version:
+                return None
+            if entry.index is None:
+                entry.index = HistoryIndex()
+                for seq, message in entry.items:
+                    entry.index.add(seq, message.get("content"))
+                entry.size += entry.index.size
+                self._bytes += entry.index.size
+            seqs = entry.index.search(query, k, before, after)
+            messages = dict(entry.items) if seqs else {}
+            result = [(seq, messages[seq]) for seq in seqs]
+            self._evict()
+            return result
+
+    def invalidate(self, session_id=None):
+        """删除指定会话的缓存，不传session_id时清空"""
+        with self._lock:
+            if session_id is None:
+                self._entries.clear()
+                self._bytes = 0
+            else:
+                self._remove(session_id)
+
+    def _remove(self, session_id):
+        entry = self._entries.pop(session_id, None)
+        if entry is not None:
+            self._bytes -= entry.size
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and self._entries:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= evicted.size
+            self.metrics["evictions"] += 1
+
+    def stats(self):
+        lookups = self.metrics["hits"] + self.metrics["misses"] + self.metrics["stale"]
+        return {
+            **self.metrics,
+            "hit_rate": self.metrics["hits"] / lookups if lookups else 0.0,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+        }
@@ -0,0 +1,124 @@
+import asyncio
+import time
+from collections import deque
+
+
+class SpeculativeTask:
+    """
+    推测执行的一次LLM调用：创建即开始执行，之后根据判断结果 result() 采用，或 discard() 取消丢弃。
+    调用方的协程函数接收一个trace字典，记录已收到的token块数(chunks)和接口返回的用量(usage)。
+    """
+
+    def __init__(self, call, track_usage=True):
+        """
+        :param call: 协程函数 call(trace)
+        :param track_usage: 服务商是否返回token用量；为False时不统计这次调用的token
+        """
+        self.track_usage = track_usage
+        self.trace = {"chunks": 0}
+        self.started = time.perf_counter()
+        self.finished = None
+        self.task = asyncio.ensure_future(call(self.trace))
+        self.task.add_done_callback(self._on_done)
+
+    def _on_done(self, task):
+        self.finished = time.perf_counter()
+
+    async def result(self):
+        return await self.task
+
+    async def discard(self):
+        """取消尚未完成的调用，已完成的结果直接丢弃；返回调用时是否已经完成"""
+        done = self.task.done()
+        if not done:
+            self.task.cancel()
+            # 等待取消完成；只有调用方自身被取消时才抛出CancelledError
+            await asyncio.wait([self.task])
+        if not self.task.cancelled():
+            # 推测调用本身出错时结果同样不再需要，取出异常避免"exception was never retrieved"
+            self.task.exception()
+        return done
+
+    def tokens(self):
+        """
+        本次调用消耗的token：有接口返回的用量时使用，否则以已收到的块数估算输出token（输入token记为0）；
+        服务商不返回用量时返回 (0, 0)，不计入统计
+        """
+        if not self.track_usage:
+            return 0, 0
+        usage = self.trace.get("usage")
+        if usage:
+            return usage["prompt_tokens"], usage["completion_tokens"]
+        return 0, self.trace["chunks"]
+
+
+class SpeculationStats:
+    """
+    推测执行计划生成的统计与开关：记录推测比例、被采用/丢弃的次数、丢弃浪费的token和节省的时间。
+    最近 window 轮中丢弃比例超过 max_discard_rate 时暂停推测（仍每 window 轮试探一次），
+    以便按部署情况在延迟与成本之间取舍。
+    """
+
+    def __init__(self, enabled=True, max_discard_rate=1.0, window=50):
+        self.enabled = enabled
+        self.max_discard_rate = max_discard_rate
+        self._recent = deque(maxlen=window)
+        self._skipped = 0
+        self.metrics = {
+            "turns": 0,
+            "speculated": 0,
+            "used": 0,
+            "discarded": 0,
+            "cancelled": 0,
+            "wasted_prompt_tokens": 0,
+            "wasted_completion_tokens": 0,
+            "used_prompt_tokens": 0,
+            "used_completion_tokens": 0,
+            "saved_seconds": 0.0,
+        }
+
+    def should_speculate(self):
+        """开始一轮对话时调用，决定本轮是否推测执行"""
+        self.metrics["turns"] += 1
+        if not self.enabled:
+            return False
+        if len(self._recent) == self._recent.maxlen and \
+                sum(self._recent) / len(self._recent) > self.max_discard_rate:
+            self._skipped += 1
+            if self._skipped < self._recent.maxlen:
+                return False
+        self._skipped = 0
+        self.metrics["speculated"] += 1
+        return True
+
+    def record_used(self, speculative: SpeculativeTask, decided):
+        """
+        推测结果被采用
+        :param decided: 上下文判断完成的时间（perf_counter），此前计划生成已经进行的时间即为节省的时间
+        """
+        prompt_tokens, completion_tokens = speculative.tokens()
+        self.metrics["used"] += 1
+        self.metrics["used_prompt_tokens"] += prompt_tokens
+        self.metrics["used_completion_tokens"] += completion_tokens
+        self.metrics["saved_seconds"] += max(0.0, min(speculative.finished or decided, decided) - speculative.started)
+        self._recent.append(0)
+
+    async def discard(self, speculative: SpeculativeTask):
+        """推测结果不被采用（上下文判断可以直接回答或判断出错），丢弃并记录浪费的token"""
+        done = await speculative.discard()
+        prompt_tokens, completion_tokens = speculative.tokens()
+        self.metrics["discarded"] += 1
+        if not done:
+            self.metrics["cancelled"] += 1
+        self.metrics["wasted_prompt_tokens"] += prompt_tokens
+        self.metrics["wasted_completion_tokens"] += completion_tokens
+        self._recent.append(1)
+
+    def stats(self):
+        turns = self.metrics["turns"]
+        speculated = self.metrics["speculated"]
+        return {
+            **self.metrics,
+            "speculation_rate": speculated / turns if turns else 0.0,
+            "discard_rate": self.metrics["discarded"] / speculated if speculated else 0.0,
+        }
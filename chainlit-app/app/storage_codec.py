@@ -0,0 +1,144 @@
+import threading
+import time
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# 超过阈值的值压缩后按块存放在子下标中，结点本身只保存描述符：
+#   ^G(subs)      = "\x1b<算法>:<块数>:<原始字节数>[:<起始块号>]"
+#   ^G(subs, i)   = 第i块压缩数据（按块顺序拼接为一个完整的压缩流）
+# 块号默认从1开始；覆盖写入时新块先写在与旧块不重叠的块号上，再切换描述符、删除旧块，
+# 并发的读取方任何时刻都能读到完整的旧值或新值。
+# 未超过阈值的值原样存放在结点上，JSON文本不会以 \x1b 开头，因此与旧数据兼容。
+MARKER = "\x1b"
+# IRIS单个字符串最长3641144个字符，留出余量
+MAX_CHUNK_BYTES = 3 * 1024 * 1024
+
+
+class StorageCodec:
+    """
+    global结点值的存储编解码：大值压缩（优先zstd，未安装时使用zlib）并分块，读取时逐块流式解压。
+    同一进程的所有IRIS连接共享一个实例，记录压缩比和压缩/解压耗时。
+    """
+
+    def __init__(self, algorithm=None, threshold=4096, chunk_size=MAX_CHUNK_BYTES, level=None):
+        """
+        :param algorithm: "zstd"、"zlib" 或 "none"（只分块不压缩），默认有zstd时用zstd
+        :param threshold: UTF-8编码后不小于该字节数的值才压缩
+        """
+        if algorithm is None:
+            algorithm = "zstd" if zstandard is not None else "zlib"
+        if algorithm == "zstd" and zstandard is None:
+            print("未安装zstandard，存储压缩改用zlib")
+            algorithm = "zlib"
+        self.algorithm = algorithm
+        self.threshold = threshold
+        self.chunk_size = min(chunk_size, MAX_CHUNK_BYTES)
+        self.level = level
+        self._lock = threading.Lock()
+        self.metrics = {
+            "compressed": 0,
+            "chunked": 0,
+            "bytes_raw": 0,
+            "bytes_stored": 0,
+            "compress_seconds": 0.0,
+            "decompressed": 0,
+            "decompress_seconds": 0.0,
+        }
+
+    def _record(self, **values):
+        with self._lock:
+            for name, value in values.items():
+                self.metrics[name] += value
+
+    def _compress(self, data: bytes) -> bytes:
+        if self.algorithm == "zstd":
+            return zstandard.ZstdCompressor(level=self.level or 3).compress(data)
+        if self.algorithm == "zlib":
+            return zlib.compress(data, self.level or 6)
+        return data
+
+    @staticmethod
+    def _decompressor(algorithm):
+        if algorithm == "zstd":
+            if zstandard is None:
+                raise RuntimeError("读取zstd压缩的数据需要安装zstandard")
+            return zstandard.ZstdDecompressor().decompressobj()
+        if algorithm == "zlib":
+            return zlib.decompressobj()
+        return None
+
+    @staticmethod
+    def _chunk_range(stored):
+        """描述符对应的块号范围，不是描述符时返回空范围"""
+        if not isinstance(stored, str) or not stored.startswith(MARKER):
+            return range(0)
+        fields = stored[1:].split(":")
+        first = int(fields[3]) if len(fields) > 3 else 1
+        return range(first, first + int(fields[1]))
+
+    def write(self, iris, value: str, global_name, *subscripts, overwrite=False):
+        """
+        写入一个值
+        :param overwrite: 结点原来可能存有分块数据时设为True，新值写好后再删除旧的块
+        """
+        old = self._chunk_range(iris.get(global_name, *subscripts)) if overwrite else range(0)
+        data = value.encode("utf-8")
+        if len(data) < self.threshold and len(data) <= self.chunk_size:
+            iris.set(value, global_name, *subscripts)
+        else:
+            start = time.perf_counter()
+            payload = data if len(data) < self.threshold else self._compress(data)
+            algorithm = "none" if payload is data else self.algorithm
+            chunks = [payload[i:i + self.chunk_size] for i in range(0, len(payload), self.chunk_size)]
+            # 与旧块重叠时写在旧块之后
+            first = 1 if not old or len(chunks) < old.start else old.stop
+            for i, chunk in enumerate(chunks, start=first):
+                iris.set(chunk, global_name, *subscripts, i)
+            descriptor = f"{MARKER}{algorithm}:{len(chunks)}:{len(data)}"
+            iris.set(descriptor if first == 1 else f"{descriptor}:{first}", global_name, *subscripts)
+            self._record(compressed=1 if algorithm != "none" else 0, chunked=1 if len(chunks) > 1 else 0,
+                         bytes_raw=len(data), bytes_stored=len(payload),
+                         compress_seconds=time.perf_counter() - start)
+        for i in old:
+            iris.kill(global_name, *subscripts, i)
+
+    def read(self, iris, stored, global_name, *subscripts):
+        """
+        由结点上读到的值还原原始值：普通值直接返回，描述符则逐块读取并流式解压
+        :param stored: 已经读到的结点值（如迭代器返回的值），None表示结点不存在
+        """
+        if not isinstance(stored, str) or not stored.startswith(MARKER):
+            return stored
+        algorithm = stored[1:].split(":")[0]
+        start = time.perf_counter()
+        decompressor = self._decompressor(algorithm)
+        parts = []
+        for i in self._chunk_range(stored):
+            chunk = iris.getBytes(global_name, *subscripts, i)
+            if chunk is None:
+                # 读到描述符之后结点被覆盖写入，旧块已删除：按新值重新读取
+                current = iris.get(global_name, *subscripts)
+                if current == stored:
+                    raise ValueError(f"^{global_name}{subscripts} 缺少第{i}块数据")
+                return self.read(iris, current, global_name, *subscripts)
+            parts.append(decompressor.decompress(chunk) if decompressor else chunk)
+        if decompressor is not None and hasattr(decompressor, "flush"):
+            parts.append(decompressor.flush())
+        self._record(decompressed=1, decompress_seconds=time.perf_counter() - start)
+        return b"".join(parts).decode("utf-8")
+
+    def get(self, iris, global_name, *subscripts):
+        """读取并还原一个结点的值，不存在时返回None"""
+        return self.read(iris, iris.get(global_name, *subscripts), global_name, *subscripts)
+
+    def stats(self):
+        return {
+            **self.metrics,
+            "algorithm": self.algorithm,
+            "compression_ratio": (self.metrics["bytes_raw"] / self.metrics["bytes_stored"]
+                                  if self.metrics["bytes_stored"] else 0.0),
+        }
@@ -0,0 +1,179 @@
+import asyncio
+import json
+import re
+import time
+from prompt_builder import summarize_payload
+
+SUMMARIZER_SYSTEM = "你是一个对话摘要Agent，只输出JSON格式"
+# 消息中出现的FHIR资源及其引用的资源（如Observation引用的Patient），用于按需调取原始消息
+RESOURCE_ID = re.compile(r'"resourceType"\s*:\s*"(\w+)"\s*,\s*"id"\s*:\s*"([^"]+)"')
+REFERENCE = re.compile(r'"reference"\s*:\s*"(\w+/[^"/]+)"')
+
+
+def _resource_refs(content):
+    refs = {f"{t}/{i}" for t, i in RESOURCE_ID.findall(content)}
+    refs.update(REFERENCE.findall(content))
+    return refs
+
+
+class ConversationSummarizer:
+    """
+    在后台维护会话的滚动摘要：每轮对话结束后，把最近 recent_messages 条之前、尚未摘要的消息交给LLM合并进摘要，
+    保存在会话头中（IRISContextManager.set_summary）。摘要结构：
+        {"upto": 已摘要到的消息序号, "summary": 整体摘要, "facts": [{"text": 要点, "sources": [消息序号]}],
+         "resources": {"Patient/794": [消息序号]}, "updated_at": ...}
+    Agent使用 摘要 + 检索出的相关消息 + 最近的消息（见 HistorySelector）。
+    """
+
+    def __init__(self, ctx, router, recent_messages=8, min_batch=8, pinned_messages=1, max_facts=40,
+                 max_message_chars=3000):
+        """
+        :param ctx: AsyncIRISContextManager
+        :param router: LLMRouter，使用其中的 summarizer 路由
+        :param recent_messages: 保留原文的最近消息条数
+        :param min_batch: 未摘要的较早消息达到该条数才更新摘要（减少LLM调用）
+        :param pinned_messages: 会话开头始终保留原文的消息条数（医生身份等）
+        """
+        self.ctx = ctx
+        self.router = router
+        self.recent_messages = recent_messages
+        self.min_batch = min_batch
+        self.pinned_messages = pinned_messages
+        self.max_facts = max_facts
+        self.max_message_chars = max_message_chars
+        self._running = {}
+        self._dirty = set()
+        self.metrics = {
+            "runs": 0,
+            "skipped": 0,
+            "failures": 0,
+            "messages_folded": 0,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "seconds": 0.0,
+        }
+
+    def schedule(self, session_id):
+        """轮次结束后调用，在后台更新摘要（不等待）；同一会话正在摘要时，结束后再检查一次"""
+        if session_id in self._running:
+            self._dirty.add(session_id)
+            return
+        task = asyncio.ensure_future(self._run(session_id))
+        self._running[session_id] = task
+        task.add_done_callback(lambda t: self._done(session_id, t))
+
+    def _done(self, session_id, task):
+        self._running.pop(session_id, None)
+        if not task.cancelled() and task.exception() is not None:
+            self.metrics["failures"] += 1
+            print(f"更新会话摘要失败: {task.exception()}")
+        if session_id in self._dirty:
+            self._dirty.discard(session_id)
+            self.schedule(session_id)
+
+    async def _run(self, session_id):
+        start = time.perf_counter()
+        try:
+            if not await self.summarize(session_id):
+                self.metrics["skipped"] += 1
+        finally:
+            self.metrics["seconds"] += time.perf_counter() - start
+
+    async def summarize(self, session_id):
+        """把较早的未摘要消息合并进摘要，返回是否更新"""
+        summary = await self.ctx.get_summary(session_id) or {}
+        upto = max(summary.get("upto", 0), self.pinned_messages)
+        end = await self.ctx.get_history_length(session_id) - self.recent_messages
+        if end - upto < self.min_batch:
+            return False
+        records = await self.ctx.get_history_range(session_id, upto + 1, end + 1)
+        if not records:
+            return False
+        result = await self._call_llm(summary, records)
+        resources = {ref: list(seqs) for ref, seqs in (summary.get("resources") or {}).items()}
+        for record in records:
+            for ref in _resource_refs(record.content or ""):
+                resources.setdefault(ref, []).append(record.seq)
+        seqs = {record.seq for record in records} | set(range(1, upto + 1))
+        facts = (summary.get("facts") or []) + [
+            {"text": fact.get("text", ""), "sources": [s for s in fact.get("sources") or [] if s in seqs]}
+            for fact in result.get("facts") or [] if isinstance(fact, dict)
+        ]
+        new_summary = {
+            "upto": records[-1].seq,
+            "summary": result.get("summary") or summary.get("summary", ""),
+            "facts": facts[-self.max_facts:],
+            "resources": resources,
+            "updated_at": records[-1].ts,
+        }
+        saved = await self.ctx.set_summary(session_id, new_summary)
+        if saved:
+            self.metrics["runs"] += 1
+            self.metrics["messages_folded"] += len(records)
+        return saved
+
+    def _format_message(self, record):
+        content = record.content or ""
+        if len(content) > self.max_message_chars:
+            content = summarize_payload(content, head_chars=self.max_message_chars)
+        return f"#{record.seq} {record.role}: {content}"
+
+    async def _call_llm(self, summary, records):
+        previous = ""
+        if summary.get("summary"):
+            previous = summary["summary"] + "\n" + "\n".join(
+                f"- {fact['text']} (来源: {fact['sources']})" for fact in summary.get("facts") or [])
+        prompt = f"""
+请把门诊对话中较早的消息合并进已有的对话摘要，供后续对话使用。输出JSON格式：
+
+{{
+  "summary": "更新后的整体摘要：涉及的患者、医生关注的问题、已得出的结论",
+  "facts": [{{"text": "新消息中的关键事实（患者基本信息、诊断、检查结果、用药、费用、结论等，保留具体数值）", "sources": [来源消息序号]}}]
+}}
+
+要求：
+1. facts只包含新消息中的内容，每条都要用sources标出依据的消息序号（#后的数字）。
+2. 不要描述FHIR协议、资源格式、审计信息等技术细节，绝不允许编造数据。
+
+### 已有摘要：
+{previous or "（无）"}
+
+### 新消息：
+{chr(10).join(self._format_message(record) for record in records)}
+"""
+        client, llm_model = self.router.route("summarizer")
+        response = await client.chat.completions.create(
+            model=llm_model,
+            messages=[
+                {"role": "system", "content": SUMMARIZER_SYSTEM},
+                {"role": "user", "content": prompt}
+            ],
+            temperature=0.01,
+            response_format={"type": "json_object"}
+        )
+        if response.usage is not None:
+            self.metrics["prompt_tokens"] += response.usage.prompt_tokens
+            self.metrics["completion_tokens"] += response.usage.completion_tokens
+        content = response.choices[0].message.content or ""
+        try:
+            result = json.loads(content[content.find("{"):])
+        except ValueError:
+            # 模型没有按JSON输出时整体作为摘要文本
+            result = {"summary": content, "facts": []}
+        return result if isinstance(result, dict) else {"summary": str(result), "facts": []}
+
+    @staticmethod
+    def render(summary):
+        """摘要转换为放入Agent提示词的消息文本"""
+        lines = [f"[较早对话的摘要：覆盖到第{summary['upto']}条消息，#n为原始消息序号]", summary.get("summary", "")]
+        if summary.get("facts"):
+            lines.append("要点：")
+            lines.extend(f"- {fact['text']}" + (f" (#{', #'.join(map(str, fact['sources']))})" if fact.get("sources") else "")
+                         for fact in summary["facts"])
+        if summary.get("resources"):
+            lines.append("已查询过的资源：" + "，".join(
+                f"{ref}(#{seqs[-1]})" for ref, seqs in list(summary["resources"].items())[-30:]))
+        return "\n".join(lines)
+
+    def stats(self):
+        return {**self.metrics, "running": len(self._running)}
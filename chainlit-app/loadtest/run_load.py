@@ -0,0 +1,345 @@
+"""
+Chainlit Agent流水线多会话压测工具。
+在同一进程内模拟N个并发的医生会话，每个会话按scenarios.json中的脚本逐轮调用真实的on_chat_start/on_message，
+LLM和MCP分别指向本地桩服务（stub_llm.py、stub_mcp_server.py），IRIS上下文存储使用.env中配置的真实IRIS。
+输出每轮对话耗时分布、事件循环延迟以及每会话的内存增长。
+
+用法（在chainlit-app/app目录下执行，以便加载.env和.chainlit配置）：
+    python ../loadtest/run_load.py --sessions 50 --ramp 10 --token-latency-ms 20
+--processes N 时把会话平均分给N个独立进程（模拟多worker部署，共用桩服务和IRIS），汇总各进程的结果。
+"""
+import argparse
+import asyncio
+import gc
+import importlib
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+LOADTEST_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.join(os.path.dirname(LOADTEST_DIR), "app")
+
+
+def percentile(values, pct):
+    """线性插值计算百分位数"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * pct / 100
+    lo = int(k)
+    hi = min(lo + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+
+def summarize(values):
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values) if values else 0.0,
+        "p50": percentile(values, 50),
+        "p90": percentile(values, 90),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": max(values) if values else 0.0,
+    }
+
+
+def current_rss_bytes():
+    """读取当前进程常驻内存（仅Linux，其它平台返回0）"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+
+class LoopLagMonitor:
+    """周期性休眠并记录实际唤醒时间与期望时间之差，即事件循环延迟"""
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.samples = []
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.samples.append((loop.time() - start - self.interval) * 1000)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+
+class Metrics:
+    def __init__(self):
+        self.turns = []
+        self.errors = []
+        self.sessions_done = 0
+
+
+async def run_session(idx, app, scenario, args, metrics):
+    """模拟一个医生会话：建立chainlit上下文、连接MCP、按脚本逐轮提问"""
+    import chainlit as cl
+    from chainlit.context import init_http_context
+    from chainlit.user_session import user_sessions
+    from mcp import ClientSession
+    from mcp.client.sse import sse_client
+
+    await asyncio.sleep(args.ramp * idx / max(args.sessions, 1))
+    context = init_http_context()
+    try:
+        async with sse_client(args.mcp_url) as (read, write):
+            async with ClientSession(read, write) as session:
+                await session.initialize()
+                await app.on_mcp_connect(SimpleNamespace(name="stub-mcp"), session)
+                await app.on_chat_start()
+                for _ in range(args.repeat):
+                    for turn in scenario["turns"]:
+                        start = time.perf_counter()
+                        try:
+                            await app.on_message(cl.Message(content=turn["question"]))
+                        except Exception as e:
+                            metrics.errors.append(f"会话{idx}[{scenario['name']}] {turn['question']}: {e!r}")
+                            continue
+                        metrics.turns.append({
+                            "session": idx,
+                            "scenario": scenario["name"],
+                            "question": turn["question"],
+                            "latency_ms": (time.perf_counter() - start) * 1000,
+                        })
+                        if args.think_time:
+                            await asyncio.sleep(random.uniform(0, 2 * args.think_time))
+    except Exception as e:
+        metrics.errors.append(f"会话{idx}[{scenario['name']}] 建立失败: {e!r}")
+    finally:
+        # 模拟浏览器断开：释放chainlit为该会话保存的内存状态
+        user_sessions.pop(context.session.id, None)
+        metrics.sessions_done += 1
+
+
+def spawn_stubs(args):
+    """以子进程方式启动桩LLM与桩MCP服务，避免其占用被测进程的事件循环"""
+    python = sys.executable
+    llm = subprocess.Popen([
+        python, os.path.join(LOADTEST_DIR, "stub_llm.py"),
+        "--port", str(args.llm_port),
+        "--scenarios", args.scenarios,
+        "--ttft-ms", str(args.ttft_ms),
+        "--token-latency-ms", str(args.token_latency_ms),
+        "--answer-tokens", str(args.answer_tokens),
+    ])
+    mcp = subprocess.Popen([
+        python, os.path.join(LOADTEST_DIR, "stub_mcp_server.py"),
+        "--port", str(args.mcp_port),
+        "--latency-ms", str(args.tool_latency_ms),
+    ])
+    return [llm, mcp]
+
+
+async def wait_for_port(port, timeout=15):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"等待端口{port}就绪超时")
+
+
+def load_app(args):
+    """导入真实的Chainlit应用模块，并将其LLM客户端指向桩LLM服务"""
+    from openai import AsyncOpenAI
+
+    sys.path.insert(0, APP_DIR)
+    app = importlib.import_module(args.app)
+    app.router.override_client(AsyncOpenAI(api_key="stub", base_url=f"http://127.0.0.1:{args.llm_port}/v1"))
+    return app
+
+
+async def main_async(args):
+    with open(args.scenarios, encoding="utf-8") as f:
+        scenarios = json.load(f)
+
+    stubs = spawn_stubs(args) if args.spawn_stubs else []
+    try:
+        await wait_for_port(args.llm_port)
+        await wait_for_port(args.mcp_port)
+        app = load_app(args)
+
+        if args.tracemalloc:
+            tracemalloc.start()
+        gc.collect()
+        rss_before = current_rss_bytes()
+        traced_before = tracemalloc.get_traced_memory()[0] if args.tracemalloc else 0
+
+        metrics = Metrics()
+        monitor = LoopLagMonitor()
+        monitor.start()
+        started = time.perf_counter()
+        await asyncio.gather(*[
+            run_session(i, app, scenarios[i % len(scenarios)], args, metrics)
+            for i in range(args.sessions)
+        ])
+        elapsed = time.perf_counter() - started
+        rss_peak = current_rss_bytes()
+        await monitor.stop()
+
+        gc.collect()
+        rss_after = current_rss_bytes()
+        traced_after = tracemalloc.get_traced_memory()[0] if args.tracemalloc else 0
+    finally:
+        for proc in stubs:
+            proc.terminate()
+
+    latencies = [t["latency_ms"] for t in metrics.turns]
+    per_scenario = {}
+    for t in metrics.turns:
+        per_scenario.setdefault(t["scenario"], []).append(t["latency_ms"])
+    sessions = max(args.sessions, 1)
+    report = {
+        "sessions": args.sessions,
+        "elapsed_s": elapsed,
+        "turns_completed": len(latencies),
+        "turns_per_s": len(latencies) / elapsed if elapsed else 0.0,
+        "errors": metrics.errors,
+        "turn_latency_ms": summarize(latencies),
+        "turn_latency_ms_by_scenario": {k: summarize(v) for k, v in per_scenario.items()},
+        "event_loop_lag_ms": summarize(monitor.samples),
+        "memory": {
+            "rss_before_mb": rss_before / 2**20,
+            "rss_peak_mb": rss_peak / 2**20,
+            "rss_after_mb": rss_after / 2**20,
+            "rss_growth_per_session_kb": (rss_peak - rss_before) / sessions / 1024,
+            "rss_retained_per_session_kb": (rss_after - rss_before) / sessions / 1024,
+        },
+    }
+    if args.tracemalloc:
+        report["memory"]["traced_retained_per_session_kb"] = (traced_after - traced_before) / sessions / 1024
+    if args.raw:
+        report["raw"] = {"turns": metrics.turns, "loop_lag_ms": monitor.samples}
+    return report
+
+
+async def run_processes(args):
+    """启动 args.processes 个压测子进程（桩服务由本进程启动一次），合并各进程的报告"""
+    stubs = spawn_stubs(args) if args.spawn_stubs else []
+    reports = []
+    try:
+        await wait_for_port(args.llm_port)
+        await wait_for_port(args.mcp_port)
+        procs = []
+        for i in range(args.processes):
+            sessions = args.sessions // args.processes + (1 if i < args.sessions % args.processes else 0)
+            report_file = f"{args.report or 'load_report'}.worker{i}.json"
+            cmd = [sys.executable, os.path.abspath(__file__), "--no-spawn-stubs", "--raw",
+                   "--app", args.app, "--sessions", str(sessions), "--ramp", str(args.ramp),
+                   "--repeat", str(args.repeat), "--think-time", str(args.think_time),
+                   "--scenarios", args.scenarios, "--llm-port", str(args.llm_port),
+                   "--mcp-port", str(args.mcp_port), "--report", report_file]
+            procs.append((await asyncio.create_subprocess_exec(*cmd, stdout=subprocess.DEVNULL), report_file))
+        for proc, report_file in procs:
+            await proc.wait()
+            with open(report_file, encoding="utf-8") as f:
+                reports.append(json.load(f))
+            os.remove(report_file)
+    finally:
+        for proc in stubs:
+            proc.terminate()
+    return merge_reports(reports)
+
+
+def merge_reports(reports):
+    turns = [t for r in reports for t in r["raw"]["turns"]]
+    latencies = [t["latency_ms"] for t in turns]
+    per_scenario = {}
+    for t in turns:
+        per_scenario.setdefault(t["scenario"], []).append(t["latency_ms"])
+    elapsed = max(r["elapsed_s"] for r in reports)
+    sessions = sum(r["sessions"] for r in reports)
+    memory = {key: sum(r["memory"][key] for r in reports) for key in reports[0]["memory"] if key.endswith("_mb")}
+    memory.update({key: sum(r["memory"][key] * r["sessions"] for r in reports) / max(sessions, 1)
+                   for key in reports[0]["memory"] if key.endswith("_kb")})
+    return {
+        "sessions": sessions,
+        "processes": len(reports),
+        "elapsed_s": elapsed,
+        "turns_completed": len(latencies),
+        "turns_per_s": len(latencies) / elapsed if elapsed else 0.0,
+        "errors": [e for r in reports for e in r["errors"]],
+        "turn_latency_ms": summarize(latencies),
+        "turn_latency_ms_by_scenario": {k: summarize(v) for k, v in per_scenario.items()},
+        "event_loop_lag_ms": summarize([s for r in reports for s in r["raw"]["loop_lag_ms"]]),
+        "memory": memory,
+    }
+
+
+def print_report(report):
+    def line(name, s):
+        print(f"  {name:<24} n={s['count']:<6} mean={s['mean']:9.1f} p50={s['p50']:9.1f} p90={s['p90']:9.1f} "
+              f"p95={s['p95']:9.1f} p99={s['p99']:9.1f} max={s['max']:9.1f}")
+
+    if report.get("processes"):
+        print(f"\n进程数: {report['processes']}（内存为各进程之和）", end="")
+    print(f"\n并发会话: {report['sessions']}  耗时: {report['elapsed_s']:.1f}s  "
+          f"完成轮次: {report['turns_completed']}  吞吐: {report['turns_per_s']:.2f} 轮/秒")
+    print("每轮耗时(ms):")
+    line("全部", report["turn_latency_ms"])
+    for name, s in report["turn_latency_ms_by_scenario"].items():
+        line(name, s)
+    print("事件循环延迟(ms):")
+    line("loop lag", report["event_loop_lag_ms"])
+    print("内存:")
+    for k, v in report["memory"].items():
+        print(f"  {k:<32} {v:10.1f}")
+    if report["errors"]:
+        print(f"错误 {len(report['errors'])} 条，前5条：")
+        for err in report["errors"][:5]:
+            print(f"  {err}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chainlit Agent流水线多会话压测")
+    parser.add_argument("--app", default="app", help="被测的Chainlit应用模块名")
+    parser.add_argument("--sessions", type=int, default=10, help="并发会话数")
+    parser.add_argument("--ramp", type=float, default=5.0, help="所有会话在多少秒内逐步启动")
+    parser.add_argument("--repeat", type=int, default=1, help="每个会话重复执行脚本的次数")
+    parser.add_argument("--think-time", type=float, default=0.0, help="医生两次提问之间的平均思考时间（秒）")
+    parser.add_argument("--scenarios", default=os.path.join(LOADTEST_DIR, "scenarios.json"))
+    parser.add_argument("--no-spawn-stubs", dest="spawn_stubs", action="store_false", help="不自动启动桩服务（桩服务已单独运行）")
+    parser.add_argument("--llm-port", type=int, default=8101)
+    parser.add_argument("--mcp-port", type=int, default=8102)
+    parser.add_argument("--ttft-ms", type=float, default=300.0, help="桩LLM首token延迟（毫秒）")
+    parser.add_argument("--token-latency-ms", type=float, default=20.0, help="桩LLM逐token延迟（毫秒）")
+    parser.add_argument("--answer-tokens", type=int, default=120, help="桩LLM回答类输出token数")
+    parser.add_argument("--tool-latency-ms", type=float, default=80.0, help="桩MCP工具调用时延（毫秒）")
+    parser.add_argument("--tracemalloc", action="store_true", help="启用tracemalloc统计Python堆的保留内存（有额外开销）")
+    parser.add_argument("--report", help="将报告以JSON格式写入该文件")
+    parser.add_argument("--processes", type=int, default=1, help="压测进程数，模拟多worker部署")
+    parser.add_argument("--raw", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    args.mcp_url = f"http://127.0.0.1:{args.mcp_port}/sse"
+
+    report = asyncio.run(run_processes(args) if args.processes > 1 else main_async(args))
+    print_report(report)
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
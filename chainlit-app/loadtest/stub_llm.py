@@ -0,0 +1,174 @@
+"""
+本地OpenAI兼容的桩LLM服务，仅用于压测。
+根据system prompt识别调用方Agent（上下文检测、计划生成、回答），返回与scenarios.json匹配的结构化结果，
+并按配置的首字延迟和逐token延迟进行流式输出，模拟真实大模型的时延特征。
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import time
+import uuid
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# 计划和上下文判断结果按问题文本查找
+_PLANS = {}
+_CAN_ANSWER = {}
+_CONFIG = {
+    "ttft_ms": 300.0,
+    "token_latency_ms": 20.0,
+    "answer_tokens": 120,
+    "chars_per_token": 2,
+}
+
+_ANSWER_TEXT = "根据患者档案，患者生命体征平稳，近期血压控制良好，未见明显用药禁忌，建议继续按原方案治疗并定期复查。"
+# 问题锚点：上下文检测Agent和计划Agent的prompt中问题出现的位置
+_QUESTION_MARKERS = ("### 当前问题：", "用户最新问题：")
+
+
+def load_scenarios(path):
+    """从场景文件中加载各问题对应的计划和上下文判断结果"""
+    with open(path, encoding="utf-8") as f:
+        scenarios = json.load(f)
+    for scenario in scenarios:
+        for turn in scenario["turns"]:
+            question = turn["question"]
+            _CAN_ANSWER[question] = turn.get("can_answer", False)
+            if "plan" in turn:
+                _PLANS[question] = turn["plan"]
+
+
+def find_question(prompt):
+    """在prompt中问题锚点之后查找场景中的问题"""
+    for marker in _QUESTION_MARKERS:
+        pos = prompt.rfind(marker)
+        if pos < 0:
+            continue
+        tail = prompt[pos:]
+        for question in _CAN_ANSWER:
+            if question in tail:
+                return question
+    return None
+
+
+def build_reply(messages):
+    """按调用方Agent生成完整回复文本"""
+    system = messages[0]["content"] if messages and messages[0]["role"] == "system" else ""
+    prompt = messages[-1]["content"] if messages else ""
+    if not isinstance(prompt, str):
+        prompt = json.dumps(prompt, ensure_ascii=False)
+    question = find_question(prompt)
+
+    if "上下文判断助手" in system:
+        can_answer = _CAN_ANSWER.get(question, False)
+        return json.dumps({"can_answer": can_answer, "reasoning": "桩LLM按场景配置判断"}, ensure_ascii=False)
+    if "计划生成Agent" in system:
+        plan = _PLANS.get(question) or [
+            {"action": "llm_answer", "tool": None, "input": question or prompt[-200:], "result_var": "$answer", "description": "直接回答"}
+        ]
+        return json.dumps({"plan": plan, "explanation": "桩LLM按场景配置生成计划"}, ensure_ascii=False)
+
+    if "对话摘要Agent" in system:
+        sources = [int(n) for n in re.findall(r"^#(\d+) ", prompt, re.M)]
+        return json.dumps({
+            "summary": "桩LLM生成的对话摘要",
+            "facts": [{"text": "桩LLM提取的要点", "sources": sources[:2]}],
+        }, ensure_ascii=False)
+
+    # 其它Agent：按配置的token数生成回答文本
+    length = _CONFIG["answer_tokens"] * _CONFIG["chars_per_token"]
+    repeat = length // len(_ANSWER_TEXT) + 1
+    return (_ANSWER_TEXT * repeat)[:length]
+
+
+def split_tokens(text):
+    size = _CONFIG["chars_per_token"]
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def _chunk(completion_id, model, delta, finish_reason=None):
+    return {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+
+
+def _usage(messages, tokens):
+    prompt_chars = sum(len(m["content"]) if isinstance(m["content"], str) else 0 for m in messages)
+    prompt_tokens = prompt_chars // _CONFIG["chars_per_token"]
+    return {"prompt_tokens": prompt_tokens, "completion_tokens": len(tokens), "total_tokens": prompt_tokens + len(tokens)}
+
+
+app = FastAPI()
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    model = body.get("model", "stub")
+    messages = body.get("messages", [])
+    tokens = split_tokens(build_reply(messages))
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    token_delay = _CONFIG["token_latency_ms"] / 1000
+
+    if not body.get("stream"):
+        await asyncio.sleep(_CONFIG["ttft_ms"] / 1000 + token_delay * len(tokens))
+        return JSONResponse({
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(tokens)}, "finish_reason": "stop"}],
+            "usage": _usage(messages, tokens),
+        })
+
+    include_usage = (body.get("stream_options") or {}).get("include_usage", False)
+
+    async def event_stream():
+        await asyncio.sleep(_CONFIG["ttft_ms"] / 1000)
+        yield f"data: {json.dumps(_chunk(completion_id, model, {'role': 'assistant', 'content': ''}), ensure_ascii=False)}\n\n"
+        for token in tokens:
+            yield f"data: {json.dumps(_chunk(completion_id, model, {'content': token}), ensure_ascii=False)}\n\n"
+            await asyncio.sleep(token_delay)
+        yield f"data: {json.dumps(_chunk(completion_id, model, {}, 'stop'), ensure_ascii=False)}\n\n"
+        if include_usage:
+            usage_chunk = _chunk(completion_id, model, {})
+            usage_chunk["choices"] = []
+            usage_chunk["usage"] = _usage(messages, tokens)
+            yield f"data: {json.dumps(usage_chunk, ensure_ascii=False)}\n\n"
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+
+@app.get("/v1/models")
+async def list_models():
+    return {"object": "list", "data": [{"id": "stub", "object": "model", "owned_by": "loadtest"}]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OpenAI兼容的桩LLM服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8101)
+    parser.add_argument("--scenarios", default=os.path.join(os.path.dirname(__file__), "scenarios.json"))
+    parser.add_argument("--ttft-ms", type=float, default=_CONFIG["ttft_ms"], help="首token延迟（毫秒）")
+    parser.add_argument("--token-latency-ms", type=float, default=_CONFIG["token_latency_ms"], help="每个token的输出间隔（毫秒）")
+    parser.add_argument("--answer-tokens", type=int, default=_CONFIG["answer_tokens"], help="回答类Agent输出的token数")
+    args = parser.parse_args()
+
+    _CONFIG["ttft_ms"] = args.ttft_ms
+    _CONFIG["token_latency_ms"] = args.token_latency_ms
+    _CONFIG["answer_tokens"] = args.answer_tokens
+    load_scenarios(args.scenarios)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""
+桩MCP服务器，仅用于压测。
+暴露与mcp-server/multi_server/MCPServer.py同名同参数的工具，按配置的时延返回合成的FHIR/SQL数据，
+使压测不依赖Embedding服务和真实临床数据。
+"""
+import argparse
+import asyncio
+import json
+import random
+
+from mcp.server.fastmcp import FastMCP
+
+_CONFIG = {
+    "latency_ms": 80.0,
+    "jitter_ms": 40.0,
+    "observations": 20,
+}
+
+
+async def _simulate_latency():
+    delay = _CONFIG["latency_ms"] + random.uniform(0, _CONFIG["jitter_ms"])
+    await asyncio.sleep(delay / 1000)
+
+
+def _patient(patient_id):
+    return {
+        "resourceType": "Patient",
+        "id": patient_id,
+        "meta": {"versionId": "1", "lastUpdated": "2025-08-16T04:25:13Z"},
+        "name": [{"use": "official", "text": "张三", "family": "张", "given": ["三"]}],
+        "gender": "male",
+        "birthDate": "1980-01-15",
+    }
+
+
+def _observation(patient_id, idx):
+    return {
+        "resourceType": "Observation",
+        "id": f"{patient_id}-bp-{idx}",
+        "meta": {"versionId": "1", "lastUpdated": "2025-08-16T04:25:13Z"},
+        "status": "final",
+        "code": {"coding": [{"system": "http://loinc.org", "code": "85354-9", "display": "血压"}]},
+        "subject": {"reference": f"Patient/{patient_id}"},
+        "effectiveDateTime": f"2025-07-{idx % 28 + 1:02d}T09:00:00Z",
+        "component": [
+            {"code": {"coding": [{"code": "8480-6", "display": "收缩压"}]}, "valueQuantity": {"value": 120 + idx % 20, "unit": "mmHg"}},
+            {"code": {"coding": [{"code": "8462-4", "display": "舒张压"}]}, "valueQuantity": {"value": 80 + idx % 10, "unit": "mmHg"}},
+        ],
+    }
+
+
+def _bundle(resources):
+    return {
+        "resourceType": "Bundle",
+        "type": "searchset",
+        "total": len(resources),
+        "entry": [{"resource": r} for r in resources],
+    }
+
+
+mcp = FastMCP("Stub MCP Server for load test")
+
+
+@mcp.tool()
+async def query_fhir(resource_type: str, filters: dict) -> dict:
+    """
+    查询FHIR服务器上的指定资源，支持传入过滤条件。
+    :param resource_type: FHIR资源类型（如 'Observation', 'Patient'）
+    :param filters: 查询过滤条件（如 {'subject': 'Patient/794'}），$everything操作传入{'id': '794', '$everything': ''}
+    :return: 查询结果（FHIR Bundle JSON）
+    """
+    await _simulate_latency()
+    patient_id = str(filters.get("id") or str(filters.get("subject", "Patient/794")).split("/")[-1])
+    if resource_type == "Patient" and "$everything" in filters:
+        resources = [_patient(patient_id)] + [_observation(patient_id, i) for i in range(_CONFIG["observations"])]
+        return _bundle(resources)
+    if resource_type == "Patient":
+        return _patient(patient_id)
+    if resource_type == "Observation":
+        return _bundle([_observation(patient_id, i) for i in range(_CONFIG["observations"])])
+    return _bundle([])
+
+
+@mcp.tool()
+async def query_drug_insurance_info(drugName: str) -> dict:
+    """
+    根据药品名称查询药品报销规则。一次只能查询一种药品的报销规则。
+    :param drugName: 药品名称（如 '地高辛'或'左奥硝唑氯化钠'等）
+    :return: 报销规则知识库
+    """
+    await _simulate_latency()
+    return f"{drugName}的报销约束是:限二线用药。{drugName}注射液的报销约束是:nan"
+
+
+@mcp.tool()
+async def getAppointments(docId: str) -> dict:
+    """
+    查询医生当天的门诊就诊预约。
+    :param docId: 医生的FHIR资源id
+    :return: 查询结果（包含Appointment资源的FHIR Bundle JSON）
+    """
+    await _simulate_latency()
+    appointments = [
+        {
+            "resourceType": "Appointment",
+            "id": f"appt-{i}",
+            "status": "booked",
+            "participant": [
+                {"actor": {"reference": f"Practitioner/{docId}"}},
+                {"actor": {"reference": f"Patient/{794 + i}", "display": f"患者{i}"}},
+            ],
+        }
+        for i in range(5)
+    ]
+    return _bundle(appointments)
+
+
+async def query_sql(sqlStatement: str) -> dict:
+    """
+    在IRIS服务器上执行SQL语句查询，传入待执行SQL语句，返回查询结果。
+    :param sqlStatement: SQL语句
+    :return: 查询结果，格式为JSON
+    """
+    await _simulate_latency()
+    return json.dumps({
+        "status": {"errors": [], "summary": ""},
+        "console": [],
+        "result": {"content": [{"ID": 1, "Currency": "CNY", "ItemName": "阿奇霉素", "OrderID": "1", "Price": 1666}]},
+    }, ensure_ascii=False)
+
+
+mcp.add_tool(query_sql, name=query_sql.__name__)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="压测用桩MCP服务器")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8102)
+    parser.add_argument("--latency-ms", type=float, default=_CONFIG["latency_ms"], help="工具调用基础时延（毫秒）")
+    parser.add_argument("--jitter-ms", type=float, default=_CONFIG["jitter_ms"], help="工具调用随机抖动上限（毫秒）")
+    parser.add_argument("--observations", type=int, default=_CONFIG["observations"], help="每个患者合成的Observation数量")
+    args = parser.parse_args()
+
+    _CONFIG["latency_ms"] = args.latency_ms
+    _CONFIG["jitter_ms"] = args.jitter_ms
+    _CONFIG["observations"] = args.observations
+    mcp.settings.host = args.host
+    mcp.settings.port = args.port
+    mcp.run(transport="sse")
+
+
+if __name__ == "__main__":
+    main()
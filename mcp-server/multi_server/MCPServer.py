@@ -2,8 +2,11 @@
 import os
 from mcp.server.fastmcp import FastMCP
 from dotenv import load_dotenv
-from openapi_parser import generate_tool_list
+from openapi_parser import SpecCompiler
 from rest_api_tool_generator import RESTAPIToolGenerator
+from response_cache import ResponseCache
+from call_policy import policy_for, load_policy_config, upstream_stats
+from urllib.parse import urlsplit
 import httpx
 import asyncio
 import base64
@@ -26,6 +29,27 @@ connection = irisnative.connect(
     password=os.getenv("IRIS_PASSWORD")
 )
 
+# 生成的GET类工具共享的响应缓存（仅对规范中声明了x-cache-ttl的操作生效）
+response_cache = ResponseCache(max_bytes=int(os.getenv("TOOL_CACHE_MAX_BYTES", 32 * 1024 * 1024)))
+
+# 查看生成工具的响应缓存命中情况
+@mcp.resource("metrics://response-cache")
+def response_cache_metrics() -> str:
+    """生成工具响应缓存的命中/未命中等指标"""
+    return json.dumps(response_cache.stats())
+
+# 上游调用策略（对冲、重试、熔断），可通过环境变量TOOL_CALL_POLICIES按工具配置
+policy_config = load_policy_config()
+fhir_policy = policy_for("query_fhir", None, policy_config)
+# 访问FHIR服务器共享的连接池客户端
+fhir_client = httpx.AsyncClient(limits=httpx.Limits(max_connections=100, max_keepalive_connections=20))
+
+# 查看各上游的熔断状态和重试/对冲指标
+@mcp.resource("metrics://upstreams")
+def upstream_metrics() -> str:
+    """各上游的熔断状态、重试与对冲次数、p95耗时"""
+    return json.dumps(upstream_stats())
+
 # 连接IRIS上被暴露的表元数据
 def get_table_meta(url,namespace,scheme):
     try:
@@ -63,14 +87,49 @@ def get_table_meta(url,namespace,scheme):
         print("无法解析响应为JSON格式")
     return None
 
+def get_spec_sources() -> Dict[str, str]:
+    """
+    读取需要加载的IRIS REST应用规范，返回 {命名空间: 规范URL}
+    IRIS_OPENAPI_SPECS 为逗号分隔的 命名空间=URL 列表，如：
+        mcp=http://localhost:52880/api/mgmnt/v2/MCP/MCPTools,his=http://localhost:52880/api/mgmnt/v2/HIS/Orders
+    仍兼容只配置单个 IRIS_OPENAPI_SPEC 的方式（此时工具名不加前缀）
+    """
+    sources = {}
+    for item in (os.getenv("IRIS_OPENAPI_SPECS") or "").split(","):
+        item = item.strip()
+        if not item:
+            continue
+        namespace, sep, url = item.partition("=")
+        if not sep:
+            # 未写命名空间时使用URL最后一段作为命名空间
+            namespace, url = item.rstrip("/").rsplit("/", 1)[-1], item
+        sources[namespace.strip()] = url.strip()
+    if not sources and os.getenv("IRIS_OPENAPI_SPEC"):
+        sources[""] = os.getenv("IRIS_OPENAPI_SPEC")
+    return sources
+
+async def fetch_spec(client, namespace, spec_url, headers):
+    """获取单个IRIS API Spec，失败时返回None"""
+    print(f"正在获取IRIS API Spec[{namespace or 'default'}]，访问URL: {spec_url}")
+    try:
+        response = await client.get(
+            spec_url, 
+            headers=headers, 
+            timeout=10
+        )
+        response.raise_for_status()
+        print(f"获取IRIS API Spec[{namespace or 'default'}]成功! 状态码: {response.status_code}")
+        return response.json()
+    except Exception as e:
+        print(f"获取IRIS API Spec[{namespace or 'default'}]失败: {str(e)}")
+        return None
+
 async def get_iris_apis() -> Dict :
-    """在服务器启动前执行REST API检查"""
-    spec_url = os.getenv("IRIS_OPENAPI_SPEC")
-    if not spec_url:
-        print("未设置 IRIS_OPENAPI_SPEC 环境变量，跳过启动检查")
-        return
-    
-    print(f"正在获取IRIS API Spec，访问URL: {spec_url}")
+    """在服务器启动前并发获取所有IRIS REST应用的API Spec，返回 {命名空间: spec}"""
+    sources = get_spec_sources()
+    if not sources:
+        print("未设置 IRIS_OPENAPI_SPECS/IRIS_OPENAPI_SPEC 环境变量，跳过启动检查")
+        return {}
     # 获取认证凭据
     username = os.getenv("IRIS_USERNAME")
     password = os.getenv("IRIS_PASSWORD")
@@ -83,18 +142,10 @@ async def get_iris_apis() -> Dict :
         headers["Authorization"] = f"Basic {encoded_credentials}"
         #print("已添加基本认证凭据")
     async with httpx.AsyncClient() as client:
-        try:
-            response = await client.get(
-                spec_url, 
-                headers=headers, 
-                timeout=10
-            )
-            response.raise_for_status()
-            print(f"获取IRIS API Spec成功! 状态码: {response.status_code}")
-            spec = response.text
-            return spec
-        except Exception as e:
-            print(f"启动检查失败: {str(e)}")
+        specs = await asyncio.gather(*[
+            fetch_spec(client, namespace, url, headers) for namespace, url in sources.items()
+        ])
+    return {namespace: spec for namespace, spec in zip(sources, specs) if spec}
 
 # 获取文本的嵌入向量
 def get_embedding(texts):
@@ -179,14 +230,20 @@ async def query_fhir(resource_type: str, filters: dict) -> dict:
         else:
             query_params = '&'.join([f"{k}={v}" for k, v in filters.items()])
     url = f"{url}?{query_params}"
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.get(url, timeout=10)
-            response.raise_for_status()
-            data = response.json()
-            return data
-        except Exception as e:
-            raise Exception(f"FHIR 查询失败: {e}")
+
+    async def send(timeout):
+        return await fhir_client.get(url, timeout=timeout)
+
+    try:
+        if fhir_policy is None:
+            response = await send(10)
+        else:
+            response = await fhir_policy.call(urlsplit(fhir_base_url).netloc, send)
+        response.raise_for_status()
+        data = response.json()
+        return data
+    except Exception as e:
+        raise Exception(f"FHIR 查询失败: {e}")
 
 sql_query_Desc = """
     在IRIS服务器上执行SQL语句查询，传入待执行SQL语句，返回查询结果。
@@ -235,11 +292,8 @@ async def test():
 
 if __name__ == "__main__":
 
-    # 动态获取IRIS上的API定义
-    spec = json.loads(asyncio.run(get_iris_apis()))
-    #补丁：由于IRIS会自动以域名+端口作为host的根路径（如mcpdemo:52773），暂时需要手动将其替换为docker环境下可访问的地址如(localhost:52880)
-    spec['host'] = 'localhost:52880'
-    #print(spec)
+    # 动态获取IRIS上所有REST应用的API定义
+    specs = asyncio.run(get_iris_apis())
     # 将OpenAI 2.0版本的REST API规范转换为如下格式的Python JSON对象
     """
      [
@@ -268,15 +322,18 @@ if __name__ == "__main__":
         }
      ]
     """
-    api_dict = generate_tool_list(spec)
+    api_dict = []
+    # 增量编译器：按路径项内容哈希缓存编译结果，重新加载规范时只编译变化的部分
+    spec_compiler = SpecCompiler()
+    for namespace, spec in specs.items():
+        #补丁：由于IRIS会自动以域名+端口作为host的根路径（如mcpdemo:52773），暂时需要手动将其替换为docker环境下可访问的地址如(localhost:52880)
+        spec['host'] = os.getenv("IRIS_API_HOST", 'localhost:52880')
+        api_dict.extend(spec_compiler.compile(spec, namespace))
     #print(api_dict)
     # 创建工具生成器
-    generator = RESTAPIToolGenerator(api_dict)
-    # 获取并注册生成的工具函数
-    tools = generator.get_tool_functions()
-    for func_name, func in tools.items():
-        mcp.add_tool(func, name=func_name)
-        print(f"动态工具已添加：{func_name}")
+    generator = RESTAPIToolGenerator(api_dict, cache=response_cache, policy_config=policy_config)
+    # 注册生成的工具函数，工具在第一次调用时才构建
+    generator.register_tools(mcp, lazy=True)
     # 将SQL表可读性注入SQL查询工具的注释中，便于大模型使用
     table_desc = get_table_meta(os.getenv("TABLE_META_ENDPOINT"),os.getenv("TABLE_NS"),os.getenv("TABLE_SCHEME"))
     desc = sql_query_Desc+json.dumps(table_desc, separators=(',', ':'),ensure_ascii=False)
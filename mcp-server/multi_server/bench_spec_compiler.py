@@ -0,0 +1,107 @@
+"""
+OpenAPI 规范编译的基准测试。
+生成包含数千个操作的合成规范（含共享定义、嵌套引用和递归定义），对比：
+  - generate_tool_list：每次全量遍历规范
+  - SpecCompiler：冷启动全量编译、规范未变化时的重新编译、少量路径项变化和单个共享定义变化后的增量编译
+
+用法：
+    python bench_spec_compiler.py --operations 5000
+"""
+import argparse
+import copy
+import gc
+import time
+
+from openapi_parser import generate_tool_list, SpecCompiler
+
+
+def synthetic_spec(operations):
+    definitions = {
+        "Coding": {"type": "object", "properties": {"code": {"type": "string"}, "system": {"type": "string"}}},
+        "CodeableConcept": {"type": "object", "properties": {"coding": {"type": "array", "items": {"$ref": "#/definitions/Coding"}}, "text": {"type": "string"}}},
+        # 递归定义：树形的组织结构
+        "Organization": {"type": "object", "properties": {"name": {"type": "string"}, "partOf": {"$ref": "#/definitions/Organization"}}},
+    }
+    paths = {}
+    for i in range(operations):
+        group = i % 50
+        definitions.setdefault(f"Request{group}", {
+            "type": "object",
+            "required": ["patientId"],
+            "properties": {
+                "patientId": {"type": "string", "description": "患者资源id"},
+                "code": {"$ref": "#/definitions/CodeableConcept"},
+                "organization": {"$ref": "#/definitions/Organization"},
+                "amount": {"type": "number", "format": "double", "description": "金额"},
+            },
+        })
+        paths[f"/resource{i}/{{id}}"] = {
+            "get": {
+                "operationId": f"getResource{i}",
+                "description": f"查询资源{i}",
+                "parameters": [
+                    {"name": "id", "in": "path", "required": True, "type": "string", "description": "资源id"},
+                    {"name": "date", "in": "query", "type": "string", "format": "date", "description": "日期"},
+                ],
+            },
+            "post": {
+                "operationId": f"updateResource{i}",
+                "description": f"更新资源{i}",
+                "parameters": [
+                    {"name": "id", "in": "path", "required": True, "type": "string"},
+                    {"name": "body", "in": "body", "schema": {"$ref": f"#/definitions/Request{group}"}},
+                ],
+            },
+        }
+    return {
+        "swagger": "2.0",
+        "host": "localhost:52880",
+        "basePath": "/api",
+        "schemes": ["http"],
+        "paths": paths,
+        "definitions": definitions,
+    }
+
+
+def timed(label, func, operations):
+    # 各项测量前先回收垃圾，前一项留下的对象不计入后一项的耗时
+    gc.collect()
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<36} {elapsed * 1000:9.1f} ms  ({len(result)} 个工具, 每操作 {elapsed / operations * 1e6:7.1f} us)")
+    return result
+
+
+def main(operations):
+    spec = synthetic_spec(operations)
+    total_ops = operations * 2
+    print(f"合成规范：{operations} 个路径，{total_ops} 个操作，{len(spec['definitions'])} 个定义\n")
+
+    baseline = timed("generate_tool_list（全量）", lambda: generate_tool_list(spec), total_ops)
+
+    compiler = SpecCompiler()
+    cold = timed("SpecCompiler 冷启动", lambda: compiler.compile(spec), total_ops)
+    assert cold == baseline
+    timed("SpecCompiler 规范未变化", lambda: compiler.compile(spec), total_ops)
+
+    changed = copy.deepcopy(spec)
+    for i in range(0, operations, 100):
+        changed["paths"][f"/resource{i}/{{id}}"]["get"]["description"] += "（已修改）"
+    compiler.stats = {"hits": 0, "misses": 0}
+    timed("SpecCompiler 1% 路径项变化", lambda: compiler.compile(changed), total_ops)
+    print(f"  重新编译的路径项: {compiler.stats['misses']}")
+
+    changed_def = copy.deepcopy(changed)
+    changed_def["definitions"]["Request7"]["properties"]["note"] = {"type": "string"}
+    compiler.stats = {"hits": 0, "misses": 0}
+    result = timed("SpecCompiler 单个共享定义变化", lambda: compiler.compile(changed_def), total_ops)
+    print(f"  重新编译的路径项: {compiler.stats['misses']}")
+    assert result == generate_tool_list(changed_def)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="OpenAPI规范增量编译基准")
+    parser.add_argument("--operations", type=int, default=5000, help="合成规范中的路径数（每个路径2个操作）")
+    args = parser.parse_args()
+    main(args.operations)
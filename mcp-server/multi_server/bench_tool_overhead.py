@@ -0,0 +1,160 @@
+"""
+生成工具单次调用开销的微基准测试。
+使用 httpx.MockTransport 屏蔽网络耗时，对比：
+  - legacy：原先通过 exec 生成函数体、每次遍历 locals()、重新计算认证头并新建 AsyncClient 的实现
+  - plan：注册时预编译的 RequestPlan，共享连接池客户端
+
+用法：
+    python bench_tool_overhead.py --calls 20000
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import time
+
+import httpx
+
+import rest_api_tool_generator
+from rest_api_tool_generator import RESTAPIToolGenerator
+
+API = {
+    "name": "getAppointments",
+    "description": "查询医生当天的门诊就诊预约。",
+    "api_path": "http://localhost:52880/MCP/MCPTools/outpatient_appointment/{docId}",
+    "method": "get",
+    "input_schema": {
+        "type": "object",
+        "title": "getAppointmentsArguments",
+        "properties": {
+            "docId": {"type": "string", "description": "医生的FHIR资源id"},
+            "date": {"type": "string", "description": "就诊日期"},
+        },
+        "required": ["docId"],
+    },
+    "path_params": ["docId"],
+    "query_params": ["date"],
+}
+
+RESPONSE = {"resourceType": "Bundle", "type": "searchset", "total": 0, "entry": []}
+
+
+def mock_transport():
+    return httpx.MockTransport(lambda request: httpx.Response(200, json=RESPONSE))
+
+
+class MockAsyncClient(httpx.AsyncClient):
+    """legacy实现内部直接 new httpx.AsyncClient()，这里替换为使用MockTransport的子类"""
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault("transport", mock_transport())
+        super().__init__(*args, **kwargs)
+
+
+def legacy_tool(api):
+    """复现原 exec 生成的函数体（调用路径保持一致，仅替换传输层）"""
+    path_params = api["path_params"]
+    query_params = api["query_params"]
+    params = list(api["input_schema"]["properties"])
+    method = api["method"]
+    api_path = api["api_path"]
+    func_code = f"async def api_function({', '.join(params)}):\n"
+    func_code += "    path_params = {" + "".join(f"'{p}': {p}," for p in path_params) + "}\n"
+    func_code += f"""
+    query_params = {{}}
+    for param in {query_params}:
+        if param in locals() and locals()[param] is not None:
+            query_params[param] = locals()[param]
+    json_payload = {{}}
+    if "{method}" != "get":
+        body_params = {params}
+        for param in body_params:
+            if param not in path_params and param not in query_params and param in locals():
+                json_payload[param] = locals()[param]
+    final_url = f"{api_path}"
+    if path_params:
+        for param, value in path_params.items():
+            placeholder = "{{" + param + "}}"
+            final_url = final_url.replace(placeholder, str(value))
+    headers = {{}}
+    username = os.getenv("IRIS_USERNAME")
+    password = os.getenv("IRIS_PASSWORD")
+    if username and password:
+        credentials = f"{{username}}:{{password}}"
+        encoded_credentials = base64.b64encode(credentials.encode('utf-8')).decode('utf-8')
+        headers["Authorization"] = f"Basic {{encoded_credentials}}"
+    async with httpx.AsyncClient() as client:
+        try:
+            request_args = {{
+                "method": "{method}",
+                "url": final_url,
+                "headers": headers,
+                "params": query_params if query_params else None,
+                "json": json_payload if json_payload else None,
+                "timeout": 10.0
+            }}
+            request_args = {{k: v for k, v in request_args.items() if v is not None}}
+            response = await client.request(**request_args)
+            response.raise_for_status()
+            return response.json()
+        except httpx.HTTPStatusError as e:
+            return {{"error": f"HTTP错误: {{e.response.status_code}}", "details": e.response.text}}
+        except Exception as e:
+            return {{"error": "请求失败", "details": str(e)}}
+"""
+    local_vars = {}
+    exec_globals = {
+        "os": os,
+        "base64": base64,
+        "json": json,
+        "httpx": type("httpx", (), {"AsyncClient": MockAsyncClient, "HTTPStatusError": httpx.HTTPStatusError}),
+    }
+    exec(func_code, exec_globals, local_vars)
+    return local_vars["api_function"]
+
+
+async def measure(func, calls):
+    # 预热
+    for _ in range(100):
+        await func(docId="1", date="2025-08-16")
+    start = time.perf_counter()
+    for _ in range(calls):
+        await func(docId="1", date="2025-08-16")
+    return (time.perf_counter() - start) / calls * 1e6
+
+
+async def measure_build_url(plan, calls):
+    args = {"docId": "1", "date": "2025-08-16"}
+    start = time.perf_counter()
+    for _ in range(calls):
+        plan.build_url(args)
+    return (time.perf_counter() - start) / calls * 1e6
+
+
+async def main(calls):
+    os.environ.setdefault("IRIS_USERNAME", "superuser")
+    os.environ.setdefault("IRIS_PASSWORD", "SYS")
+
+    legacy = legacy_tool(API)
+    generator = RESTAPIToolGenerator([API], client=httpx.AsyncClient(transport=mock_transport()))
+    plan_tool = generator.get_tool_functions()[API["name"]]
+    plan = generator.request_plans[API["name"]]
+
+    legacy_us = await measure(legacy, calls)
+    plan_us = await measure(plan_tool, calls)
+    url_us = await measure_build_url(plan, calls)
+    await generator.aclose()
+
+    print(f"调用次数: {calls}")
+    print(f"legacy (exec + 每次新建客户端): {legacy_us:8.1f} us/次")
+    print(f"plan   (预编译 + 共享连接池):   {plan_us:8.1f} us/次")
+    print(f"加速比: {legacy_us / plan_us:.1f}x")
+    print(f"其中 RequestPlan.build_url:      {url_us:8.2f} us/次")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="生成工具单次调用开销微基准")
+    parser.add_argument("--calls", type=int, default=5000)
+    args = parser.parse_args()
+    asyncio.run(main(args.calls))
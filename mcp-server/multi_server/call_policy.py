@@ -0,0 +1,279 @@
+import asyncio
+import json
+import os
+import random
+import time
+from collections import deque
+from typing import Dict, Any, Callable, Awaitable, Optional
+
+import httpx
+
+# 这些状态码说明上游暂时不可用，幂等请求可以重试
+RETRYABLE_STATUS = (429, 502, 503, 504)
+
+
+class CircuitOpenError(Exception):
+    """上游熔断中，快速失败"""
+
+
+class DeadlineExceededError(Exception):
+    """在整体时限内未能完成调用"""
+
+
+class LatencyTracker:
+    """记录最近若干次成功调用的耗时，用于计算对冲请求的发送时机"""
+
+    def __init__(self, window: int = 200):
+        self.samples = deque(maxlen=window)
+
+    def record(self, seconds: float):
+        self.samples.append(seconds)
+
+    def quantile(self, q: float) -> Optional[float]:
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(int(len(ordered) * q), len(ordered) - 1)]
+
+
+class CircuitBreaker:
+    """
+    按上游划分的熔断器。
+    连续失败达到阈值后打开，在reset_timeout内直接拒绝调用；
+    之后进入半开状态，只放行一个探测请求，成功则关闭，失败则重新打开。
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def before_call(self):
+        state = self.state
+        if state == "open" or (state == "half-open" and self.probing):
+            raise CircuitOpenError("上游服务熔断中，暂时拒绝调用")
+        if state == "half-open":
+            self.probing = True
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.probing or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+        self.probing = False
+
+
+class UpstreamState:
+    """同一上游（host:port）上所有工具共享的熔断器、延迟统计和指标"""
+
+    def __init__(self, breaker: CircuitBreaker):
+        self.breaker = breaker
+        self.latency = LatencyTracker()
+        self.metrics = {
+            "calls": 0,
+            "attempts": 0,
+            "retries": 0,
+            "hedges": 0,
+            "hedge_wins": 0,
+            "failures": 0,
+            "rejected": 0,
+        }
+
+
+_upstreams = {}
+
+
+def get_upstream(name: str, policy: "CallPolicy") -> UpstreamState:
+    state = _upstreams.get(name)
+    if state is None:
+        state = UpstreamState(CircuitBreaker(policy.breaker_threshold, policy.breaker_reset))
+        _upstreams[name] = state
+    return state
+
+
+def upstream_stats() -> Dict[str, Any]:
+    """所有上游的熔断状态与调用指标"""
+    return {
+        name: {
+            **state.metrics,
+            "breaker": state.breaker.state,
+            "p95_ms": (state.latency.quantile(0.95) or 0.0) * 1000,
+        }
+        for name, state in _upstreams.items()
+    }
+
+
+class CallPolicy:
+    """
+    幂等上游调用的策略：在整体时限（deadline）内做带抖动的重试，
+    单次尝试超过最近p95耗时仍未返回时发送一个对冲请求，取先成功者，
+    并通过按上游共享的熔断器在上游不健康时快速失败。
+    """
+
+    def __init__(self, deadline: float = 10.0, attempt_timeout: float = None, max_retries: int = 2,
+                 backoff_base: float = 0.1, backoff_max: float = 1.0, hedge: bool = True,
+                 hedge_quantile: float = 0.95, hedge_min_delay: float = 0.05, hedge_min_samples: int = 20,
+                 breaker_threshold: int = 5, breaker_reset: float = 30.0):
+        self.deadline = deadline
+        self.attempt_timeout = attempt_timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_min_samples = hedge_min_samples
+        self.breaker_threshold = breaker_threshold
+        self.breaker_reset = breaker_reset
+
+    @classmethod
+    def from_config(cls, config: Optional[Dict[str, Any]]) -> Optional["CallPolicy"]:
+        """由配置字典创建策略，{"enabled": false} 表示不使用策略"""
+        config = dict(config or {})
+        if not config.pop("enabled", True):
+            return None
+        return cls(**config)
+
+    def _hedge_delay(self, state: UpstreamState) -> Optional[float]:
+        if not self.hedge or len(state.latency.samples) < self.hedge_min_samples:
+            return None
+        return max(state.latency.quantile(self.hedge_quantile), self.hedge_min_delay)
+
+    def _backoff(self, attempt: int) -> float:
+        # 全抖动指数退避
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    async def _attempt(self, state: UpstreamState, send: Callable[[float], Awaitable[httpx.Response]],
+                       timeout: float) -> httpx.Response:
+        """执行一次（可能带对冲的）尝试，返回首个非可重试的响应"""
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        tasks = [asyncio.ensure_future(send(timeout))]
+        try:
+            hedge_delay = self._hedge_delay(state)
+            if hedge_delay is not None and hedge_delay < timeout:
+                done, _ = await asyncio.wait(tasks, timeout=hedge_delay)
+                if not done:
+                    state.metrics["hedges"] += 1
+                    tasks.append(asyncio.ensure_future(send(timeout - hedge_delay)))
+
+            pending = set(tasks)
+            last_response, last_error = None, None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        last_error = task.exception()
+                        continue
+                    response = task.result()
+                    if response.status_code in RETRYABLE_STATUS:
+                        last_response = response
+                        continue
+                    state.latency.record(loop.time() - start)
+                    if task is not tasks[0]:
+                        state.metrics["hedge_wins"] += 1
+                    return response
+            if last_response is not None:
+                return last_response
+            raise last_error
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled():
+                    task.exception()
+
+    async def call(self, upstream: str, send: Callable[[float], Awaitable[httpx.Response]]) -> httpx.Response:
+        """
+        按策略调用上游
+        :param upstream: 上游标识（如 host:port），同一上游共享熔断器
+        :param send: 发送一次请求的协程函数，参数为本次尝试的超时时间（秒）
+        """
+        state = get_upstream(upstream, self)
+        state.metrics["calls"] += 1
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.deadline
+        last_response, last_error = None, None
+        attempt = 0
+        while True:
+            try:
+                state.breaker.before_call()
+            except CircuitOpenError:
+                state.metrics["rejected"] += 1
+                raise
+            remaining = deadline - loop.time()
+            timeout = min(self.attempt_timeout or remaining, remaining)
+            state.metrics["attempts"] += 1
+            try:
+                response = await asyncio.wait_for(self._attempt(state, send, timeout), timeout)
+                if response.status_code not in RETRYABLE_STATUS:
+                    state.breaker.record_success()
+                    return response
+                last_response = response
+            except (httpx.TransportError, asyncio.TimeoutError) as e:
+                last_error = e
+            except BaseException as e:
+                # 其它异常按失败计入；调用方取消时只结束进行中的探测（否则半开的熔断器会一直拒绝调用），
+                # 不把取消计入上游的连续失败
+                if isinstance(e, Exception) or state.breaker.probing:
+                    state.breaker.record_failure()
+                raise
+            state.breaker.record_failure()
+
+            attempt += 1
+            backoff = self._backoff(attempt)
+            if attempt > self.max_retries or loop.time() + backoff >= deadline:
+                break
+            state.metrics["retries"] += 1
+            await asyncio.sleep(backoff)
+
+        state.metrics["failures"] += 1
+        if last_response is not None:
+            return last_response
+        if isinstance(last_error, asyncio.TimeoutError):
+            raise DeadlineExceededError(f"调用 {upstream} 超过时限 {self.deadline}s")
+        raise last_error
+
+
+def load_policy_config() -> Dict[str, Dict[str, Any]]:
+    """
+    从环境变量 TOOL_CALL_POLICIES 读取按工具名配置的策略，"*" 为所有工具的默认配置，如：
+    {"query_fhir": {"deadline": 8, "max_retries": 1}, "getAppointments": {"hedge": false}}
+    """
+    raw = os.getenv("TOOL_CALL_POLICIES")
+    if not raw:
+        return {}
+    try:
+        return json.loads(raw)
+    except json.JSONDecodeError as e:
+        print(f"TOOL_CALL_POLICIES 不是合法的JSON，忽略: {e}")
+        return {}
+
+
+def policy_for(tool_name: str, spec_config: Optional[Dict[str, Any]] = None,
+               overrides: Optional[Dict[str, Dict[str, Any]]] = None) -> Optional[CallPolicy]:
+    """
+    合并环境变量中的默认配置（"*"）、规范中的 x-call-policy 与环境变量中的按工具配置，生成该工具的策略。
+    策略需显式启用：都没有配置的工具返回None，每次调用直接发送一次请求
+    """
+    overrides = overrides or {}
+    if spec_config is None and tool_name not in overrides and "*" not in overrides:
+        return None
+    config = dict(overrides.get("*", {}))
+    config.update(spec_config or {})
+    config.update(overrides.get(tool_name, {}))
+    return CallPolicy.from_config(config)
@@ -1,5 +1,7 @@
 import re
 import json
+import hashlib
+import marshal
 from typing import Dict, List, Any
 
 def convert_swagger_type_to_json_schema_type(swagger_type: str, swagger_format: str = None) -> str:
@@ -36,7 +38,63 @@ def resolve_ref(spec: Dict, ref_path: str) -> Dict:
         current = current.get(part, {})
     return current
 
-def extract_parameters(operation: Dict, spec: Dict) -> Dict:
+class RefResolver:
+    """
+    带记忆化的 $ref 解析器：递归展开嵌套引用，每个引用只解析一次；
+    遇到递归结构（如树形的 definitions）时在环上截断为占位对象，避免无限展开。
+    展开结果与解析顺序无关：在外层引用处截断的结果依赖于从哪里开始展开，不记忆；
+    记忆的结果所依赖的引用正在外层展开时也不使用，重新展开。
+    同时记录解析过程中用到的引用，供增量编译判断依赖是否变化。
+    """
+
+    def __init__(self, spec: Dict):
+        self.spec = spec
+        self._memo = {}
+        self._resolving = []
+        # 当前展开中截断发生的最外层位置（_resolving中的下标）
+        self._cut = 0
+        self.used_refs = set()
+
+    def resolve(self, ref_path: str) -> Dict:
+        """解析 $ref 引用并展开其中嵌套的引用"""
+        self.used_refs.add(ref_path)
+        memo = self._memo.get(ref_path)
+        if memo is not None and memo[1].isdisjoint(self._resolving):
+            resolved, deps = memo
+            self.used_refs.update(deps)
+            return resolved
+        if ref_path in self._resolving:
+            # 递归引用：截断为占位对象
+            self._cut = min(self._cut, self._resolving.index(ref_path))
+            return {"type": "object", "description": f"递归引用 {ref_path}"}
+
+        outer_used, outer_cut = self.used_refs, self._cut
+        depth = len(self._resolving)
+        self.used_refs = {ref_path}
+        self._cut = depth
+        self._resolving.append(ref_path)
+        try:
+            resolved = self.resolve_node(resolve_ref(self.spec, ref_path))
+        finally:
+            self._resolving.pop()
+            deps = self.used_refs
+            self.used_refs = outer_used | deps
+            cut, self._cut = self._cut, min(outer_cut, self._cut)
+        if cut >= depth:
+            self._memo[ref_path] = (resolved, frozenset(deps))
+        return resolved
+
+    def resolve_node(self, node: Any) -> Any:
+        """递归展开任意模式结点中的 $ref"""
+        if isinstance(node, dict):
+            if "$ref" in node:
+                return self.resolve(node["$ref"])
+            return {k: self.resolve_node(v) for k, v in node.items()}
+        if isinstance(node, list):
+            return [self.resolve_node(v) for v in node]
+        return node
+
+def extract_parameters(operation: Dict, spec: Dict, resolver: RefResolver = None) -> Dict:
     """
     提取所有参数（路径、查询、body）
     返回格式: {
@@ -46,6 +104,7 @@ def extract_parameters(operation: Dict, spec: Dict) -> Dict:
         "required": [param_name]
     }
     """
+    resolver = resolver or RefResolver(spec)
     parameters = {
         "path_params": {},
         "query_params": {},
@@ -54,6 +113,9 @@ def extract_parameters(operation: Dict, spec: Dict) -> Dict:
     }
     
     for param in operation.get("parameters", []):
+        # 参数本身也可能是引用（如 #/parameters/xxx）
+        if "$ref" in param:
+            param = resolver.resolve(param["$ref"])
         param_in = param.get("in")
         param_name = param.get("name")
         required = param.get("required", False)
@@ -61,10 +123,8 @@ def extract_parameters(operation: Dict, spec: Dict) -> Dict:
         if required:
             parameters["required"].append(param_name)
         
-        # 获取参数模式
-        schema = param.get("schema", {})
-        if "$ref" in schema:
-            schema = resolve_ref(spec, schema["$ref"])
+        # 获取参数模式（嵌套引用一并展开）
+        schema = resolver.resolve_node(param.get("schema", {}))
         
         if not schema:
             # 简单参数
@@ -83,11 +143,7 @@ def extract_parameters(operation: Dict, spec: Dict) -> Dict:
             # 处理 body 参数（可能是嵌套对象）
             if "properties" in schema:
                 for prop_name, prop_def in schema["properties"].items():
-                    if "$ref" in prop_def:
-                        ref_def = resolve_ref(spec, prop_def["$ref"])
-                        parameters["body_params"][prop_name] = ref_def
-                    else:
-                        parameters["body_params"][prop_name] = prop_def
+                    parameters["body_params"][prop_name] = prop_def
                 
                 # 添加必填字段
                 if "required" in schema:
@@ -95,63 +151,157 @@ def extract_parameters(operation: Dict, spec: Dict) -> Dict:
     
     return parameters
 
-def generate_tool_list(openapi_spec: Dict) -> List[Dict]:
-    """从 OpenAPI 2.0 规范生成工具列表（修复路径参数问题）"""
+def namespaced_name(namespace: str, name: str) -> str:
+    """为工具名加上规范的命名空间前缀，如 mcp_getAppointments（MCP工具名只允许字母、数字、_和-）"""
+    if not namespace:
+        return name
+    prefix = re.sub(r"[^A-Za-z0-9_-]", "_", namespace)
+    return f"{prefix}_{name}"
+
+def get_base_url(openapi_spec: Dict) -> str:
+    return f"{openapi_spec['schemes'][0]}://{openapi_spec['host']}{openapi_spec['basePath']}"
+
+def compile_path_item(path: str, path_item: Dict, base_url: str, namespace: str,
+                      spec: Dict, resolver: RefResolver) -> List[Dict]:
+    """将单个路径下的所有操作编译为工具描述"""
+    tools = []
+    for method, operation in path_item.items():
+        if method.lower() not in ["get", "post", "put", "delete", "patch"]:
+            continue
+            
+        # 获取操作信息
+        operation_id = namespaced_name(
+            namespace, operation.get("operationId", f"{method}_{path.replace('/', '_')}")
+        )
+        description = operation.get("description", operation.get("summary", ""))
+        
+        # 提取所有参数
+        params_info = extract_parameters(operation, spec, resolver)
+        
+        # 创建统一的属性集合
+        properties = {}
+        properties.update(params_info["path_params"])
+        properties.update(params_info["query_params"])
+        properties.update(params_info["body_params"])
+        
+        # 为属性添加类型信息
+        for prop_name, prop_def in properties.items():
+            prop_type = convert_swagger_type_to_json_schema_type(
+                prop_def.get("type", "string"),
+                prop_def.get("format")
+            )
+            properties[prop_name] = {
+                "type": prop_type,
+                "description": prop_def.get("description", "")
+            }
+        
+        # 创建输入模式
+        input_schema = {
+            "type": "object",
+            "title": f"{operation_id}Arguments",
+            "properties": properties,
+            "required": params_info["required"]
+        }
+        
+        # 完整的 API 路径
+        api_path = f"{base_url}{path}"
+        
+        # 添加到工具列表
+        tools.append({
+            "name": operation_id,
+            "description": description.strip(),
+            "api_path": api_path,
+            "method": method.lower(),
+            "input_schema": input_schema,
+            # 额外信息用于请求构造
+            "path_params": list(params_info["path_params"].keys()),
+            "query_params": list(params_info["query_params"].keys()),
+            # 可选的缓存有效期（秒），由规范中的厂商扩展 x-cache-ttl 声明
+            "cache_ttl": operation.get("x-cache-ttl"),
+            # 可选的调用策略（对冲、重试、熔断参数），由厂商扩展 x-call-policy 声明
+            "call_policy": operation.get("x-call-policy")
+        })
+    return tools
+
+def generate_tool_list(openapi_spec: Dict, namespace: str = None) -> List[Dict]:
+    """
+    从 OpenAPI 2.0 规范生成工具列表（修复路径参数问题）
+    :param namespace: 可选的命名空间，加载多个规范时用于区分同名操作
+    """
     tools = []
-    definitions = openapi_spec.get("definitions", {})
-    base_url = f"{openapi_spec['schemes'][0]}://{openapi_spec['host']}{openapi_spec['basePath']}"
+    resolver = RefResolver(openapi_spec)
+    base_url = get_base_url(openapi_spec)
     
     # 遍历所有路径和方法
     for path, path_item in openapi_spec.get("paths", {}).items():
-        for method, operation in path_item.items():
-            if method.lower() not in ["get", "post", "put", "delete", "patch"]:
-                continue
-                
-            # 获取操作信息
-            operation_id = operation.get("operationId", f"{method}_{path.replace('/', '_')}")
-            description = operation.get("description", operation.get("summary", ""))
-            
-            # 提取所有参数
-            params_info = extract_parameters(operation, openapi_spec)
-            
-            # 创建统一的属性集合
-            properties = {}
-            properties.update(params_info["path_params"])
-            properties.update(params_info["query_params"])
-            properties.update(params_info["body_params"])
-            
-            # 为属性添加类型信息
-            for prop_name, prop_def in properties.items():
-                prop_type = convert_swagger_type_to_json_schema_type(
-                    prop_def.get("type", "string"),
-                    prop_def.get("format")
-                )
-                properties[prop_name] = {
-                    "type": prop_type,
-                    "description": prop_def.get("description", "")
-                }
-            
-            # 创建输入模式
-            input_schema = {
-                "type": "object",
-                "title": f"{operation_id}Arguments",
-                "properties": properties,
-                "required": params_info["required"]
-            }
-            
-            # 完整的 API 路径
-            api_path = f"{base_url}{path}"
-            
-            # 添加到工具列表
-            tools.append({
-                "name": operation_id,
-                "description": description.strip(),
-                "api_path": api_path,
-                "method": method.lower(),
-                "input_schema": input_schema,
-                # 额外信息用于请求构造
-                "path_params": list(params_info["path_params"].keys()),
-                "query_params": list(params_info["query_params"].keys())
-            })
+        tools.extend(compile_path_item(path, path_item, base_url, namespace, openapi_spec, resolver))
     
-    return tools
\ No newline at end of file
+    return tools
+
+def _content_hash(obj: Any) -> bytes:
+    # marshal 比 json.dumps 快数倍，不同的内容编码一定不同；相同内容的编码偶尔不同（键顺序、字符串是否驻留）
+    # 只会导致一次缓存未命中。version 2 不写对象引用标记，编码与对象是否被共享无关
+    try:
+        data = marshal.dumps(obj, 2)
+    except ValueError:
+        data = json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+class SpecCompiler:
+    """
+    OpenAPI 规范的增量编译器。
+    先比较整个规范的内容哈希，未变化时直接返回上次的结果；
+    变化时以路径项内容哈希（连同基础URL和命名空间）为键查找编译结果，并核对每个路径项依赖的 $ref 的内容哈希，
+    只有内容或所依赖定义发生变化的路径项会被重新编译。
+    """
+
+    def __init__(self):
+        self._cache = {}
+        self._documents = {}
+        self.stats = {"unchanged": 0, "hits": 0, "misses": 0}
+
+    def compile(self, openapi_spec: Dict, namespace: str = None) -> List[Dict]:
+        """编译规范，返回与 generate_tool_list 相同格式的工具列表"""
+        # 整个规范的哈希由各路径项的哈希和规范其余部分组合而成，与直接序列化整个规范的开销相同，
+        # 规范变化时各路径项的哈希可以直接使用，冷启动也只序列化一遍
+        paths = openapi_spec.get("paths", {})
+        path_hashes = {path: _content_hash(path_item) for path, path_item in paths.items()}
+        document_hash = _content_hash([{k: v for k, v in openapi_spec.items() if k != "paths"},
+                                       list(path_hashes.items())])
+        document = self._documents.get(namespace)
+        if document is not None and document[0] == document_hash:
+            self.stats["unchanged"] += 1
+            return list(document[1])
+
+        tools = []
+        resolver = RefResolver(openapi_spec)
+        base_url = get_base_url(openapi_spec)
+        ref_hashes = {}
+
+        def ref_hash(ref_path):
+            if ref_path not in ref_hashes:
+                ref_hashes[ref_path] = _content_hash(resolve_ref(openapi_spec, ref_path))
+            return ref_hashes[ref_path]
+
+        live_keys = set()
+        for path, path_item in paths.items():
+            key = (namespace, base_url, path, path_hashes[path])
+            live_keys.add(key)
+            cached = self._cache.get(key)
+            if cached is not None and all(ref_hash(r) == h for r, h in cached[0].items()):
+                self.stats["hits"] += 1
+                tools.extend(cached[1])
+                continue
+
+            self.stats["misses"] += 1
+            resolver.used_refs = set()
+            compiled = compile_path_item(path, path_item, base_url, namespace, openapi_spec, resolver)
+            deps = {r: ref_hash(r) for r in resolver.used_refs}
+            self._cache[key] = (deps, compiled)
+            tools.extend(compiled)
+
+        # 清理同一规范中已不存在的路径项
+        for key in [k for k in self._cache if k[:2] == (namespace, base_url) and k not in live_keys]:
+            del self._cache[key]
+        self._documents[namespace] = (document_hash, tools)
+        return list(tools)
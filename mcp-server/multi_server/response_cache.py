@@ -0,0 +1,146 @@
+import time
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, Optional, Tuple
+
+
+class CacheEntry:
+    """缓存条目：原始响应体、校验器（ETag）和过期时间"""
+    __slots__ = ("body", "etag", "expires_at", "size")
+
+    def __init__(self, body: bytes, etag: Optional[str], expires_at: float):
+        self.body = body
+        self.etag = etag
+        self.expires_at = expires_at
+        self.size = len(body) + (len(etag) if etag else 0)
+
+    def is_fresh(self, now: float) -> bool:
+        return now < self.expires_at
+
+
+def parse_cache_control(value: Optional[str]) -> Dict[str, Optional[str]]:
+    """解析Cache-Control头，如 'max-age=60, no-cache' -> {'max-age': '60', 'no-cache': None}"""
+    directives = {}
+    if not value:
+        return directives
+    for part in value.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        name, _, arg = part.partition("=")
+        directives[name.strip().lower()] = arg.strip().strip('"') if arg else None
+    return directives
+
+
+class ResponseCache:
+    """
+    按字节数限制容量的共享响应缓存（LRU淘汰），供生成的GET类工具使用。
+    遵循HTTP缓存语义：
+      - Cache-Control: no-store 不缓存；max-age/s-maxage 优先于操作上配置的 x-cache-ttl
+      - Cache-Control: no-cache 或条目过期时，若有ETag则带If-None-Match重新验证，304时直接复用缓存体
+    """
+
+    def __init__(self, max_bytes: int = 32 * 1024 * 1024, max_entry_bytes: int = None):
+        self.max_bytes = max_bytes
+        # 单个响应超过该大小不缓存，避免一个大Bundle挤掉所有条目
+        self.max_entry_bytes = max_entry_bytes or max_bytes // 8
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.metrics = {
+            "hits": 0,
+            "misses": 0,
+            "revalidated": 0,
+            "stores": 0,
+            "evictions": 0,
+            "uncacheable": 0,
+        }
+
+    @staticmethod
+    def make_key(method: str, url: str, params: Optional[Dict[str, Any]]) -> Tuple:
+        if not params:
+            return (method, url)
+        return (method, url, tuple(sorted((k, str(v)) for k, v in params.items())))
+
+    def lookup(self, key: Tuple) -> Optional[CacheEntry]:
+        """查找条目（不论是否过期），命中时移到LRU尾部"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def record_hit(self):
+        self.metrics["hits"] += 1
+
+    def record_miss(self):
+        self.metrics["misses"] += 1
+
+    def freshness(self, headers, default_ttl: Optional[float]) -> Optional[float]:
+        """
+        根据响应头计算条目的有效期（秒）
+        :return: None 表示不可缓存；0 表示可缓存但每次使用前都需重新验证
+        """
+        directives = parse_cache_control(headers.get("cache-control"))
+        if "no-store" in directives or "private" in directives:
+            return None
+        if "no-cache" in directives:
+            return 0.0
+        for name in ("s-maxage", "max-age"):
+            if directives.get(name) is not None:
+                try:
+                    return max(float(directives[name]), 0.0)
+                except ValueError:
+                    break
+        return default_ttl
+
+    def store(self, key: Tuple, body: bytes, headers, default_ttl: Optional[float]) -> bool:
+        """按响应头和默认TTL存储响应体，返回是否已缓存"""
+        ttl = self.freshness(headers, default_ttl)
+        etag = headers.get("etag")
+        # 既没有有效期也没有ETag的条目无法复用
+        if ttl is None or (ttl == 0 and not etag) or len(body) > self.max_entry_bytes:
+            self.metrics["uncacheable"] += 1
+            return False
+        entry = CacheEntry(body, etag, time.monotonic() + ttl)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old.size
+            self._entries[key] = entry
+            self._bytes += entry.size
+            while self._bytes > self.max_bytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.size
+                self.metrics["evictions"] += 1
+        self.metrics["stores"] += 1
+        return True
+
+    def revalidate(self, key: Tuple, entry: CacheEntry, headers, default_ttl: Optional[float]):
+        """服务器返回304时刷新条目的过期时间"""
+        ttl = self.freshness(headers, default_ttl)
+        entry.expires_at = time.monotonic() + (ttl or 0.0)
+        if headers.get("etag"):
+            entry.etag = headers.get("etag")
+        self.metrics["revalidated"] += 1
+
+    def invalidate(self, key: Tuple = None):
+        """删除指定条目，不传key时清空缓存"""
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+                self._bytes = 0
+                return
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._bytes -= entry.size
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.metrics["hits"] + self.metrics["misses"]
+        return {
+            **self.metrics,
+            "hit_rate": self.metrics["hits"] / lookups if lookups else 0.0,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+        }
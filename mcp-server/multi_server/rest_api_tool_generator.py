@@ -1,61 +1,201 @@
 import httpx
 import inspect
 import json
-import types
 import asyncio
 import os
+import re
 import logging
-from typing import Dict, Any, Callable
+from typing import Dict, Any, Callable, Optional
 import base64
+import time
+from urllib.parse import urlsplit
+from response_cache import ResponseCache
+from call_policy import CallPolicy, policy_for, load_policy_config
+from mcp.server.fastmcp.tools.base import Tool
+from mcp.server.fastmcp.utilities.func_metadata import FuncMetadata, func_metadata
+
+
+def build_auth_headers() -> Dict[str, str]:
+    """根据环境变量构造IRIS的Basic认证头（只在注册时计算一次）"""
+    headers = {}
+    username = os.getenv("IRIS_USERNAME")
+    password = os.getenv("IRIS_PASSWORD")
+    if username and password:
+        credentials = f"{username}:{password}"
+        encoded_credentials = base64.b64encode(credentials.encode('utf-8')).decode('utf-8')
+        headers["Authorization"] = f"Basic {encoded_credentials}"
+    return headers
+
+
+class RequestPlan:
+    """
+    单个REST操作的预编译请求计划，在工具注册时构建一次。
+    URL模板预先拆分为常量片段与路径参数，参数按路径/查询/请求体预先分类，
+    认证头和连接池客户端在多个工具之间共享，每次调用只需少量字典查找。
+    """
+    __slots__ = ("name", "method", "url_segments", "path_params", "query_params",
+                 "body_params", "headers", "client", "timeout", "cache", "cache_ttl",
+                 "policy", "upstream")
+
+    # 只有安全方法的响应允许缓存
+    _SAFE_METHODS = ("GET", "HEAD")
+
+    # 将 "http://host/a/{docId}/b" 拆分为 ["http://host/a/", "docId", "/b"]
+    _PLACEHOLDER = re.compile(r"\{([^{}]+)\}")
+
+    def __init__(self, api: Dict[str, Any], client: httpx.AsyncClient, headers: Dict[str, str],
+                 timeout: float = 10.0, cache: ResponseCache = None, policy: CallPolicy = None):
+        self.name = api["name"]
+        self.method = api["method"].upper()
+        self.url_segments = tuple(self._PLACEHOLDER.split(api["api_path"]))
+        self.path_params = tuple(self.url_segments[1::2])
+        self.query_params = tuple(p for p in api.get("query_params", []) if p not in self.path_params)
+        # 请求体参数：除路径、查询参数以外的其余参数（仅用于非GET请求）
+        if self.method == "GET":
+            self.body_params = ()
+        else:
+            classified = set(self.path_params) | set(self.query_params)
+            self.body_params = tuple(p for p in api["input_schema"]["properties"] if p not in classified)
+        self.headers = headers
+        self.client = client
+        self.timeout = timeout
+        # 缓存为可选功能：仅当操作在规范中声明了 x-cache-ttl 且为安全方法时启用
+        self.cache_ttl = api.get("cache_ttl")
+        self.cache = cache if self.cache_ttl is not None and self.method in self._SAFE_METHODS else None
+        # 对冲/重试/熔断策略只用于幂等的安全方法，同一上游（host:port）共享熔断器
+        self.policy = policy if self.method in self._SAFE_METHODS else None
+        self.upstream = urlsplit(self.url_segments[0]).netloc
+
+    def build_url(self, args: Dict[str, Any]) -> str:
+        """将路径参数填入预拆分的URL模板"""
+        segments = self.url_segments
+        if len(segments) == 1:
+            return segments[0]
+        parts = list(segments)
+        for i in range(1, len(parts), 2):
+            parts[i] = str(args.get(parts[i]))
+        return "".join(parts)
+
+    async def execute(self, args: Dict[str, Any]) -> Any:
+        """按计划发送HTTP请求"""
+        url = self.build_url(args)
+        query_params = {p: args[p] for p in self.query_params if args.get(p) is not None}
+        json_payload = {p: args[p] for p in self.body_params if p in args}
+        try:
+            if self.cache is not None:
+                return await self._cached_request(url, query_params)
+            response = await self._send(url, query_params, json_payload, self.headers)
+            response.raise_for_status()
+            return response.json()
+        except httpx.HTTPStatusError as e:
+            return {
+                "error": f"HTTP错误: {e.response.status_code}",
+                "details": e.response.text
+            }
+        except Exception as e:
+            return {
+                "error": "请求失败",
+                "details": str(e)
+            }
+
+    async def _send(self, url: str, query_params: Dict, json_payload: Dict,
+                    headers: Dict[str, str]) -> httpx.Response:
+        async def send(timeout: float) -> httpx.Response:
+            return await self.client.request(
+                self.method,
+                url,
+                headers=headers,
+                params=query_params or None,
+                json=json_payload or None,
+                timeout=timeout
+            )
+
+        if self.policy is None:
+            return await send(self.timeout)
+        return await self.policy.call(self.upstream, send)
+
+    async def _cached_request(self, url: str, query_params: Dict) -> Any:
+        """带HTTP缓存语义的请求：新鲜条目直接返回，过期条目带ETag重新验证"""
+        cache = self.cache
+        key = cache.make_key(self.method, url, query_params)
+        entry = cache.lookup(key)
+        if entry is not None and entry.is_fresh(time.monotonic()):
+            cache.record_hit()
+            return json.loads(entry.body)
+
+        cache.record_miss()
+        headers = self.headers
+        if entry is not None and entry.etag:
+            headers = {**headers, "If-None-Match": entry.etag}
+        response = await self._send(url, query_params, None, headers)
+        if response.status_code == 304 and entry is not None:
+            cache.revalidate(key, entry, response.headers, self.cache_ttl)
+            return json.loads(entry.body)
+        response.raise_for_status()
+        cache.store(key, response.content, response.headers, self.cache_ttl)
+        return response.json()
+
+
+class LazyTool(Tool):
+    """
+    延迟构建的MCP工具：注册时直接使用OpenAPI规范中的输入模式作为参数定义，
+    函数签名、请求计划以及FastMCP的参数校验模型都推迟到第一次调用时才构建，
+    使启动耗时和内存不随操作数量增长。
+    """
+    fn_metadata: Optional[FuncMetadata] = None
+
+    @property
+    def output_schema(self) -> Optional[Dict[str, Any]]:
+        return self.fn_metadata.output_schema if self.fn_metadata is not None else None
+
+    async def run(self, arguments, context=None, convert_result=False):
+        if self.fn_metadata is None:
+            # self.fn 在构建前为生成器的 build_tool 绑定函数
+            self.fn = self.fn()
+            self.fn_metadata = func_metadata(self.fn)
+        return await super().run(arguments, context, convert_result)
+
 
 class RESTAPIToolGenerator:
-    def __init__(self, api_metadata: Dict[str, Any]):
+    def __init__(self, api_metadata: Dict[str, Any], client: httpx.AsyncClient = None,
+                 cache: ResponseCache = None, policy_config: Dict[str, Dict[str, Any]] = None):
         """
         初始化 REST API 工具生成器
         :param api_metadata: REST API 元数据描述
+        :param client: 所有工具共享的连接池客户端，不传则自动创建
+        :param cache: 可选的共享响应缓存，仅对声明了 x-cache-ttl 的GET操作生效
+        :param policy_config: 按工具名配置的调用策略，不传则读取环境变量 TOOL_CALL_POLICIES
         """
         self.api_metadata = api_metadata
+        self.client = client or httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20)
+        )
+        self.auth_headers = build_auth_headers()
+        self.cache = cache
+        self.policy_config = load_policy_config() if policy_config is None else policy_config
+        self.apis = {api["name"]: api for api in api_metadata}
+        self.request_plans = {}
         self.tool_functions = {}
-        self._generate_functions()
     
-    def _generate_functions(self):
-        """为每个 API 元数据生成对应的 Python 函数"""
-        for api in self.api_metadata:
-            # 创建函数名称和描述
-            func_name = api["name"]
-            description = api["description"]
-            
-            # 创建函数签名
-            signature = self._create_function_signature(api["input_schema"])
-            
-            # 获取额外参数信息
-            path_params = api.get("path_params", [])
-            query_params = api.get("query_params", [])
-            
-            # 创建函数实现
-            func_impl = self._create_function_implementation(
-                api["api_path"],
-                api["method"],
-                signature,
-                path_params,
-                query_params
-            )
-            
-            # 创建函数对象
-            func = types.FunctionType(
-                code=func_impl.__code__,
-                globals=globals(),
-                name=func_name,
-                argdefs=func_impl.__defaults__,
-                closure=func_impl.__closure__
-            )
-            
-            # 设置函数属性
-            func.__doc__ = description
-            func.__annotations__ = signature["annotations"]
-            
-            # 添加到工具字典
-            self.tool_functions[func_name] = func
+    def build_tool(self, func_name: str) -> Callable:
+        """为指定的 API 生成请求计划和对应的 Python 函数（已构建则直接返回）"""
+        func = self.tool_functions.get(func_name)
+        if func is not None:
+            return func
+        api = self.apis[func_name]
+        
+        # 创建函数签名
+        signature = self._create_function_signature(api["input_schema"])
+        
+        # 预编译请求计划
+        policy = policy_for(func_name, api.get("call_policy"), self.policy_config)
+        plan = RequestPlan(api, self.client, self.auth_headers, cache=self.cache, policy=policy)
+        self.request_plans[func_name] = plan
+        
+        # 创建函数对象并添加到工具字典
+        func = self._create_tool_function(func_name, api["description"], signature, plan)
+        self.tool_functions[func_name] = func
+        return func
     
     def _create_function_signature(self, input_schema: Dict) -> Dict:
         """
@@ -66,10 +206,10 @@ class RESTAPIToolGenerator:
         properties = input_schema["properties"]
         required_params = input_schema.get("required", [])
         
-        # 创建参数列表和类型注解
-        parameters = []
+        # 创建参数列表和类型注解（必需参数在前，非必需参数默认值为 None）
+        required = []
+        optional = []
         annotations = {}
-        defaults = []
         
         for param_name, param_def in properties.items():
             # 映射 JSON 类型到 Python 类型
@@ -78,18 +218,17 @@ class RESTAPIToolGenerator:
             # 添加类型注解
             annotations[param_name] = param_type
             
-            # 如果是必需参数
             if param_name in required_params:
-                parameters.append(param_name)
+                required.append(inspect.Parameter(
+                    param_name, inspect.Parameter.POSITIONAL_OR_KEYWORD, annotation=param_type))
             else:
-                # 非必需参数添加默认值
-                parameters.append(param_name)
-                defaults.append(None)  # 默认值为 None
+                optional.append(inspect.Parameter(
+                    param_name, inspect.Parameter.POSITIONAL_OR_KEYWORD, default=None, annotation=param_type))
         
         return {
-            "parameters": parameters,
+            "parameters": [p.name for p in required + optional],
             "annotations": annotations,
-            "defaults": tuple(defaults) if defaults else None
+            "signature": inspect.Signature(required + optional)
         }
     
     def _map_json_type_to_python(self, json_type: str) -> type:
@@ -105,121 +244,61 @@ class RESTAPIToolGenerator:
         }
         return type_mapping.get(json_type, Any)
     
-    def _create_function_implementation(self, api_path: str, method: str, signature: Dict, 
-                                        path_params: list, query_params: list) -> Callable:
+    def _create_tool_function(self, func_name: str, description: str, signature: Dict,
+                              plan: RequestPlan) -> Callable:
         """
-        创建函数实现（支持路径参数）
-        :param api_path: API 路径
-        :param method: HTTP 方法
+        创建调用请求计划的工具函数，通过 __signature__ 向 MCP 暴露参数定义
+        :param func_name: 工具名称
+        :param description: 工具描述
         :param signature: 函数签名
-        :param path_params: 路径参数列表
-        :param query_params: 查询参数列表
+        :param plan: 预编译的请求计划
         :return: 可调用的函数
         """
-        method = method.lower()
-        params = signature["parameters"]
-        
-        # 创建函数定义字符串
-        func_def = f"async def {signature.get('name', 'api_function')}({', '.join(params)}):\n"
-        
-        # 添加函数体 - 完整的 HTTP 请求实现
-        func_body = f"""
-    # 准备请求参数
-    # 1. 提取路径参数
-    path_params = {{"""
-        for param in path_params:
-            func_body += f"""
-        '{param}': {param},"""
-        func_body += f"""
-    }}
-    
-    # 2. 提取查询参数
-    query_params = {{}}
-    for param in {query_params}:
-        if param in locals() and locals()[param] is not None:
-            query_params[param] = locals()[param]
-    
-    # 3. 准备请求体（仅用于非GET请求）
-    json_payload = {{}}
-    if "{method}" != "get":
-        body_params = {params}
-        for param in body_params:
-            if param not in path_params and param not in query_params and param in locals():
-                json_payload[param] = locals()[param]
-    
-    # 构建最终URL（替换路径参数）
-    final_url = f"{api_path}"
-    if path_params:
-        for param, value in path_params.items():
-            # 安全处理路径参数占位符
-            placeholder = "{{" + param + "}}"
-            final_url = final_url.replace(placeholder, str(value))
-    
-    # 准备认证头
-    headers = {{}}
-    username = os.getenv("IRIS_USERNAME")
-    password = os.getenv("IRIS_PASSWORD")
-    if username and password:
-        credentials = f"{{username}}:{{password}}"
-        encoded_credentials = base64.b64encode(credentials.encode('utf-8')).decode('utf-8')
-        headers["Authorization"] = f"Basic {{encoded_credentials}}"
-    
-    # 发送 HTTP 请求
-    async with httpx.AsyncClient() as client:
-        try:
-            request_args = {{
-                "method": "{method}",
-                "url": final_url,
-                "headers": headers,
-                "params": query_params if query_params else None,
-                "json": json_payload if json_payload else None,
-                "timeout": 10.0
-            }}
-            
-            # 清除空值参数
-            request_args = {{k: v for k, v in request_args.items() if v is not None}}
-            
-            response = await client.request(**request_args)
-            response.raise_for_status()
-            return response.json()
-        except httpx.HTTPStatusError as e:
-            return {{
-                "error": f"HTTP错误: {{e.response.status_code}}",
-                "details": e.response.text
-            }}
-        except Exception as e:
-            return {{
-                "error": "请求失败",
-                "details": str(e)
-            }}
-"""
-        
-        # 合并函数定义和函数体
-        full_func_code = func_def + func_body
-        
-        # 执行函数代码
-        local_vars = {}
-        # 确保必要的模块在生成的函数中可用
-        exec_globals = {
-            "os": os, 
-            "base64": base64,
-            "json": json,
-            "httpx": httpx,
-            "logger": logging.getLogger(__name__)  # 添加logger
-        }
-        exec(full_func_code, exec_globals, local_vars)
-        
-        return local_vars[signature.get('name', 'api_function')]
+        sig = signature["signature"]
+
+        async def api_function(*args, **kwargs):
+            if args:
+                kwargs.update(zip(signature["parameters"], args))
+            return await plan.execute(kwargs)
+
+        api_function.__name__ = func_name
+        api_function.__qualname__ = func_name
+        api_function.__doc__ = description
+        api_function.__annotations__ = signature["annotations"]
+        api_function.__signature__ = sig
+        return api_function
     
     def get_tool_functions(self) -> Dict[str, Callable]:
-        """获取生成的工具函数字典"""
+        """获取生成的工具函数字典（会立即构建全部工具）"""
+        for func_name in self.apis:
+            self.build_tool(func_name)
         return self.tool_functions
     
-    def register_tools(self, mcp_server):
-        """将生成的工具注册到 MCP 服务器"""
-        for func_name, func in self.tool_functions.items():
-            mcp_server._tool_manager.add_tool(func, name=func_name)
-            print(f"已注册工具: {func_name}")
+    def register_tools(self, mcp_server, lazy: bool = True):
+        """
+        将生成的工具注册到 MCP 服务器
+        :param lazy: 为True时注册 LazyTool，工具在第一次调用时才构建
+        """
+        tools = mcp_server._tool_manager._tools
+        for func_name, api in self.apis.items():
+            if func_name in tools:
+                print(f"工具已存在，跳过: {func_name}")
+                continue
+            if not lazy:
+                mcp_server._tool_manager.add_tool(self.build_tool(func_name), name=func_name)
+                continue
+            tools[func_name] = LazyTool(
+                fn=lambda name=func_name: self.build_tool(name),
+                name=func_name,
+                description=api["description"],
+                parameters=api["input_schema"],
+                is_async=True,
+            )
+        print(f"已注册 {len(self.apis)} 个REST工具（{'延迟构建' if lazy else '立即构建'}）")
+
+    async def aclose(self):
+        """关闭共享的连接池客户端"""
+        await self.client.aclose()
 
 # 示例使用
 if __name__ == "__main__":
@@ -276,6 +355,10 @@ if __name__ == "__main__":
         }
     ]
     
+    # 设置环境变量用于测试（认证头在创建工具生成器时计算，需先设置）
+    os.environ["IRIS_USERNAME"] = "superuser"
+    os.environ["IRIS_PASSWORD"] = "SYS"
+    
     # 创建工具生成器
     generator = RESTAPIToolGenerator(api_metadata)
     
@@ -290,10 +373,6 @@ if __name__ == "__main__":
         print(f"签名: {inspect.signature(func)}")
         print(f"类型注解: {func.__annotations__}")
     
-    # 设置环境变量用于测试
-    os.environ["IRIS_USERNAME"] = "superuser"
-    os.environ["IRIS_PASSWORD"] = "SYS"
-    
     # 测试调用
     async def test_tools():
         print("\n测试工具调用:")